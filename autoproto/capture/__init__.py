@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+
+"""Module for recording the packets of a connection to a capture file and
+reading them back.
+
+A capture file holds the raw bytes of every packet, in the order they were
+received, together with the time and direction of each packet. It ends with
+an index of the packets by packet id and direction:
+
+    header:  magic, version (ubyte), start time (double)
+    record:  time since start (double), direction (ubyte), length (uint),
+             bytes of the packet
+    index:   number of entries (uint), then for every entry direction
+             (ubyte), packet id (ushort), number of records (uint) and the
+             offsets of the records (ulong each)
+    trailer: offset of the index (ulong), magic
+
+All values are big-endian. If a capture was never closed (for example when
+the process was killed), it has no index, and the index is rebuilt by going
+through the records the first time it's needed.
+
+A FlightRecorder keeps only the most recent packets of a connection in
+memory, and writes them to a capture file when asked to.
+
+"""
+
+import array
+import mmap
+import struct
+import sys
+import time
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+__all__ = [
+    'Capture', 'CaptureWriter', 'FlightRecorder', 'MAGIC', 'VERSION']
+
+MAGIC = b'APCP'
+VERSION = 1
+
+_header = struct.Struct('>4sBd')
+_record = struct.Struct('>dBI')
+_entry = struct.Struct('>BHI')
+_count = struct.Struct('>I')
+_trailer = struct.Struct('>Q4s')
+
+_swap = sys.byteorder == 'little'
+
+def _packet_id(packet):
+    packet_class = getattr(packet, 'packet_class', packet.__class__)
+    return packet_class.id
+
+class CaptureWriter(object):
+    """Writes packets to a capture file.
+
+    """
+    def __init__(self, path, buffering=65536, start_time=None):
+        """Creates a capture file at the specified path. The times of the
+        packets are stored relative to start_time, which defaults to the
+        current time.
+
+        """
+        self.path = path
+        if start_time is None:
+            start_time = time.time()
+        self.start_time = start_time
+        self.count = 0
+        self._fh = open(path, 'wb', buffering)
+        self._fh.write(_header.pack(MAGIC, VERSION, self.start_time))
+        self._offset = _header.size
+        # Offsets of the records, by (direction, packet id) tuples.
+        self._index = {}
+
+    @property
+    def closed(self):
+        return self._fh is None
+
+    def close(self):
+        """Writes the index and closes the file. Does nothing if the file has
+        already been closed.
+
+        """
+        if self._fh is None:
+            return
+
+        index_offset = self._offset
+        pieces = [_count.pack(len(self._index))]
+        for (direction, packet_id), offsets in sorted(self._index.items()):
+            pieces.append(_entry.pack(direction, packet_id, len(offsets)))
+            if _swap:
+                offsets.byteswap()
+            pieces.append(offsets.tobytes())
+        pieces.append(_trailer.pack(index_offset, MAGIC))
+        self._fh.write(b''.join(pieces))
+        self._fh.close()
+        self._fh = None
+
+    def write(self, packet, timestamp=None):
+        """Records a packet (or a Frame). The packet is recorded as the bytes
+        returned by its build method, which for a packet that has been read
+        by a PacketReader are the bytes it was read from, as long as it has
+        not been changed.
+
+        """
+        self.write_bytes(packet.direction, _packet_id(packet), packet.build(),
+                         timestamp)
+
+    def write_bytes(self, direction, packet_id, data, timestamp=None):
+        """Records the bytes of a packet with the specified direction and
+        packet id. The time of the packet defaults to the current time.
+
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        key = (direction, packet_id)
+        offsets = self._index.get(key)
+        if offsets is None:
+            offsets = self._index[key] = array.array('Q')
+        offsets.append(self._offset)
+
+        self._fh.write(_record.pack(timestamp - self.start_time, direction,
+                                    len(data)))
+        self._fh.write(data)
+        self._offset += _record.size + len(data)
+        self.count += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class FlightRecorder(object):
+    """Keeps the most recent packets of a connection, so that they can be
+    written to a capture file after something went wrong.
+
+    All the memory is allocated up front: the data of the packets is copied
+    into a ring buffer of size bytes, and the time, direction, packet id and
+    position of the most recent packets are kept in arrays of length frames.
+    A packet is lost once newer packets have overwritten its data, and
+    packets larger than the ring buffer are only counted.
+
+    """
+    def __init__(self, frames=256, size=256 * 1024, path=None):
+        """Sets up a recorder. The path is where dump writes the packets to
+        if no other path is given.
+
+        """
+        self.frames = frames
+        self.path = path
+        self.buffer = bytearray(size)
+        # The number of packets that have been recorded, and the number of
+        # bytes that have been written to the ring buffer. Data never wraps
+        # around the end of the buffer, so the bytes that are skipped at the
+        # end are counted as written.
+        self.count = 0
+        self.written = 0
+        self._times = array.array('d', [0.0]) * frames
+        self._directions = array.array('B', [0]) * frames
+        self._packet_ids = array.array('H', [0]) * frames
+        self._starts = array.array('Q', [0]) * frames
+        self._lengths = array.array('L', [0]) * frames
+
+    def write(self, packet, timestamp=None):
+        """Records a packet (or a Frame). See CaptureWriter.write.
+
+        """
+        self.write_bytes(packet.direction, _packet_id(packet), packet.build(),
+                         timestamp)
+
+    def write_bytes(self, direction, packet_id, data, timestamp=None):
+        """Records the bytes of a packet with the specified direction and
+        packet id. The time of the packet defaults to the current time.
+
+        """
+        slot = self.count % self.frames
+        self.count += 1
+        self._times[slot] = time.time() if timestamp is None else timestamp
+        self._directions[slot] = direction
+        self._packet_ids[slot] = packet_id
+        num = len(data)
+        self._lengths[slot] = num
+
+        size = len(self.buffer)
+        if num > size:
+            # Keep an empty range at the current position, which is treated
+            # as lost (see _data).
+            self._starts[slot] = self.written
+            return
+        position = self.written % size
+        if position + num > size:
+            # Start over at the beginning of the buffer.
+            self.written += size - position
+            position = 0
+        self._starts[slot] = self.written
+        self.buffer[position:position + num] = data
+        self.written += num
+
+    def _data(self, slot):
+        """Returns a copy of the data of the packet in the specified slot, or
+        None if the data has been overwritten.
+
+        """
+        size = len(self.buffer)
+        start, num = self._starts[slot], self._lengths[slot]
+        if num > size or self.written - start > size:
+            return None
+        position = start % size
+        return bytes(self.buffer[position:position + num])
+
+    def packets(self):
+        """Returns a list of (time, direction, packet id, data) tuples for the
+        packets that are still held, oldest first. The data of packets that
+        have been lost is None.
+
+        """
+        result = []
+        for i in range(max(0, self.count - self.frames), self.count):
+            slot = i % self.frames
+            result.append((self._times[slot], self._directions[slot],
+                           self._packet_ids[slot], self._data(slot)))
+        return result
+
+    def dump(self, path=None):
+        """Writes the packets that are still held to a capture file, and
+        returns the number of packets that were written.
+
+        """
+        packets = [p for p in self.packets() if p[3] is not None]
+        start_time = packets[0][0] if packets else None
+        with CaptureWriter(path or self.path, start_time=start_time) as out:
+            for timestamp, direction, packet_id, data in packets:
+                out.write_bytes(direction, packet_id, data, timestamp)
+        return len(packets)
+
+class Capture(object):
+    """A capture file opened for reading. The file is memory-mapped, so the
+    packet data is not copied or even read from disk until it's used.
+
+    The data of the records are memoryview instances of the memory map,
+    which must be released before the capture can be closed.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+        if len(self._map) < _header.size:
+            raise ValueError('%s is not a capture file' % path)
+        magic, version, self.start_time = _header.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        if version != VERSION:
+            raise ValueError('Unsupported capture version %d' % version)
+
+        # The index and the offset after the last record are only looked for
+        # once they're needed, since going through the records of a large
+        # capture takes a while.
+        self._end = None
+        self._index = None
+        self.complete = self._read_trailer()
+
+    def _read_trailer(self):
+        """Finds the end of the records from the trailer. Returns False if the
+        file doesn't end with a trailer.
+
+        """
+        size = len(self._map)
+        if size < _header.size + _count.size + _trailer.size:
+            return False
+        index_offset, magic = _trailer.unpack_from(
+            self._map, size - _trailer.size)
+        if magic != MAGIC or index_offset > size - _trailer.size:
+            return False
+        self._end = index_offset
+        return True
+
+    def _read_index(self):
+        """Reads the index at the end of the file.
+
+        """
+        index = {}
+        offset = self._end + _count.size
+        for i in range(_count.unpack_from(self._map, self._end)[0]):
+            direction, packet_id, num = _entry.unpack_from(self._map, offset)
+            offset += _entry.size
+            offsets = array.array('Q')
+            offsets.frombytes(self._view[offset:offset + num * 8])
+            if _swap:
+                offsets.byteswap()
+            offset += num * 8
+            index[direction, packet_id] = offsets
+        self._index = index
+
+    def _next_record(self, offset):
+        """Returns the offset of the record after the one at the specified
+        offset, or None if there is no complete record at the offset. A
+        record that is cut short ends the capture.
+
+        """
+        size = len(self._map)
+        if offset + _record.size > size:
+            return None
+        length = _record.unpack_from(self._map, offset)[2]
+        end = offset + _record.size + length
+        if end > size or not length:
+            return None
+        return end
+
+    def _rebuild_index(self):
+        """Builds the index by going through the records.
+
+        """
+        index = self._index = {}
+        offset = _header.size
+        while True:
+            end = self._next_record(offset)
+            if end is None:
+                break
+            direction = _record.unpack_from(self._map, offset)[1]
+            # The packet id is assumed to be the first byte of the packet.
+            packet_id = self._map[offset + _record.size]
+            key = (direction, packet_id)
+            offsets = index.get(key)
+            if offsets is None:
+                offsets = index[key] = array.array('Q')
+            offsets.append(offset)
+            offset = end
+        self._end = offset
+
+    @property
+    def end(self):
+        """The offset after the last record. For a capture that was never
+        closed, the records are gone through to find it.
+
+        """
+        if self._end is None:
+            offset = _header.size
+            while True:
+                end = self._next_record(offset)
+                if end is None:
+                    break
+                offset = end
+            self._end = offset
+        return self._end
+
+    @property
+    def index(self):
+        """A dict of the offsets of the records (as arrays) by (direction,
+        packet id) tuples. The index is read (or rebuilt) the first time it's
+        used, and holds an offset for every record.
+
+        """
+        if self._index is None:
+            if self.complete:
+                self._read_index()
+            else:
+                self._rebuild_index()
+        return self._index
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+
+    @property
+    def duration(self):
+        """The time of the last record, in seconds since the capture started.
+
+        """
+        offsets = [max(entry) for entry in self.index.values() if entry]
+        if not offsets:
+            return 0.0
+        return _record.unpack_from(self._map, max(offsets))[0]
+
+    def record_at(self, offset):
+        """Returns the (time, direction, data) tuple of the record at the
+        specified offset. The time is in seconds since the capture started.
+
+        """
+        t, direction, length = _record.unpack_from(self._map, offset)
+        start = offset + _record.size
+        return t, direction, self._view[start:start + length]
+
+    def records(self, direction=None, packet_ids=None, start=None, end=None):
+        """Yields a (time, direction, data) tuple for every record in the
+        capture, in the order they were recorded. If direction is specified,
+        only the packets of that direction are included, and if packet_ids is
+        specified, only packets with those ids are included. The start and
+        end offsets limit the records to a range of the file (see split).
+        Reading a range doesn't need the index unless packet_ids is
+        specified.
+
+        """
+        if start is None:
+            start = _header.size
+        if end is None:
+            end = self.end
+        elif self._end is not None:
+            end = min(end, self._end)
+
+        if packet_ids is not None:
+            offsets = []
+            for (d, packet_id), entry in self.index.items():
+                if packet_id in packet_ids and direction in (None, d):
+                    offsets += entry
+            offsets.sort()
+            for offset in offsets:
+                if start <= offset < end:
+                    yield self.record_at(offset)
+            return
+
+        unpack_from = _record.unpack_from
+        view = self._view
+        offset = start
+        while offset < end:
+            t, d, length = unpack_from(view, offset)
+            start = offset + _record.size
+            offset = start + length
+            if direction is None or d == direction:
+                yield t, d, view[start:offset]
+
+    def split(self, size):
+        """Splits the records into ranges of about size bytes. Returns a list
+        of (start, end) offsets that can be passed to records.
+
+        The ranges are found by going through the headers of the records
+        once, without using the index, so only the ranges are kept in memory.
+        Ranges can be read from other Capture instances of the same file
+        without going through the records again.
+
+        """
+        ranges = []
+        start = offset = _header.size
+        end = self._end
+        while offset != end:
+            following = self._next_record(offset)
+            if following is None:
+                # The capture was never closed and this is where it ends.
+                self._end = offset
+                break
+            offset = following
+            if offset - start >= size:
+                ranges.append((start, offset))
+                start = offset
+        if start < offset:
+            ranges.append((start, offset))
+        return ranges
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return sum(len(offsets) for offsets in self.index.values())
+
+    def __repr__(self):
+        return '%s.%s(%r)' % (self.__class__.__module__,
+                              self.__class__.__name__, self.path)
@@ -5,12 +5,62 @@ data structures.
 
 """
 
+import array
 import struct
+import sys
 
 __author__ = 'andreas@blixt.org (Andreas Blixt)'
 
 __all__ = ['Array', 'Marshaler', 'MarshalerInitializer']
 
+# Whether array.array values have to be byte swapped to match the big-endian
+# byte order that Marshaler formats use.
+_swap = sys.byteorder == 'little'
+
+# The array.array typecodes to try for every struct format character.
+_typecodes = {
+    'b': 'b', 'B': 'B', 'h': 'h', 'H': 'H', 'i': 'il', 'I': 'IL', 'q': 'ql',
+    'Q': 'QL', 'f': 'f', 'd': 'd'}
+
+# Cache of struct.Struct instances for sequences of values.
+_sequence_structs = {}
+
+def _array_typecode(item_type):
+    """Returns the array.array typecode that holds values of the specified
+    fixed-size Marshaler type, or None if there is no such typecode.
+
+    """
+    size = item_type.size
+    for code in _typecodes.get(item_type.format[1:], ''):
+        try:
+            if array.array(code).itemsize == size:
+                return code
+        except ValueError:
+            # The typecode is not supported by this version of Python.
+            pass
+    return None
+
+def _is_bulk(item_type):
+    """Returns True if sequences of the specified Marshaler type can be read
+    and written with a single struct format.
+
+    """
+    fmt = getattr(item_type, 'format', '')
+    return len(fmt) == 2 and fmt[0] == '>'
+
+def _sequence_struct(item_type, length):
+    """Returns a struct.Struct for a sequence of values of the specified
+    fixed-size Marshaler type.
+
+    """
+    fmt = '>%d%s' % (length, item_type.format[1:])
+    s = _sequence_structs.get(fmt)
+    if s is None:
+        if len(_sequence_structs) >= 100:
+            _sequence_structs.clear()
+        s = _sequence_structs[fmt] = struct.Struct(fmt)
+    return s
+
 class MarshalerInitializer(type):
     """Meta-class for setting up new classes with the base type Marshaler.
 
@@ -18,11 +68,11 @@ class MarshalerInitializer(type):
     def __new__(cls, name, bases, dct):
         # Pre-calculate the size of the value, if possible.
         if 'format' in dct:
-            dct['size'] = struct.calcsize(dct['format'])
+            dct['_struct'] = struct.Struct(dct['format'])
+            dct['size'] = dct['_struct'].size
         return type.__new__(cls, name, bases, dct)
 
-class Marshaler(object):
-    __metaclass__ = MarshalerInitializer
+class Marshaler(metaclass=MarshalerInitializer):
     _counter = 0
 
     def __init__(self, **kwargs):
@@ -35,22 +85,46 @@ class Marshaler(object):
         Marshaler._counter += 1
 
     def __get__(self, instance, owner):
+        if instance is None:
+            # The field was looked up on the packet class itself.
+            return self
+        try:
+            return self._get(instance)
+        except AttributeError:
+            pass
+
+        if instance._pending is not None:
+            # The packet was created from bytes that have not been decoded
+            # yet.
+            instance._decode()
+            return self._get(instance)
+
         if hasattr(self, 'default'):
-            return getattr(instance, '_v_' + self.name, self.default)
+            return self.default
         else:
-            try:
-                return getattr(instance, '_v_' + self.name)
-            except AttributeError:
-                raise AttributeError('\'%s\' missing value for \'%s\' (%s)' % (
-                    instance.__class__.__name__,
-                    self.name,
-                    self.__class__.__name__))
+            raise AttributeError('\'%s\' missing value for \'%s\' (%s)' % (
+                instance.__class__.__name__,
+                self.name,
+                self.__class__.__name__))
 
     def __set__(self, instance, value):
-        setattr(instance, '_v_' + self.name, value)
+        if instance._raw is not None:
+            # The packet will no longer match the bytes it was created from.
+            if instance._pending is not None:
+                instance._decode()
+            instance._raw = None
+        self._set(instance, value)
 
-    def _set_up(self, name):
+    def _set_up(self, name, slot):
+        """Sets up the Marshaler as the field with the specified name, with
+        its value stored in the specified slot of the packet class.
+
+        """
         self.name = name
+        # Keep the accessors of the slot around to avoid looking up the slot
+        # by name for every access.
+        self._get = slot.__get__
+        self._set = slot.__set__
 
     @classmethod
     def bytes_from(cls, value):
@@ -60,7 +134,19 @@ class Marshaler(object):
         format of the data.
 
         """
-        return struct.pack(cls.format, value)
+        return cls._struct.pack(value)
+
+    @classmethod
+    def from_unpacked(cls, value):
+        """Converts a value unpacked using the format of this class into the
+        value that should be exposed on packets.
+
+        Override this method instead of read_value for fixed-size types that
+        need to post-process their value, so that compiled packet readers can
+        apply the conversion after unpacking several fields at once.
+
+        """
+        return value
 
     @classmethod
     def read_bytes(cls, reader):
@@ -70,9 +156,22 @@ class Marshaler(object):
         behavior.
 
         """
-        data = reader.get(cls.size)
         # XXX: Ignores formats with more than one value.
-        return struct.unpack(cls.format, data)[0]
+        return reader.unpack(cls._struct)[0]
+
+    @classmethod
+    def skip_bytes(cls, reader):
+        """Moves the specified reader past a value without creating it.
+
+        Override this method for variable-size types that can find the end of
+        their data without reading all of it. By default, fixed-size types
+        skip their size and other types read and discard their value.
+
+        """
+        if hasattr(cls, 'size'):
+            reader.skip(cls.size)
+        else:
+            cls.read_bytes(reader)
 
     def bytes_for(self, packet):
         """Returns the byte string for the value of this field for the
@@ -86,14 +185,22 @@ class Marshaler(object):
         Marshaler. Default values do not count.
 
         """
-        return hasattr(packet, '_v_' + self.name)
+        if packet._pending is not None:
+            packet._decode()
+        try:
+            self._get(packet)
+        except AttributeError:
+            return False
+        return True
 
     def read(self, packet, reader):
         """Reads the value from the specified PacketReader and sets the
         appropriate field of the specified packet.
 
         """
-        self.__set__(packet, self.read_value(packet, reader))
+        # Reading a value does not count as changing the packet, so bypass
+        # __set__.
+        self._set(packet, self.read_value(packet, reader))
 
     def read_value(self, packet, reader):
         """Responsible for returning a value given a packet and a reader.
@@ -104,6 +211,16 @@ class Marshaler(object):
         """
         return self.read_bytes(reader)
 
+    def skip_value(self, reader):
+        """Moves the specified reader past the value of this field without
+        creating it.
+
+        If the skip_bytes function depends on field-specific values, override
+        this method to provide those values to it.
+
+        """
+        self.skip_bytes(reader)
+
     def value_for(self, packet):
         """Returns the value of this field for the specified packet, or the
         default value if the packet does not have a value set.
@@ -112,15 +229,22 @@ class Marshaler(object):
         value = self.__get__(packet, packet.__class__)
         return value
 
+# The default conversion of unpacked values, which bulk reads can skip.
+_plain_unpacked = Marshaler.from_unpacked.__func__
+
 class Array(Marshaler):
-    def __init__(self, length_type, item_type, **kwargs):
+    def __init__(self, length_type, item_type, as_array=False, **kwargs):
         """Initializes an array field. The length of the array is determined
         using length_type. If length_type is a number, that number is used as
         a fixed length instead. Every item in the array is read/written as
         item_type.
 
+        If as_array is True and item_type is a simple fixed-size type (such as
+        JavaShort), the value is read as an array.array instead of a list.
+
         """
         super(Array, self).__init__(**kwargs)
+        self.as_array = as_array
         self.length_type = length_type
         self.item_type = item_type
 
@@ -134,20 +258,33 @@ class Array(Marshaler):
         The item_kwargs argument is a dictionary of keyword arguments to pass
         on to the bytes_from method of the item_type class.
 
+        If item_type is a simple fixed-size type, the whole list (or
+        array.array) is packed in one go.
+
         """
         pieces = []
 
-        if isinstance(length_type, (int, long)):
+        if isinstance(length_type, int):
             assert len(value) == length_type, 'Invalid value length'
         else:
             pieces.append(length_type.bytes_from(len(value)))
 
-        for item in value:
-            pieces.append(item_type.bytes_from(item, **item_kwargs))
-        return ''.join(pieces)
+        if not _is_bulk(item_type) or item_kwargs:
+            for item in value:
+                pieces.append(item_type.bytes_from(item, **item_kwargs))
+        elif isinstance(value, array.array) and \
+                value.typecode == _array_typecode(item_type):
+            if _swap:
+                value = array.array(value.typecode, value)
+                value.byteswap()
+            pieces.append(value.tobytes())
+        else:
+            pieces.append(_sequence_struct(item_type, len(value)).pack(*value))
+        return b''.join(pieces)
 
     @classmethod
-    def read_bytes(cls, reader, length_type, item_type, **item_kwargs):
+    def read_bytes(cls, reader, length_type, item_type, as_array=False,
+                   **item_kwargs):
         """Reads a sequence of item_type. The length of the sequence is
         determined by reading a number using length_type. (If length_type is a
         number, that number will be used.)
@@ -155,20 +292,68 @@ class Array(Marshaler):
         The item_kwargs argument is a dictionary of keyword arguments to pass
         on to the read_bytes method of the item_type class.
 
+        If item_type is a simple fixed-size type, the whole sequence is
+        unpacked in one go. In that case an array.array is returned instead of
+        a list if as_array is True.
+
         """
-        if isinstance(length_type, (int, long)):
+        if isinstance(length_type, int):
             length = length_type
         else:
             length = length_type.read_bytes(reader)
+            reader.check_limit('max_array_length', length)
+
+        if hasattr(item_type, 'size') and not item_kwargs:
+            # Wait for the whole sequence before reading any of it, so that a
+            # sequence that arrives in pieces isn't read again for every
+            # piece.
+            reader.require(length * item_type.size)
+
+        if _is_bulk(item_type) and not item_kwargs:
+            code = as_array and _array_typecode(item_type)
+            if code and item_type.from_unpacked.__func__ is _plain_unpacked:
+                value = array.array(code)
+                value.frombytes(reader.get(length * item_type.size))
+                if _swap:
+                    value.byteswap()
+                return value
+
+            values = reader.unpack(_sequence_struct(item_type, length))
+            if item_type.from_unpacked.__func__ is _plain_unpacked:
+                return list(values)
+            return [item_type.from_unpacked(v) for v in values]
 
         value = []
-        for i in xrange(length):
+        for i in range(length):
             value.append(item_type.read_bytes(reader, **item_kwargs))
         return value
 
+    @classmethod
+    def skip_bytes(cls, reader, length_type, item_type, **item_kwargs):
+        """Moves the reader past a sequence of item_type without creating any
+        values. If item_type has a fixed size, the whole sequence is skipped
+        in one go.
+
+        """
+        if isinstance(length_type, int):
+            length = length_type
+        else:
+            length = length_type.read_bytes(reader)
+            reader.check_limit('max_array_length', length)
+
+        if hasattr(item_type, 'size') and not item_kwargs:
+            reader.skip(length * item_type.size)
+        else:
+            for i in range(length):
+                item_type.skip_bytes(reader, **item_kwargs)
+
     def bytes_for(self, packet):
         return self.bytes_from(self.value_for(packet), self.length_type,
                                self.item_type)
 
     def read_value(self, packet, reader):
-        return self.read_bytes(reader, self.length_type, self.item_type)
+        return self.read_bytes(reader, self.length_type, self.item_type,
+                               self.as_array)
+
+    def skip_value(self, reader):
+        self.skip_bytes(reader, self.length_type, self.item_type)
@@ -17,12 +17,15 @@ __all__ = [
 class JavaBool(Marshaler):
     format = '>b'
 
-    def read_value(self, packet, reader):
-        value = self.read_bytes(reader)
+    @classmethod
+    def from_unpacked(cls, value):
         assert value == 0 or value == 1, \
             'Tried to read a boolean but got %d' % value
         return bool(value)
 
+    def read_value(self, packet, reader):
+        return self.from_unpacked(self.read_bytes(reader))
+
 class JavaByte(Marshaler):
     format = '>b'
 
@@ -57,4 +60,11 @@ class JavaString(Marshaler):
     @classmethod
     def read_bytes(self, reader):
         strlen = JavaShort.read_bytes(reader)
+        reader.check_limit('max_string_length', strlen)
         return reader.get(strlen).decode('utf-8')
+
+    @classmethod
+    def skip_bytes(self, reader):
+        strlen = JavaShort.read_bytes(reader)
+        reader.check_limit('max_string_length', strlen)
+        reader.skip(strlen)
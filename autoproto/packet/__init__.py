@@ -6,14 +6,20 @@ well as writing a single packet to a Minecraft server.
 """
 
 import binascii
+import errno
+import socket
+import struct
+import time
 
 import autoproto.marshal
 
 __author__ = 'andreas@blixt.org (Andreas Blixt)'
 
 __all__ = [
-    'NotAvailableYet', 'Packet', 'PacketInitializer', 'PacketReader',
-    'PacketToClient', 'PacketToServer', 'TO_CLIENT', 'TO_SERVER']
+    'BufferReader', 'Frame', 'LimitExceeded', 'NotAvailableYet', 'Packet',
+    'PacketInitializer', 'PacketReader', 'PacketStats', 'PacketToClient',
+    'PacketToServer', 'PacketWriter', 'SharedFrame', 'TO_CLIENT', 'TO_SERVER',
+    'record_stats']
 
 TO_CLIENT = 0b10
 TO_SERVER = 0b01
@@ -23,6 +29,200 @@ TO_SERVER = 0b01
 _map_sc = {}
 _map_cs = {}
 
+def _is_fixed(val):
+    """Returns True if the specified Marshaler instance is read and written
+    using a single big-endian struct format, which makes it possible to merge
+    it with neighboring fields of the same kind.
+
+    """
+    fmt = getattr(val, 'format', None)
+    return fmt is not None and fmt[:1] == '>'
+
+def _group_fields(values):
+    """Groups a list of Marshaler instances into runs. Consecutive fixed-size
+    fields end up in the same run, while every variable-size field gets a run
+    of its own. Yields (fixed, fields) tuples.
+
+    """
+    run = []
+    for val in values:
+        if _is_fixed(val):
+            run.append(val)
+            continue
+        if run:
+            yield True, run
+            run = []
+        yield False, [val]
+    if run:
+        yield True, run
+
+def _check_direction(packet, direction):
+    """Raises a ValueError if the specified packet cannot be sent in the
+    specified direction.
+
+    """
+    if direction == TO_SERVER:
+        if not isinstance(packet, PacketToServer):
+            raise ValueError(
+                'Packet %s cannot have direction client->server' % (
+                    packet.__class__.__name__))
+    elif direction == TO_CLIENT:
+        if not isinstance(packet, PacketToClient):
+            raise ValueError(
+                'Packet %s cannot have direction server->client' % (
+                    packet.__class__.__name__))
+    elif direction is not None:
+        raise ValueError('Invalid direction')
+
+# Whether sockets support scatter/gather output.
+_sendmsg = hasattr(socket.socket, 'sendmsg')
+
+# Marks arguments of generated constructors that were not specified.
+_unset = object()
+
+# The PacketStats instance that statistics are currently recorded to, if any.
+# See record_stats.
+_stats = None
+_timer = time.perf_counter
+
+def _instrument_build(cls, enable):
+    """Replaces the build method of a packet class with a version that records
+    statistics, or restores the original build method. Replacing the method
+    keeps build free of any overhead while statistics are not recorded.
+
+    """
+    build = cls.__dict__.get('build')
+    if build is None or hasattr(build, '_untimed') == enable:
+        return
+    if not enable:
+        cls.build = build._untimed
+        return
+
+    def timed_build(packet):
+        start = _timer()
+        data = build(packet)
+        if _stats is not None:
+            _stats.add(cls, packet.direction, encoded=1,
+                       encoded_bytes=len(data), encode_time=_timer() - start)
+        return data
+    timed_build._untimed = build
+    cls.build = timed_build
+
+def _compile(cls):
+    """Generates specialized __init__, _read, _skip, _write and build
+    functions for a packet class. Returns a dict with the functions.
+
+    Every run of fixed-size fields is read and written with one precomputed
+    struct.Struct, while variable-size fields (such as strings) fall back to
+    the read, skip_value and bytes_for methods of their Marshaler.
+
+    """
+    namespace = {
+        '_check_direction': _check_direction,
+        '_id': cls.id_type.bytes_from(cls.id),
+        '_unset': _unset}
+
+    # The constructor takes every field as an optional keyword argument and
+    # stores it directly in its slot.
+    init_lines = [
+        'def __init__(self, direction=None%s):' % ''.join(
+            ', %s=_unset' % val.name for val in cls._values),
+        '    if direction is not None:',
+        '        _check_direction(self, direction)',
+        '    self.direction = direction',
+        '    self.suppressed = False',
+        '    self._pending = None',
+        '    self._limits = None',
+        '    self._raw = None']
+    for val in cls._values:
+        init_lines.append('    if %s is not _unset:' % val.name)
+        init_lines.append('        self._v_%s = %s' % (val.name, val.name))
+
+    read_lines = ['def _read(packet, reader):']
+    skip_lines = ['def _skip(reader):']
+    build_items = ['_id']
+    # Packets that still match the bytes they were created from write those
+    # bytes.
+    write_lines = [
+        'def _write(packet, writer):',
+        '    if packet._raw is not None:',
+        '        writer.write_bytes(packet._raw)',
+        '        return']
+
+    for i, (fixed, fields) in enumerate(_group_fields(cls._values)):
+        if i == 0 and not (fixed and _is_fixed(cls.id_type)):
+            # The packet id could not be merged into the first run.
+            write_lines.append('    writer.write_bytes(_id)')
+
+        if not fixed:
+            namespace['_m%d' % i] = fields[0]
+            read_lines.append('    _m%d.read(packet, reader)' % i)
+            skip_lines.append('    _m%d.skip_value(reader)' % i)
+            write_lines.append(
+                '    writer.write_bytes(_m%d.bytes_for(packet))' % i)
+            build_items.append('_m%d.bytes_for(packet)' % i)
+            continue
+
+        s = struct.Struct('>' + ''.join(val.format[1:] for val in fields))
+        namespace['_s%d' % i] = s
+
+        targets = []
+        conversions = []
+        for j, val in enumerate(fields):
+            convert = val.from_unpacked
+            if convert.__func__ is autoproto.marshal._plain_unpacked:
+                targets.append('packet._v_%s' % val.name)
+                continue
+            # The value needs to be post-processed before it's stored.
+            namespace['_c%d_%d' % (i, j)] = convert
+            targets.append('_t%d' % j)
+            conversions.append('    packet._v_%s = _c%d_%d(_t%d)' % (
+                val.name, i, j, j))
+
+        read_lines.append('    %s, = reader.unpack(_s%d)' % (
+            ', '.join(targets), i))
+        read_lines += conversions
+        skip_lines.append('    reader.skip(%d)' % s.size)
+
+        args = ', '.join('packet.%s' % val.name for val in fields)
+        build_items.append('_s%d.pack(%s)' % (i, args))
+
+        # Get the values before allocating any space, so that a missing
+        # value doesn't leave the space unused. The buffer is looked up after
+        # allocating since allocate may replace it.
+        for j, val in enumerate(fields):
+            write_lines.append('    _a%d = packet.%s' % (j, val.name))
+        args = ', '.join('_a%d' % j for j in range(len(fields)))
+        if i == 0 and _is_fixed(cls.id_type):
+            # Write the packet id as part of the first run.
+            s = struct.Struct('>' + cls.id_type.format[1:] + s.format[1:])
+            args = '%d, %s' % (cls.id, args)
+        namespace['_w%d' % i] = s
+        write_lines.append('    _p = writer.allocate(%d)' % s.size)
+        write_lines.append(
+            '    _w%d.pack_into(writer.buffer, _p, %s)' % (i, args))
+
+    if len(read_lines) == 1:
+        read_lines.append('    pass')
+        skip_lines.append('    pass')
+        write_lines.append('    writer.write_bytes(_id)')
+
+    # Packets that still match the bytes they were created from return
+    # those bytes.
+    build_lines = [
+        'def build(packet):',
+        '    if packet._raw is not None:',
+        '        return packet._raw']
+    if len(build_items) == 1:
+        build_lines.append('    return _id')
+    else:
+        build_lines.append(
+            '    return b\'\'.join((%s))' % ', '.join(build_items))
+
+    source = [init_lines, read_lines, skip_lines, write_lines, build_lines]
+    exec('\n\n'.join('\n'.join(lines) for lines in source), namespace)
+    return namespace
+
 class PacketInitializer(type):
     """Meta-class for setting up packet classes.
 
@@ -31,6 +231,13 @@ class PacketInitializer(type):
 
     """
     def __new__(cls, name, bases, dct):
+        if '__slots__' not in dct:
+            # Store the value of every field in a slot so that packets don't
+            # need a dict.
+            dct['__slots__'] = tuple(
+                '_v_' + attr_name for attr_name, attr in dct.items()
+                if isinstance(attr, autoproto.marshal.Marshaler))
+
         t = type.__new__(cls, name, bases, dct)
 
         if 'id' not in dct:
@@ -66,43 +273,151 @@ class PacketInitializer(type):
         for attr_name in dct.keys():
             attr = dct[attr_name]
             if isinstance(attr, autoproto.marshal.Marshaler):
-                attr._set_up(attr_name)
+                assert attr_name != 'direction', \
+                    '%s may not have a field named direction' % name
+                attr._set_up(attr_name, getattr(t, '_v_' + attr_name))
                 t._values.append(attr)
         t._values.sort(key=lambda v: v._creation_index)
 
+        # Replace the generic field loops with generated code.
+        code = _compile(t)
+        t._read = code['_read']
+        t._skip = staticmethod(code['_skip'])
+        t._write = code['_write']
+        for attr_name in ('__init__', 'build'):
+            if attr_name not in dct:
+                setattr(t, attr_name, code[attr_name])
+
+        if _stats is not None:
+            _instrument_build(t, True)
+
         return t
 
-class Packet(object):
-    __metaclass__ = PacketInitializer
+class Packet(metaclass=PacketInitializer):
+    __slots__ = ['direction', 'suppressed', '_limits', '_pending', '_raw']
 
     def __init__(self, direction=None, **kwargs):
-        if direction == TO_SERVER:
-            if not isinstance(self, PacketToServer):
-                raise ValueError(
-                    'Packet %s cannot have direction client->server' % (
-                        self.__class__.__name__))
-        elif direction == TO_CLIENT:
-            if not isinstance(self, PacketToClient):
-                raise ValueError(
-                    'Packet %s cannot have direction server->client' % (
-                        self.__class__.__name__))
-        elif direction is not None:
-            raise ValueError('Invalid direction')
+        """Packet classes with an id get a generated version of this method
+        that only accepts the fields of the packet class as keyword arguments.
+
+        """
+        _check_direction(self, direction)
 
         self.direction = direction
         self.suppressed = False
+        # The bytes that the fields of the packet still have to be decoded
+        # from.
+        self._pending = None
+        # The reader limits that the pending bytes are decoded with.
+        self._limits = None
+        # The bytes that the packet was created from, as long as it's
+        # unchanged.
+        self._raw = None
 
         for name in kwargs:
             setattr(self, name, kwargs[name])
 
+    @classmethod
+    def from_bytes(cls, data, direction=None, limits=None):
+        """Creates a packet of this class from its bytes, including the packet
+        id, without decoding it.
+
+        The fields are decoded the first time any of them is accessed, and
+        until a field is assigned, build will return the original bytes. Note
+        that changes made to mutable values (such as lists) do not count
+        unless the value is assigned to the field again.
+
+        If limits is specified, it's a dict of the limits (see
+        BufferReader.limits) that the fields are decoded with.
+
+        """
+        packet = cls(direction)
+        packet._raw = packet._pending = data
+        packet._limits = limits
+        return packet
+
+    def _decode(self):
+        """Decodes the fields of a packet created by from_bytes.
+
+        """
+        reader = BufferReader(self._pending, self._limits)
+        self._pending = None
+        self._limits = None
+        if _stats is None:
+            self.id_type.skip_bytes(reader)
+            self._read(reader)
+            return
+
+        start = _timer()
+        self.id_type.skip_bytes(reader)
+        self._read(reader)
+        # The packet was already counted when it was read.
+        _stats.add(self.__class__, self.direction,
+                   decode_time=_timer() - start)
+
+    def _read(self, reader):
+        """Reads the values of all the fields of this packet from the
+        specified PacketReader. Packet classes with an id get a generated
+        version of this method.
+
+        """
+        for val in self._values:
+            val.read(self, reader)
+
+    def _resume(self, reader):
+        """Continues reading a packet from the specified PacketReader after a
+        field ran out of data part of the way through its value. Fields that
+        already have values are not read again.
+
+        If a field runs out of data without keeping a partial value, the
+        reader is moved back to the start of that field, so that only the
+        field is read again once more data arrives.
+
+        """
+        for val in self._values:
+            if val.has_value(self):
+                continue
+            start = reader.consumed
+            try:
+                val.read(self, reader)
+            except NotAvailableYet:
+                if reader.partial is None:
+                    reader.consumed = start
+                raise
+
+    @classmethod
+    def _skip(cls, reader):
+        """Moves the specified PacketReader past the data of a packet of this
+        class without creating any values. Packet classes with an id get a
+        generated version of this method.
+
+        """
+        for val in cls._values:
+            val.skip_value(reader)
+
+    def _write(self, writer):
+        """Writes this packet to the specified PacketWriter. Packet classes
+        with an id get a generated version of this method that packs values
+        directly into the buffer of the writer.
+
+        """
+        writer.write_bytes(self.build())
+
     def build(self):
+        """Returns the byte string for this packet. Packet classes with an id
+        get a generated version of this method.
+
+        """
+        if self._raw is not None:
+            return self._raw
+
         pieces = []
         pieces.append(self.id_type.bytes_from(self.id))
 
         for val in self._values:
             pieces.append(val.bytes_for(self))
 
-        return ''.join(pieces)
+        return b''.join(pieces)
 
     def suppress(self):
         """By calling this method, the packet is marked as being suppressed,
@@ -131,7 +446,93 @@ class PacketToClient(Packet):
 class PacketToServer(Packet):
     pass
 
-class NotAvailableYet:
+class Frame(object):
+    """The bytes of an encoded packet. The PacketReader creates frames for
+    packets that it does not decode, so that they can be forwarded byte for
+    byte.
+
+    Since a frame is only encoded once, the same frame can be written to any
+    number of PacketWriter instances (see from_packet).
+
+    """
+    __slots__ = ['data', 'direction', 'packet_class', 'suppressed']
+
+    def __init__(self, packet_class, direction, data):
+        self.data = data
+        self.direction = direction
+        self.packet_class = packet_class
+        self.suppressed = False
+
+    @classmethod
+    def from_packet(cls, packet):
+        """Encodes a packet into a SharedFrame, for sending the same packet to
+        many connections without encoding it for each one of them.
+
+        """
+        return SharedFrame(packet.__class__, packet.direction,
+                           bytes(packet.build()))
+
+    def _write(self, writer):
+        writer.write_bytes(self.data)
+
+    def build(self):
+        return self.data
+
+    def copy(self):
+        """Returns a frame with the same bytes that is not suppressed. The
+        bytes are not copied.
+
+        """
+        return Frame(self.packet_class, self.direction, self.data)
+
+    def suppress(self):
+        """Marks the frame as suppressed. See Packet.suppress.
+
+        """
+        self.suppressed = True
+
+    def __repr__(self):
+        return '%s.%s(%s, %d bytes)' % (
+            self.__class__.__module__, self.__class__.__name__,
+            self.packet_class.__name__, len(self.data))
+
+    def __str__(self):
+        return self.packet_class.__name__
+
+class SharedFrame(Frame):
+    """A frame that is written to many connections (see Frame.from_packet).
+    Its bytes and attributes can't be changed, since every connection would
+    see the change. To suppress the frame for a single connection, suppress
+    a copy of it instead (see Frame.copy).
+
+    """
+    __slots__ = []
+
+    def __init__(self, packet_class, direction, data):
+        set_slot = super(SharedFrame, self).__setattr__
+        set_slot('data', data)
+        set_slot('direction', direction)
+        set_slot('packet_class', packet_class)
+        set_slot('suppressed', False)
+
+    def __delattr__(self, name):
+        raise AttributeError('Shared frames are read-only')
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Shared frames are read-only')
+
+    def suppress(self):
+        raise TypeError('Shared frames can\'t be suppressed; suppress a copy '
+                        'of the frame instead')
+
+class LimitExceeded(Exception):
+    """Raised by a reader when data exceeds one of the limits of the reader,
+    which means that the data is malformed (or malicious) and reading can't
+    continue.
+
+    """
+
+class NotAvailableYet(BaseException):
     """Raised to abort reading when no data is available. Since it is neither
     an error nor an exception it does not inherit from the Exception class.
 
@@ -140,8 +541,171 @@ class NotAvailableYet:
     # every instance.
     __slots__ = []
 
-class PacketReader(object):
-    def __init__(self, id_type, direction):
+class BufferReader(object):
+    """Reads values from a buffer of bytes, keeping track of the current
+    position. This is the interface that Marshaler types read their values
+    through.
+
+    """
+    # Limits for the data being read, to stop malformed data from using up
+    # memory. A limit of None means no limit. Any limit that is exceeded
+    # raises LimitExceeded.
+    max_array_length = None
+    max_decompressed_size = None
+    max_pending = None
+    max_string_length = None
+    # Whether values that are read piece by piece (see partial) keep the data
+    # they were read from, so that it can be written again as it was. Data
+    # that is kept counts towards max_pending.
+    keep_compressed = False
+    # The names of the limits that apply to the bytes of a single packet,
+    # which are passed on to packets that are decoded later.
+    limits = ('max_array_length', 'max_decompressed_size',
+              'max_string_length')
+
+    def __init__(self, data=b'', limits=None):
+        """Sets up a reader of data. If limits is specified, it's a dict of
+        limits that replace the limits of the class.
+
+        """
+        if limits:
+            for name, value in limits.items():
+                setattr(self, name, value)
+        self.buffer = data
+        # The position of the next byte to read.
+        self.consumed = 0
+        # The position after the last byte of data in the buffer.
+        self.size = len(data)
+        # The buffer size needed before it's worth attempting to read again.
+        self._wanted = 0
+        # The state of a value that has been partially read. Marshaler types
+        # that can read their value piece by piece store their progress here
+        # and clear it once the value is complete.
+        self.partial = None
+
+    def _advance(self, num):
+        """Moves the buffer position forward by a number of bytes and returns
+        the position before it was moved. Raises NotAvailableYet if there
+        aren't enough bytes available.
+
+        """
+        if num < 0:
+            raise ValueError('Number of bytes may not be a negative number')
+        start = self.consumed
+        end = start + num
+        if end > self.size:
+            # Remember how much data is needed so that no attempt to read is
+            # made until it has arrived.
+            self._wanted = end
+            # Raise to tell the caller that all the data is not available yet.
+            raise NotAvailableYet
+        self.consumed = end
+        return start
+
+    def available(self):
+        """Returns the number of bytes that can currently be read.
+
+        """
+        return self.size - self.consumed
+
+    def check_limit(self, name, value):
+        """Raises LimitExceeded if value is greater than the limit with the
+        specified name (one of the max_* attributes of the reader), or if
+        value is negative, since lengths and sizes never are unless the data
+        is malformed.
+
+        """
+        if value < 0:
+            raise LimitExceeded('%s does not allow negative values, but got %d'
+                                % (name, value))
+        limit = getattr(self, name)
+        if limit is not None and value > limit:
+            raise LimitExceeded('%s is %d, but got %d' % (name, limit, value))
+
+    def require(self, num):
+        """Raises NotAvailableYet unless at least num bytes can be read. The
+        reader buffer state is not affected.
+
+        """
+        end = self.consumed + num
+        if end > self.size:
+            self._wanted = end
+            raise NotAvailableYet
+
+    def get(self, num):
+        """Attempts to get a number of bytes from the reader buffer. If there
+        aren't enough bytes available, NotAvailableYet will be raised and the
+        buffer state will not be affected.
+
+        It's very important that any code not invoked through the read method
+        that is calling this method is careful to try for NotAvailableYet as it
+        is not an Exception instance and will stop code execution unless
+        handled.
+
+        """
+        start = self._advance(num)
+        return self.get_range(start, start + num)
+
+    def skip(self, num):
+        """Moves the reader past a number of bytes without copying them. Like
+        the get method, this method raises NotAvailableYet if there aren't
+        enough bytes available.
+
+        """
+        self._advance(num)
+
+    def unpack(self, s):
+        """Unpacks values from the reader buffer using the specified
+        struct.Struct instance. Like the get method, this method raises
+        NotAvailableYet if there aren't enough bytes available.
+
+        """
+        return s.unpack_from(self.buffer, self._advance(s.size))
+
+    def get_range(self, start, end):
+        """Returns the bytes between two positions in the reader buffer.
+
+        """
+        return memoryview(self.buffer)[start:end].tobytes()
+
+class PacketReader(BufferReader):
+    """Reads packets from a stream of bytes.
+
+    Incoming data is kept in a bytearray that is only compacted or grown when
+    there is no room left at its end, so the pending data is not copied for
+    every chunk of data received. Fixed-size values are unpacked straight out
+    of the buffer.
+
+    """
+    # The initial capacity of the buffer.
+    initial_size = 16384
+    # The maximum number of bytes to make room for beyond the data that has
+    # arrived, when a length read from the data says that more is needed.
+    max_reserve = 65536
+    # The maximum number of bytes needed for a packet before it can be read.
+    # See BufferReader for the other limits.
+    max_pending = None
+
+    def __init__(self, id_type, direction, decode=None, lazy=False,
+                 max_pending=None, max_array_length=None,
+                 max_string_length=None, max_decompressed_size=None):
+        """Sets up a reader for packets of the specified direction.
+
+        If decode is specified, only packets whose class is in decode will be
+        decoded into Packet instances. All other packets will be skipped over
+        and returned as Frame instances holding their raw bytes.
+
+        If lazy is True, packets keep the bytes they were read from and their
+        fields are not decoded until one of them is accessed. See
+        Packet.from_bytes.
+
+        The max_* arguments set the limits of the reader, which stop malformed
+        data from using up memory. Limits that are not specified fall back to
+        the limits of the class. Exceeding a limit raises LimitExceeded, after
+        which the reader can't be used anymore. Lazily decoded packets are
+        decoded with the same limits when their fields are accessed.
+
+        """
         if direction == TO_SERVER:
             self._map = _map_cs
         elif direction == TO_CLIENT:
@@ -149,81 +713,190 @@ class PacketReader(object):
         else:
             raise ValueError('Invalid direction')
 
-        self.buffer = ''
-        self.consumed = 0
+        super(PacketReader, self).__init__(bytearray(self.initial_size))
+        self.size = 0
+        self.decode = decode
         self.direction = direction
         self.id_type = id_type
+        self.lazy = lazy
+        if max_pending is not None:
+            self.max_pending = max_pending
+        if max_array_length is not None:
+            self.max_array_length = max_array_length
+        if max_string_length is not None:
+            self.max_string_length = max_string_length
+        if max_decompressed_size is not None:
+            self.max_decompressed_size = max_decompressed_size
+        # The limits that lazily decoded packets are decoded with.
+        self._limits = {name: getattr(self, name) for name in self.limits}
+        self._last_packet = None
         self._packet = None
+        # Whether the packet being read has used up data that can't be read
+        # again, which means that it has to be resumed rather than read from
+        # the start.
+        self._resuming = False
+        # The number of calls, bytes and time used so far by the packet that
+        # is being read, while statistics are recorded.
+        self._reads = 0
+        self._read_bytes = 0
+        self._read_time = 0.0
 
-    def get(self, num):
-        """Attempts to get a number of bytes from the reader buffer. If there
-        aren't enough bytes available, None will be returned and the buffer
-        state will not be affected.
-
-        It's very important that any code not invoked through the read method
-        that is calling this method is careful to try for NotAvailableYet as it
-        is not an Exception instance and will stop code execution unless
-        handled.
+    def _reserve(self, num):
+        """Makes room for at least num bytes after the data in the buffer by
+        either moving pending data to the start of the buffer or by growing
+        the buffer. Returns a memoryview of the free space.
 
         """
-        if num < 0:
-            raise ValueError('Number of bytes may not be a negative number')
-        start = self.consumed
-        end = start + num
-        if end > len(self.buffer):
-            # Raise to tell the caller that all the data is not available yet.
-            raise NotAvailableYet
-        self.consumed += num
-        return self.buffer[start:end]
+        pending = self.size - self.consumed
+        # Make room for data that is known to be needed as well, but only
+        # up to max_reserve bytes at a time since the length it's known from
+        # hasn't been checked yet. The buffer doubles in size whenever it
+        # grows, so large packets are still copied a few times at most.
+        needed = max(pending + num, min(self._wanted - self.consumed,
+                                        pending + num + self.max_reserve))
+
+        if len(self.buffer) - self.size < num or len(self.buffer) < needed:
+            capacity = len(self.buffer)
+            while capacity < needed:
+                capacity *= 2
+
+            if capacity == len(self.buffer):
+                # Move the pending data to the start of the buffer.
+                self.buffer[:pending] = self.buffer[self.consumed:self.size]
+            else:
+                buf = bytearray(capacity)
+                buf[:pending] = memoryview(self.buffer)[
+                    self.consumed:self.size]
+                self.buffer = buf
+            self._wanted -= self.consumed
+            self.consumed = 0
+            self.size = pending
+
+        return memoryview(self.buffer)[self.size:]
 
     def read(self, data):
         """Gives the packet reader more data to work with. This method will
         return a list of Packet instances that were completely read. The list
         may be empty.
 
+        """
+        if not data:
+            # There was no new data available, so assume nothing can be done.
+            return []
+
+        num = len(data)
+        self._reserve(num)[:num] = data
+        return self._received(num)
+
+    def recv_into(self, sock, size=8192):
+        """Receives up to size bytes from the specified socket directly into
+        the reader buffer. Returns a list of Packet instances that were
+        completely read, or None if the connection was closed.
+
+        """
+        num = sock.recv_into(self._reserve(size), size)
+        if not num:
+            return None
+        return self._received(num)
+
+    def _received(self, num):
+        """Reads as many packets as possible after num bytes of data have
+        been added to the end of the buffer.
+
         """
         # A list of completely read packets.
         packets = []
 
-        if not data:
-            # There was no new data available, so assume nothing can be done.
-            return packets
+        stats = _stats
+        if stats is not None:
+            if self._packet is None and self.consumed == self.size:
+                # The data starts a new packet.
+                self._reads = 1
+            else:
+                self._reads += 1
 
-        self.buffer += data
+        self.size += num
+        if self.size < self._wanted:
+            # The data needed to continue reading hasn't arrived yet.
+            return packets
 
         # Keep looping until we can't read any more.
         while True:
             # Remember current buffer position so that it can be restored
             # something needs before data before it can be read.
             mark = self.consumed
+            if stats is not None:
+                begin, started = mark, _timer()
             try:
                 if not self._packet:
                     # Start reading a new packet.
                     packet_id = self.id_type.read_bytes(self)
                     if packet_id not in self._map:
                         # Get the remaining bytes to show in error.
-                        data = self.buffer[mark:]
+                        data = bytes(self.buffer[mark:self.size])
                         # Raise error.
                         raise NotImplementedError(
                             'Encountered unimplemented packet %r [%s] Last '
                             'packet was: %r' % (
                                 packet_id, binascii.hexlify(data),
                                 self._last_packet))
-                    self._packet = self._map[packet_id](self.direction)
-                packet = self._packet
+                    cls = self._map[packet_id]
+
+                    if self.decode is not None and cls not in self.decode:
+                        # Find the end of the packet and keep its bytes as
+                        # they are.
+                        cls._skip(self)
+                        packet = Frame(cls, self.direction,
+                                       self.get_range(mark, self.consumed))
+                        packets.append(packet)
+                        self._last_packet = packet
+                        if stats is not None:
+                            self._record(stats, cls, begin, started)
+                        continue
 
-                for val in packet._values:
-                    if val.has_value(packet):
-                        # Skip values that have already been loaded.
+                    if self.lazy:
+                        # Find the end of the packet and leave decoding to
+                        # the packet.
+                        cls._skip(self)
+                        packet = cls.from_bytes(
+                            self.get_range(mark, self.consumed),
+                            self.direction, self._limits)
+                        packets.append(packet)
+                        self._last_packet = packet
+                        if stats is not None:
+                            self._record(stats, cls, begin, started)
                         continue
-                    # Update the mark since all data read so far should be
-                    # kept.
+
+                    self._packet = cls(self.direction)
+                    # Update the mark since the packet id should be kept.
                     mark = self.consumed
-                    val.read(packet, self)
+                packet = self._packet
+
+                # Read the entire packet in one go. If the data runs out,
+                # reading starts over from the mark once more data arrives,
+                # unless a field kept its progress as a partial value. From
+                # then on, the packet is resumed field by field.
+                if self._resuming:
+                    packet._resume(self)
+                else:
+                    packet._read(self)
             except NotAvailableYet:
+                if self.partial is not None or self._resuming:
+                    # The data read so far has been used by the partially
+                    # read field (or by fields that were read completely), so
+                    # there's no need to keep it.
+                    mark = self.consumed
+                    self._resuming = self._packet is not None
+                if stats is not None:
+                    # Keep track of the data that won't be read again.
+                    self._read_bytes += mark - begin
+                    self._read_time += _timer() - started
                 # Ran out of data; restore the buffer position and exit the
                 # loop.
                 self.consumed = mark
+                if self.max_pending is not None:
+                    # Don't wait for (and buffer) more data than allowed.
+                    self.check_limit('max_pending', self._wanted - mark)
                 break
             else:
                 # All data was available, which means the packet has been read.
@@ -231,9 +904,240 @@ class PacketReader(object):
                 packets.append(packet)
                 self._last_packet = self._packet
                 self._packet = None
+                self._resuming = False
+                if stats is not None:
+                    self._record(stats, packet.__class__, begin, started)
 
-        # Remove all data that was consumed from the buffer.
-        self.buffer = self.buffer[self.consumed:]
-        self.consumed = 0
+        if self.consumed == self.size:
+            # Everything has been read, so start over at the beginning of the
+            # buffer without having to move any data.
+            self._wanted -= self.consumed
+            self.consumed = 0
+            self.size = 0
 
         return packets
+
+    def _record(self, stats, packet_class, begin, started):
+        """Records the statistics of a packet that has been read completely,
+        where begin and started are the buffer position and the time when
+        the last attempt to read it started.
+
+        """
+        stats.add(packet_class, self.direction, decoded=1,
+                  decoded_bytes=self._read_bytes + self.consumed - begin,
+                  decode_time=self._read_time + _timer() - started,
+                  read_calls=self._reads)
+        # Any following packet starts with the current data.
+        self._reads = 1
+        self._read_bytes = 0
+        self._read_time = 0.0
+
+class PacketWriter(object):
+    """Encodes packets into a reusable buffer and sends them to a socket.
+
+    Packets are packed directly into a bytearray. Large byte strings (such as
+    already built packets) are queued as they are instead of being copied.
+    The queued data is sent with a single scatter/gather sendmsg call where
+    available, and whatever the socket doesn't accept is kept until the next
+    flush.
+
+    """
+    # The initial capacity of the buffer.
+    initial_size = 16384
+    # Byte strings at least this long are queued instead of copied.
+    copy_limit = 1024
+    # The maximum number of buffers to pass to a single sendmsg call.
+    max_buffers = 512
+
+    def __init__(self):
+        self.buffer = bytearray(self.initial_size)
+        # The total number of bytes that have been written and flushed.
+        self.written = 0
+        self.flushed = 0
+        # The position after the last byte written to the buffer.
+        self.size = 0
+        # The position of the first byte in the buffer that isn't queued.
+        self._start = 0
+        # The buffers that are waiting to be sent.
+        self._queue = []
+
+    @property
+    def pending(self):
+        """The number of bytes that have been written but not flushed.
+
+        """
+        return self.written - self.flushed
+
+    def _seal(self):
+        """Queues the data written to the buffer since it was last queued.
+
+        """
+        if self.size > self._start:
+            self._queue.append(memoryview(self.buffer)[self._start:self.size])
+            self._start = self.size
+
+    def allocate(self, num):
+        """Reserves num bytes at the end of the buffer and returns the position
+        where they start. The caller is responsible for filling them in.
+
+        """
+        start = self.size
+        end = start + num
+        if end > len(self.buffer):
+            # Queued data may still refer to the current buffer, so start
+            # over with a new one instead of moving data around.
+            self._seal()
+            capacity = len(self.buffer)
+            while capacity < num:
+                capacity *= 2
+            self.buffer = bytearray(capacity)
+            self._start = 0
+            start, end = 0, num
+        self.size = end
+        self.written += num
+        return start
+
+    def write(self, packet):
+        """Encodes a packet (or a Frame) at the end of the output. If the
+        packet can't be encoded, nothing is added to the output.
+
+        """
+        stats = _stats
+        if stats is not None:
+            start = _timer()
+        state = self.buffer, self.size, self._start, len(self._queue), \
+            self.written
+        try:
+            packet._write(self)
+        except Exception:
+            self._restore(state)
+            raise
+        if stats is None:
+            return
+
+        if isinstance(packet, Frame):
+            packet_class = packet.packet_class
+        else:
+            packet_class = packet.__class__
+        stats.add(packet_class, packet.direction, encoded=1,
+                  encoded_bytes=self.written - state[4],
+                  encode_time=_timer() - start)
+
+    def _restore(self, state):
+        """Removes everything that was written after the state of the writer
+        was saved by write.
+
+        """
+        self.buffer, self.size, self._start, queued, self.written = state
+        del self._queue[queued:]
+
+    def write_bytes(self, data):
+        """Adds a byte string to the end of the output. The byte string must
+        not be changed until it has been flushed.
+
+        """
+        num = len(data)
+        if num < self.copy_limit:
+            start = self.allocate(num)
+            self.buffer[start:start + num] = data
+        else:
+            self._seal()
+            self._queue.append(data)
+            self.written += num
+
+    def flush(self, sock):
+        """Sends as much of the output as the specified socket accepts without
+        blocking. Returns the number of bytes that were sent.
+
+        """
+        self._seal()
+        queue = self._queue
+        if not queue:
+            return 0
+
+        try:
+            if _sendmsg:
+                sent = sock.sendmsg(queue[:self.max_buffers])
+            else:
+                sent = sock.send(queue[0])
+        except OSError as why:
+            if why.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+        self.flushed += sent
+
+        # Remove everything that was sent from the queue.
+        remaining = sent
+        i = 0
+        while i < len(queue) and remaining >= len(queue[i]):
+            remaining -= len(queue[i])
+            i += 1
+        del queue[:i]
+        if remaining:
+            queue[0] = memoryview(queue[0])[remaining:]
+
+        if not queue:
+            # Nothing refers to the buffer anymore, so it can be reused.
+            self._start = self.size = 0
+
+        return sent
+
+class PacketStats(object):
+    """Statistics about the packets that have been read and written, per
+    packet class and direction. See record_stats.
+
+    """
+    # The statistics kept for every packet class and direction. The read
+    # calls are the number of times a PacketReader was given data until the
+    # packets were complete.
+    fields = ('decoded', 'decoded_bytes', 'decode_time', 'read_calls',
+              'encoded', 'encoded_bytes', 'encode_time')
+
+    def __init__(self):
+        # Dicts of statistics by (packet class, direction) tuples.
+        self.entries = {}
+
+    def add(self, packet_class, direction, **values):
+        """Adds values to the statistics of a packet class and direction.
+
+        """
+        key = (packet_class, direction)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = dict.fromkeys(self.fields, 0)
+        for name in values:
+            entry[name] += values[name]
+
+    def clear(self):
+        self.entries.clear()
+
+    def report(self):
+        """Returns the statistics as a list of dicts, with the name of the
+        packet class as "packet" and the direction as "direction". The list
+        is sorted by the total time spent on the packets, highest first.
+
+        """
+        directions = {TO_CLIENT: 'to_client', TO_SERVER: 'to_server'}
+        rows = []
+        for (packet_class, direction), entry in self.entries.items():
+            row = dict(entry)
+            row['packet'] = packet_class.__name__
+            row['direction'] = directions.get(direction)
+            rows.append(row)
+        rows.sort(key=lambda r: r['decode_time'] + r['encode_time'],
+                  reverse=True)
+        return rows
+
+def record_stats(stats):
+    """Starts recording statistics for all packets read by PacketReader
+    instances and written by PacketWriter instances or built with
+    Packet.build to the specified PacketStats instance. If stats is None,
+    recording stops. Returns the previous PacketStats instance, if any.
+
+    """
+    global _stats
+    previous = _stats
+    _stats = stats
+    for cls in set(_map_sc.values()) | set(_map_cs.values()):
+        _instrument_build(cls, stats is not None)
+    return previous
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""Analyzes capture files recorded by the wrapper (see autoproto.capture).
+
+The records are split into ranges that are decoded in parallel by a pool of
+processes. For every packet type and direction, the number of packets, their
+share of the bytes, the compression ratio of ZlibData fields, the
+distribution of packet sizes and the packet rate over time are reported.
+Every process only holds the statistics of the range it's working on, so
+the memory used doesn't grow with the size of the captures.
+
+Run this in the top directory:
+
+    python3 -m example.analyze.main CAPTURE [CAPTURE ...] [--jobs N]
+        [--interval SECONDS] [--output FILE]
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import time
+
+import autoproto.capture
+import autoproto.marshal.java
+import autoproto.packet
+import minecraft.marshal
+# Registers the packet classes with autoproto.packet.
+import minecraft.packet
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+_directions = {autoproto.packet.TO_CLIENT: 'to_client',
+               autoproto.packet.TO_SERVER: 'to_server'}
+
+def _new_entry():
+    return {'packets': 0, 'bytes': 0, 'compressed_bytes': 0,
+            'decompressed_bytes': 0, 'min_size': None, 'max_size': 0,
+            'sizes': {}, 'timeline': {}}
+
+def _size_bucket(size):
+    """Returns the smallest power of two that is at least size.
+
+    """
+    return 1 << (size - 1).bit_length() if size > 1 else 1
+
+def _zlib_sizes(packet):
+    """Returns the compressed and decompressed sizes of the ZlibData fields
+    of a packet.
+
+    """
+    compressed = decompressed = 0
+    for val in packet._values:
+        if isinstance(val, minecraft.marshal.ZlibData):
+            # The field writes out the data exactly as it was received.
+            prefix = len(val.length_type.bytes_from(0))
+            compressed += len(val.bytes_for(packet)) - prefix
+            decompressed += len(getattr(packet, val.name))
+    return compressed, decompressed
+
+def analyze_range(task):
+    """Decodes the records in a range of a capture file and returns the
+    statistics of the packets, by (packet name, direction) tuples. The task
+    is a (path, start, end, origin, interval) tuple, where the time of a
+    packet is counted in intervals since the origin.
+
+    """
+    path, start, end, origin, interval = task
+    capture = autoproto.capture.Capture(path)
+    offset = capture.start_time - origin
+
+    readers = {}
+    stats = {}
+    for t, direction, data in capture.records(start=start, end=end):
+        reader = readers.get(direction)
+        if reader is None:
+            reader = readers[direction] = autoproto.packet.PacketReader(
+                autoproto.marshal.java.JavaUByte, direction)
+        try:
+            packets = reader.read(data)
+        except NotImplementedError:
+            # The reader can't continue after an unknown packet.
+            del readers[direction]
+            name = 'Unknown 0x%02x' % data[0]
+            compressed = decompressed = 0
+        else:
+            packet = packets[0]
+            name = packet.__class__.__name__
+            compressed, decompressed = _zlib_sizes(packet)
+            del packets, packet
+
+        size = len(data)
+        data.release()
+
+        key = (name, _directions.get(direction))
+        entry = stats.get(key)
+        if entry is None:
+            entry = stats[key] = _new_entry()
+        entry['packets'] += 1
+        entry['bytes'] += size
+        entry['compressed_bytes'] += compressed
+        entry['decompressed_bytes'] += decompressed
+        if entry['min_size'] is None or size < entry['min_size']:
+            entry['min_size'] = size
+        if size > entry['max_size']:
+            entry['max_size'] = size
+        bucket = _size_bucket(size)
+        entry['sizes'][bucket] = entry['sizes'].get(bucket, 0) + 1
+        slot = int((offset + t) // interval)
+        entry['timeline'][slot] = entry['timeline'].get(slot, 0) + 1
+
+    del readers
+    capture.close()
+    return stats
+
+def merge(total, stats):
+    """Adds the statistics returned by analyze_range to total.
+
+    """
+    for key, entry in stats.items():
+        into = total.get(key)
+        if into is None:
+            total[key] = entry
+            continue
+        for name in ('packets', 'bytes', 'compressed_bytes',
+                     'decompressed_bytes'):
+            into[name] += entry[name]
+        into['min_size'] = min(into['min_size'], entry['min_size'])
+        into['max_size'] = max(into['max_size'], entry['max_size'])
+        for name in ('sizes', 'timeline'):
+            for k, count in entry[name].items():
+                into[name][k] = into[name].get(k, 0) + count
+
+def _percentile(sizes, fraction):
+    """Returns the size bucket that the specified fraction of the packets
+    fit in.
+
+    """
+    total = sum(sizes.values())
+    seen = 0
+    for bucket in sorted(sizes):
+        seen += sizes[bucket]
+        if seen >= total * fraction:
+            return bucket
+
+def report(total, interval):
+    """Returns the statistics as a list of dicts, sorted by the number of
+    bytes, highest first.
+
+    """
+    all_bytes = sum(entry['bytes'] for entry in total.values()) or 1
+    rows = []
+    for (name, direction), entry in total.items():
+        row = dict(entry)
+        row['packet'] = name
+        row['direction'] = direction
+        row['byte_share'] = entry['bytes'] / all_bytes
+        if entry['compressed_bytes']:
+            row['compression_ratio'] = (
+                entry['decompressed_bytes'] / entry['compressed_bytes'])
+        else:
+            row['compression_ratio'] = None
+        row['p50_size_bucket'] = _percentile(entry['sizes'], 0.5)
+        row['p99_size_bucket'] = _percentile(entry['sizes'], 0.99)
+        row['peak_packets_per_second'] = (
+            max(entry['timeline'].values()) / interval)
+        # JSON keys must be strings, and the timeline is easier to use as a
+        # list of (interval, count) pairs.
+        row['sizes'] = dict((str(k), v) for k, v in sorted(
+            entry['sizes'].items()))
+        row['timeline'] = sorted(entry['timeline'].items())
+        rows.append(row)
+    rows.sort(key=lambda r: r['bytes'], reverse=True)
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Analyzes capture files recorded by the wrapper.')
+    parser.add_argument('captures', nargs='+', metavar='CAPTURE',
+                        help='the capture files to analyze')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of processes (default: one per CPU)')
+    parser.add_argument('--interval', type=float, default=60.0,
+                        help='seconds per interval of the packet rate')
+    parser.add_argument('--range-size', type=int, default=64 * 1024 * 1024,
+                        help='bytes of records per task')
+    parser.add_argument('--output', help='file to write a JSON report to')
+    args = parser.parse_args()
+
+    tasks = []
+    origin = None
+    for path in args.captures:
+        capture = autoproto.capture.Capture(path)
+        if not capture.complete:
+            print('%s has no index (it was not closed properly)' % path)
+        if origin is None or capture.start_time < origin:
+            origin = capture.start_time
+        # The ranges are found here once, so that the processes only go
+        # through the records of their own range.
+        tasks += [(path, start, end)
+                  for start, end in capture.split(args.range_size)]
+        capture.close()
+    tasks = [task + (origin, args.interval) for task in tasks]
+
+    total = {}
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.jobs) as pool:
+        for stats in pool.imap_unordered(analyze_range, tasks):
+            merge(total, stats)
+    elapsed = time.perf_counter() - start
+    rows = report(total, args.interval)
+
+    print('%-25s%10s%10s%14s%7s%7s%9s%9s%9s' % (
+        '[Packet]', '[Dir]', '[Count]', '[Bytes]', '[%]', '[Zlib]',
+        '[p50<=]', '[p99<=]', '[Peak/s]'))
+    for row in rows:
+        ratio = row['compression_ratio']
+        print('%-25s%10s%10d%14d%7.1f%7s%9d%9d%9.1f' % (
+            row['packet'], row['direction'] or '-', row['packets'],
+            row['bytes'], row['byte_share'] * 100,
+            '%.1f' % ratio if ratio else '-', row['p50_size_bucket'],
+            row['p99_size_bucket'], row['peak_packets_per_second']))
+    print('Analyzed %d packets in %d tasks in %.2f seconds' % (
+        sum(row['packets'] for row in rows), len(tasks), elapsed))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'interval': args.interval, 'origin': origin,
+                       'results': rows}, fh, indent=1, sort_keys=True)
+            fh.write('\n')
+
+if __name__ == '__main__':
+    main()
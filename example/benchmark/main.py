@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the packet codec. Builds a representative instance of every
+packet class in minecraft.packet, then measures how fast the packets are
+built and read, and how much memory that takes. The report is printed as
+JSON.
+
+Run this in the top directory:
+
+    python3 -m example.benchmark.main [--min-time SECONDS] [PACKET ...]
+
+"""
+
+import argparse
+import gc
+import json
+import platform
+import random
+import time
+import tracemalloc
+
+import autoproto.packet
+from autoproto.marshal import Array
+from autoproto.marshal.java import *
+import minecraft.marshal
+from minecraft.marshal import *
+from minecraft.packet import *
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+# The ways that the wire data is handed to PacketReader.read: every packet
+# in its own call, many packets in one call, and a stream of packets split
+# into pieces of a fixed size.
+READ_MODES = ('whole', 'coalesced', 'fragmented_1', 'fragmented_8192')
+
+# Coalesced and fragmented reads go through at least this much data.
+STREAM_SIZE = 65536
+
+_simple_samples = {
+    JavaBool: True, JavaByte: 7, JavaDouble: 128.25, JavaFloat: 1.5,
+    JavaInt: 70000, JavaLong: 1 << 40, JavaShort: 300, JavaString: 'Notch',
+    JavaUByte: 200, JavaUShort: 40000}
+
+def _chunk_data():
+    """Returns the data of a 16x128x16 chunk with ground, ores and light."""
+    rand = random.Random(0)
+    column = bytes([1] * 60 + [3] * 3 + [2] + [0] * 64)
+    blocks = bytearray(column * 256)
+    for i in range(len(blocks)):
+        if blocks[i] == 1 and rand.random() < 0.02:
+            blocks[i] = rand.choice((14, 15, 16, 56))
+    metadata = bytes(16384)
+    block_light = bytes(rand.choice((0, 0, 0, 0x11, 0x44))
+                        for i in range(16384))
+    sky_light = (bytes(32) + b'\xff' * 32) * 256
+    return bytes(blocks) + metadata + block_light + sky_light
+
+def _sample(val):
+    """Returns a sample value for the specified Marshaler instance.
+
+    """
+    if isinstance(val, Array):
+        length = val.length_type
+        if not isinstance(length, int):
+            length = 4
+        return [_sample_of_type(val.item_type) for i in range(length)]
+    return _sample_of_type(val.__class__)
+
+def _sample_of_type(marshaler_type):
+    if marshaler_type in _simple_samples:
+        return _simple_samples[marshaler_type]
+    if issubclass(marshaler_type, BlockOffsetList):
+        return [(1, -2, 3), (0, 0, 1)]
+    if issubclass(marshaler_type, DynamicData):
+        return [DynamicField(0, 0, 1), DynamicField(1, 1, 300)]
+    if issubclass(marshaler_type, ItemData):
+        return Item(276, 1, 0)
+    if issubclass(marshaler_type, ItemList):
+        return [Item(1, 64, 0), None, Item(276, 1, 12)]
+    if issubclass(marshaler_type, RelativeBlockChangeList):
+        return [RelativeBlockChange(1, 64, 2, 4, 0)]
+    if issubclass(marshaler_type, ZlibData):
+        return _chunk_data()
+    raise TypeError('No sample value for %s' % marshaler_type.__name__)
+
+def _large_samples():
+    """Returns field values for packets that are large in practice.
+
+    """
+    rand = random.Random(1)
+    changes = [
+        RelativeBlockChange(rand.randrange(8), rand.randrange(128),
+                            rand.randrange(16), rand.randrange(96),
+                            rand.randrange(16))
+        for i in range(512)]
+    offsets = [tuple(rand.randrange(-8, 9) for j in range(3))
+               for i in range(512)]
+    items = [Item(rand.randrange(1, 300), rand.randrange(1, 65), 0)
+             if rand.random() < 0.8 else None for i in range(45)]
+    return {
+        ChunkData: dict(ubound_x=15, ubound_y=127, ubound_z=15,
+                        data=_chunk_data()),
+        Explode: dict(blocks=offsets),
+        MultiBlockChange: dict(changes=changes),
+        WindowItems: dict(items=items)}
+
+def samples():
+    """Returns a list of (packet, direction) tuples with a sample packet for
+    every packet class and direction.
+
+    """
+    large = _large_samples()
+    classes = [(cls, autoproto.packet.TO_CLIENT)
+               for cls in autoproto.packet._map_sc.values()]
+    classes += [(cls, autoproto.packet.TO_SERVER)
+                for cls in autoproto.packet._map_cs.values()]
+    result = []
+    for cls, direction in sorted(classes, key=lambda c: (c[0].__name__, c[1])):
+        kwargs = dict((val.name, _sample(val)) for val in cls._values)
+        kwargs.update(large.get(cls, {}))
+        result.append((cls(**kwargs), direction))
+    return result
+
+def _measure(run, count, min_time, repeat):
+    """Returns the best time per packet of calling run, which handles count
+    packets per call. Calls are repeated until they take at least min_time,
+    and the best of repeat such measurements is used.
+
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(loops):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2
+    best = elapsed
+    for i in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(loops):
+            run()
+        best = min(best, time.perf_counter() - start)
+    return best / (loops * count)
+
+def _allocations(run, count):
+    """Returns the peak and the retained traced memory in bytes per packet of
+    calling run once. The result of run is kept alive until the memory has
+    been measured.
+
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    result = run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return (peak - before) / count, (current - before) / count
+
+def _read_pieces(data, mode):
+    """Returns the pieces to give to PacketReader.read for the wire data of a
+    packet, and the number of packets they contain.
+
+    """
+    if mode == 'whole':
+        return [data], 1
+    count = max(1, STREAM_SIZE // len(data))
+    stream = data * count
+    if mode == 'coalesced':
+        return [stream], count
+    size = int(mode.rsplit('_', 1)[1])
+    return [stream[i:i + size] for i in range(0, len(stream), size)], count
+
+def benchmark(packet, direction, min_time, repeat, modes=READ_MODES):
+    """Returns the result rows for a packet, reading it in each of the
+    specified modes.
+
+    """
+    data = packet.build()
+    name = packet.__class__.__name__
+    directions = {autoproto.packet.TO_CLIENT: 'to_client',
+                  autoproto.packet.TO_SERVER: 'to_server'}
+    rows = []
+
+    def row(operation, seconds, memory):
+        rows.append({
+            'packet': name,
+            'direction': directions[direction],
+            'operation': operation,
+            'wire_bytes': len(data),
+            'packets_per_second': 1 / seconds,
+            'megabytes_per_second': len(data) / seconds / 1e6,
+            'peak_bytes_per_packet': memory[0],
+            'retained_bytes_per_packet': memory[1]})
+
+    row('build', _measure(packet.build, 1, min_time, repeat),
+        _allocations(packet.build, 1))
+
+    for mode in modes:
+        pieces, count = _read_pieces(data, mode)
+        reader = autoproto.packet.PacketReader(JavaUByte, direction)
+
+        def read():
+            packets = []
+            for piece in pieces:
+                packets += reader.read(piece)
+            return packets
+
+        read_packets = read()
+        assert len(read_packets) == count, \
+            'Read %d %s packets, expected %d' % (len(read_packets), name,
+                                                 count)
+        row('read_' + mode, _measure(read, count, min_time, repeat),
+            _allocations(read, count))
+
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks building and reading every packet type.')
+    parser.add_argument('packets', nargs='*', metavar='PACKET',
+                        help='names of the packet classes to benchmark '
+                             '(default: all)')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='minimum duration of a measurement in seconds')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of measurements to take the best of')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the ZlibData compression cache enabled')
+    parser.add_argument('--output', help='file to write the report to')
+    args = parser.parse_args()
+
+    if not args.cache:
+        # Measure the cost of compressing every chunk.
+        ZlibData.cache = None
+
+    results = []
+    for packet, direction in samples():
+        if args.packets and packet.__class__.__name__ not in args.packets:
+            continue
+        results += benchmark(packet, direction, args.min_time, args.repeat)
+
+    report = {
+        'implementation': platform.python_implementation(),
+        'min_time': args.min_time,
+        'numpy': minecraft.marshal.numpy is not None,
+        'python': platform.python_version(),
+        'repeat': args.repeat,
+        'results': results}
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
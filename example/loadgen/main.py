@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+"""Load generator that connects simulated players to a server (or wrapper).
+
+Every bot logs in with Handshake and LogIn, reads everything the server
+sends, and once the server has placed the player with the first
+MoveAndLookCorrection it keeps sending MoveAndLook, ChatMessage and Dig
+packets at the configured rates. The login latency is measured up to that
+correction. All the bots run on a single asyncore loop. Chat messages
+carry a token that is looked for in the chat messages broadcast back by the
+server, which gives the round-trip time of the server.
+
+The report is printed as JSON, with percentiles of the login latency, the
+chat round-trip time and the packets sent and received per second. If the
+process id of the server is given, its CPU usage and resident memory are
+sampled as well (this requires /proc).
+
+Run this in the top directory:
+
+    python3 -m example.loadgen.main [--bots N] [--duration SECONDS]
+        [--connect HOST:PORT] [--server-pid PID]
+
+"""
+
+import argparse
+import asyncore
+import heapq
+import json
+import math
+import os
+import random
+import socket
+import time
+
+import autoproto.marshal.java
+import autoproto.packet
+from minecraft.packet import *
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+# The packets that bots look at. All other packets are skipped over without
+# being decoded.
+_decoded = (ChatMessage, Disconnect, HandshakeResponse,
+            MoveAndLookCorrection)
+
+def percentiles(values):
+    """Returns the 50th, 90th and 99th percentiles and the maximum of a list
+    of values, or None if the list is empty.
+
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    result = {'max': values[-1], 'count': len(values)}
+    for p in (50, 90, 99):
+        result['p%d' % p] = values[min(len(values) - 1,
+                                       int(math.ceil(len(values) * p / 100.0))
+                                       - 1)]
+    return result
+
+class ProcessSampler(object):
+    """Samples the CPU time and the resident memory of a process from /proc.
+
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.cpu = []
+        self.rss = []
+        self._ticks = os.sysconf('SC_CLK_TCK')
+        self._last = self._cpu_time(), time.perf_counter()
+
+    def _cpu_time(self):
+        with open('/proc/%d/stat' % self.pid) as fh:
+            # The command name may contain spaces, so split after it.
+            fields = fh.read().rsplit(')', 1)[1].split()
+        # The user and system time are the 14th and 15th fields.
+        return (int(fields[11]) + int(fields[12])) / self._ticks
+
+    def _rss(self):
+        with open('/proc/%d/status' % self.pid) as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+
+    def sample(self):
+        cpu, now = self._cpu_time(), time.perf_counter()
+        last_cpu, last_now = self._last
+        self.cpu.append((cpu - last_cpu) / (now - last_now))
+        self.rss.append(self._rss())
+        self._last = cpu, now
+
+class Bot(asyncore.dispatcher):
+    """A simulated player.
+
+    """
+    def __init__(self, index, address, load):
+        self.index = index
+        self.load = load
+        self.username = 'bot%d' % index
+        self.reader = autoproto.packet.PacketReader(
+            autoproto.marshal.java.JavaUByte, autoproto.packet.TO_CLIENT,
+            decode=_decoded, **load.limits)
+        self.writer = autoproto.packet.PacketWriter()
+        self.playing = False
+        self.finished = False
+        # Send times of the chat messages that haven't come back yet, by the
+        # token in the message.
+        self.pending_chat = {}
+        self._chat_sequence = 0
+        self._angle = random.random() * 2 * math.pi
+
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.started = time.perf_counter()
+        self.connect(address)
+
+    def send_packet(self, packet):
+        self.writer.write(packet)
+        self.load.sent += 1
+
+    def act(self, action):
+        """Sends a packet of the specified kind ('move', 'chat' or 'dig').
+
+        """
+        if action == 'move':
+            self._angle += 0.1
+            x = 128.0 + math.cos(self._angle) * 4
+            z = 128.0 + math.sin(self._angle) * 4
+            self.send_packet(MoveAndLook(
+                x=x, y=80.0, stance=81.62, z=z,
+                yaw=math.degrees(self._angle) % 360, pitch=0.0,
+                on_ground=False))
+        elif action == 'chat':
+            self._chat_sequence += 1
+            token = 'rtt-%d-%d' % (self.index, self._chat_sequence)
+            self.pending_chat[token] = time.perf_counter()
+            self.send_packet(ChatMessage(message=token))
+        elif action == 'dig':
+            self.send_packet(Dig(
+                status=Dig.STARTED_DIGGING, x=random.randrange(120, 136),
+                y=63, z=random.randrange(120, 136), face=1))
+
+    def handle_close(self):
+        if not self.finished:
+            self.finished = True
+            self.load.disconnected += 1
+        self.close()
+
+    def handle_connect(self):
+        self.send_packet(Handshake(username=self.username))
+
+    def handle_read(self):
+        try:
+            packets = self.reader.recv_into(self.socket)
+        except OSError as why:
+            if why.args[0] not in asyncore._DISCONNECTED:
+                raise
+            packets = None
+
+        if packets is None:
+            self.handle_close()
+            return
+
+        load = self.load
+        load.received += len(packets)
+        for packet in packets:
+            if isinstance(packet, autoproto.packet.Frame):
+                continue
+            if isinstance(packet, ChatMessage):
+                i = packet.message.find('rtt-')
+                if i < 0:
+                    continue
+                sent = self.pending_chat.pop(packet.message[i:], None)
+                if sent is not None:
+                    load.chat_rtt.append(time.perf_counter() - sent)
+            elif isinstance(packet, HandshakeResponse):
+                self.send_packet(LogIn(protocol_version=9,
+                                       username=self.username, password=''))
+            elif isinstance(packet, MoveAndLookCorrection):
+                # Like a real client, only start moving once the server has
+                # said where the player is.
+                if self.playing:
+                    continue
+                load.logins.append(time.perf_counter() - self.started)
+                self.playing = True
+                load.start_playing(self)
+            elif isinstance(packet, Disconnect):
+                print('%s was disconnected: %s' % (self.username,
+                                                   packet.reason))
+                self.handle_close()
+                return
+
+    def handle_write(self):
+        try:
+            self.writer.flush(self.socket)
+        except OSError as why:
+            if why.args[0] not in asyncore._DISCONNECTED:
+                raise
+            self.handle_close()
+
+    def writable(self):
+        return not self.connected or self.writer.pending > 0
+
+class LoadGenerator(object):
+    """Runs a number of bots against a server and collects their results.
+
+    """
+    # Limits for the data read from the server. See PacketReader.
+    limits = dict(max_pending=4 * 1024 * 1024)
+
+    def __init__(self, address, bots, rates, ramp=1.0, server_pid=None):
+        """Sets up a load generator for the server at the specified address.
+        The bots are connected evenly over ramp seconds, and rates is a dict
+        of the number of times per second that every bot sends each kind of
+        packet (see Bot.act).
+
+        """
+        self.address = address
+        self.count = bots
+        self.rates = rates
+        self.ramp = ramp
+        self.sampler = ProcessSampler(server_pid) if server_pid else None
+
+        self.bots = []
+        self.chat_rtt = []
+        self.logins = []
+        self.disconnected = 0
+        self.received = 0
+        self.sent = 0
+        # Samples of the packets sent and received per second.
+        self.received_rates = []
+        self.sent_rates = []
+        # A heap of (time, sequence, bot, action) tuples.
+        self._actions = []
+        self._sequence = 0
+
+    def _schedule(self, when, bot, action):
+        self._sequence += 1
+        heapq.heappush(self._actions, (when, self._sequence, bot, action))
+
+    def start_playing(self, bot):
+        """Schedules the first packets of a bot that has logged in, at a
+        random point of their intervals so that the bots don't all send at
+        once.
+
+        """
+        now = time.perf_counter()
+        for action, rate in self.rates.items():
+            if rate > 0:
+                self._schedule(now + random.random() / rate, bot, action)
+
+    def run(self, duration):
+        """Connects the bots and runs the event loop for duration seconds.
+
+        """
+        start = time.perf_counter()
+        end = start + duration
+        next_sample = start + 1.0
+        last_sent = last_received = 0
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+
+            # Connect the bots that are due.
+            due = self.count
+            if self.ramp > 0:
+                due = min(due, int((now - start) / self.ramp * self.count) + 1)
+            while len(self.bots) < due:
+                self.bots.append(Bot(len(self.bots), self.address, self))
+
+            # Send the packets that are due.
+            actions = self._actions
+            while actions and actions[0][0] <= now:
+                when, sequence, bot, action = heapq.heappop(actions)
+                if bot.finished:
+                    continue
+                bot.act(action)
+                self._schedule(when + 1.0 / self.rates[action], bot, action)
+
+            if now >= next_sample:
+                self.sent_rates.append(self.sent - last_sent)
+                self.received_rates.append(self.received - last_received)
+                last_sent, last_received = self.sent, self.received
+                if self.sampler:
+                    self.sampler.sample()
+                next_sample += 1.0
+
+            timeout = 0.01
+            if actions:
+                timeout = max(0.0, min(timeout, actions[0][0] - now))
+            asyncore.loop(timeout, count=1)
+
+        for bot in self.bots:
+            if bot.connected and not bot.finished:
+                bot.send_packet(Disconnect(reason='Quitting'))
+                try:
+                    bot.writer.flush(bot.socket)
+                except OSError:
+                    pass
+            bot.finished = True
+            bot.close()
+
+    def report(self):
+        """Returns the results as a dict.
+
+        """
+        result = {
+            'bots': self.count,
+            'chat_rtt_seconds': percentiles(self.chat_rtt),
+            'disconnected': self.disconnected,
+            'logged_in': len(self.logins),
+            'login_seconds': percentiles(self.logins),
+            'rates': self.rates,
+            'received_packets': self.received,
+            'received_packets_per_second': percentiles(self.received_rates),
+            'sent_packets': self.sent,
+            'sent_packets_per_second': percentiles(self.sent_rates)}
+        if self.sampler:
+            result['server_cpu'] = percentiles(self.sampler.cpu)
+            result['server_rss_bytes'] = percentiles(self.sampler.rss)
+        return result
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Connects simulated players to a server.')
+    parser.add_argument('--connect', metavar='HOST:PORT',
+                        default='localhost:25565',
+                        help='the server or wrapper to connect to')
+    parser.add_argument('--bots', type=int, default=10,
+                        help='number of bots')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='seconds to run for')
+    parser.add_argument('--ramp', type=float, default=5.0,
+                        help='seconds over which the bots connect')
+    parser.add_argument('--move-rate', type=float, default=20.0,
+                        help='MoveAndLook packets per second per bot')
+    parser.add_argument('--chat-rate', type=float, default=0.2,
+                        help='ChatMessage packets per second per bot')
+    parser.add_argument('--dig-rate', type=float, default=1.0,
+                        help='Dig packets per second per bot')
+    parser.add_argument('--server-pid', type=int,
+                        help='process id of the server to sample')
+    parser.add_argument('--output', help='file to write the report to')
+    args = parser.parse_args()
+
+    host, port = args.connect.rsplit(':', 1)
+    rates = {'chat': args.chat_rate, 'dig': args.dig_rate,
+             'move': args.move_rate}
+    load = LoadGenerator((host, int(port)), args.bots, rates, args.ramp,
+                         args.server_pid)
+    load.run(args.duration)
+
+    text = json.dumps(load.report(), indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""Checks the performance of the codec and the proxy against a baseline.
+
+The codec benchmark (example.benchmark) and the proxy benchmark
+(example.proxybench) are run several times, and every metric is summarized
+as the median and the median absolute deviation of the runs. The record
+command stores the summary as the baseline. The compare command runs the
+benchmarks again and flags every metric that got worse than the baseline by
+more than the threshold, unless the difference is within the noise of the
+runs. It exits with status 1 if any metric got worse, and with status 2 if
+there is no baseline yet.
+
+Baselines are only comparable between runs on the same machine, so no
+baseline comes with the repository. Run the record command first (and
+commit the baseline file if the checks always run on the same machine).
+
+Run this in the top directory:
+
+    python3 -m example.perfgate.main record [--runs N]
+    python3 -m example.perfgate.main compare [--runs N] [--threshold 0.1]
+
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+
+from example.benchmark import main as codec
+from example.proxybench import main as proxybench
+import minecraft.marshal
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# The packets and read modes of the codec benchmark that are checked.
+PACKETS = ('ChatMessage', 'ChunkData', 'MoveAndLook', 'MultiBlockChange',
+           'WindowItems')
+READ_MODES = ('whole', 'coalesced', 'fragmented_8192')
+
+# The traffic mixes of the proxy benchmark that are checked.
+MIXES = ('chunk', 'movement')
+
+# The factor that turns a median absolute deviation into an estimate of the
+# standard deviation of normally distributed values.
+_MAD_SCALE = 1.4826
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def collect(packets=PACKETS, mixes=MIXES, min_time=0.05, duration=2.0):
+    """Runs the benchmarks once and returns a dict of (value, better) tuples
+    by metric name, where better is 'higher' or 'lower'.
+
+    """
+    metrics = {}
+
+    # Measure the cost of compressing every chunk, like example.benchmark.
+    cache = minecraft.marshal.ZlibData.cache
+    minecraft.marshal.ZlibData.cache = None
+    try:
+        for packet, direction in codec.samples():
+            if packet.__class__.__name__ not in packets:
+                continue
+            for row in codec.benchmark(packet, direction, min_time, 3,
+                                       READ_MODES):
+                name = 'codec/%s/%s/%s/' % (row['packet'], row['direction'],
+                                            row['operation'])
+                if row['operation'] == 'build':
+                    metrics[name + 'ns_per_packet'] = (
+                        1e9 / row['packets_per_second'], 'lower')
+                else:
+                    metrics[name + 'megabytes_per_second'] = (
+                        row['megabytes_per_second'], 'higher')
+                metrics[name + 'peak_bytes_per_packet'] = (
+                    row['peak_bytes_per_packet'], 'lower')
+    finally:
+        minecraft.marshal.ZlibData.cache = cache
+
+    for mix in mixes:
+        report = proxybench.measure(mix, duration=duration)['proxy']
+        name = 'proxy/%s/' % mix
+        metrics[name + 'aggregate_packets_per_second'] = (
+            report['aggregate_packets_per_second'], 'higher')
+        for direction, latency in report['latency_seconds'].items():
+            if latency:
+                metrics[name + '%s/p99_latency_seconds' % direction] = (
+                    latency['p99'], 'lower')
+
+    return metrics
+
+def summarize(runs):
+    """Summarizes the results of several calls to collect as a dict of
+    metrics, with the median and the median absolute deviation of each.
+
+    """
+    summary = {}
+    for name in sorted(set().union(*runs)):
+        samples = [run[name][0] for run in runs if name in run]
+        median = _median(samples)
+        summary[name] = {
+            'better': runs[0][name][1],
+            'mad': _median([abs(value - median) for value in samples]),
+            'median': median,
+            'samples': samples}
+    return summary
+
+def compare(baseline, current, threshold, latency_threshold, noise):
+    """Compares two summaries of metrics. Returns a list of dicts with the
+    name, the baseline and current medians, the relative change (positive
+    when the metric got worse) and the status of every metric.
+
+    A metric is "slower" or "faster" when it changed by more than the
+    threshold, and the change is more than noise times the estimated
+    standard deviation of the difference. A change that is larger than the
+    threshold but within the noise is "noisy".
+
+    """
+    rows = []
+    for name in sorted(current):
+        metric = current[name]
+        if name not in baseline:
+            rows.append({'name': name, 'baseline': None,
+                         'current': metric['median'], 'change': None,
+                         'status': 'new'})
+            continue
+        base = baseline[name]
+        difference = metric['median'] - base['median']
+        if metric['better'] == 'higher':
+            difference = -difference
+        if base['median']:
+            change = difference / abs(base['median'])
+        else:
+            change = 0.0 if not difference else math.copysign(1e9, difference)
+
+        limit = threshold
+        if name.endswith('latency_seconds'):
+            limit = latency_threshold
+        spread = _MAD_SCALE * math.hypot(base['mad'], metric['mad'])
+        if abs(change) <= limit:
+            status = 'ok'
+        elif abs(difference) <= noise * spread:
+            status = 'noisy'
+        elif change > 0:
+            status = 'slower'
+        else:
+            status = 'faster'
+        rows.append({'name': name, 'baseline': base['median'],
+                     'current': metric['median'], 'change': change,
+                     'status': status})
+    return rows
+
+def _run(args):
+    runs = []
+    for i in range(args.runs):
+        print('Run %d of %d...' % (i + 1, args.runs), file=sys.stderr)
+        runs.append(collect(min_time=args.min_time, duration=args.duration))
+    return summarize(runs)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Checks the performance of the codec and the proxy '
+                    'against a baseline.')
+    parser.add_argument('command', choices=('compare', 'record'))
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help='the baseline file')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='number of times to run the benchmarks')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='minimum duration of a codec measurement')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='seconds per phase of the proxy benchmark')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change that counts as a regression')
+    parser.add_argument('--latency-threshold', type=float, default=0.25,
+                        help='relative change of latencies that counts as a '
+                             'regression')
+    parser.add_argument('--noise', type=float, default=3.0,
+                        help='number of standard deviations that a change '
+                             'must exceed')
+    parser.add_argument('--output', help='file to write the comparison to')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        baseline = {
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'metrics': _run(args),
+            'python': platform.python_version(),
+            'runs': args.runs}
+        with open(args.baseline, 'w') as fh:
+            json.dump(baseline, fh, indent=1, sort_keys=True)
+            fh.write('\n')
+        print('Recorded %d metrics to %s' % (len(baseline['metrics']),
+                                             args.baseline))
+        return
+
+    try:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+    except FileNotFoundError:
+        print('There is no baseline at %s. Run the record command first.' % (
+            args.baseline), file=sys.stderr)
+        sys.exit(2)
+    if baseline['python'] != platform.python_version():
+        print('Warning: the baseline was recorded with Python %s' % (
+            baseline['python']))
+    rows = compare(baseline['metrics'], _run(args), args.threshold,
+                   args.latency_threshold, args.noise)
+
+    for row in rows:
+        if row['status'] == 'new':
+            print('%-8s%s' % ('new', row['name']))
+            continue
+        print('%-8s%+8.1f%%  %s' % (row['status'], row['change'] * 100,
+                                    row['name']))
+    slower = [row for row in rows if row['status'] == 'slower']
+    print('%d of %d metrics got worse' % (len(slower), len(rows)))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(rows, fh, indent=1, sort_keys=True)
+            fh.write('\n')
+    if slower:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
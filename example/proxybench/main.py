@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+"""Measures the latency and throughput that MinecraftForwarder adds.
+
+Fake clients and a fake upstream server exchange numbered packets, either
+directly or through a MinecraftForwarder that runs in a process of its own,
+all on loopback. Both ends note the time every packet is sent and received,
+which gives the latency of every packet. The latency added by the proxy is
+the difference between the two runs.
+
+Every run has two phases. First both ends of every connection send packets
+at a fixed rate to measure the latency, then they send as fast as they can
+(with a limited number of packets in flight) to measure the throughput.
+
+Run this in the top directory:
+
+    python3 -m example.proxybench.main [--mix movement|chunk|chat]
+        [--connections N] [--rate PACKETS] [--duration SECONDS]
+
+"""
+
+import argparse
+import asyncore
+import json
+import multiprocessing
+import random
+import socket
+import time
+
+import autoproto.marshal.java
+import autoproto.packet
+from autoproto.packet import TO_CLIENT, TO_SERVER
+from example.loadgen.main import percentiles
+from example.wrapper.proxy import MinecraftForwarder
+from minecraft.marshal import ZlibData
+from minecraft.packet import *
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+# The kinds of packets that each end sends in a traffic mix, with their
+# weights.
+MIXES = {
+    'chat': {TO_CLIENT: [('chat', 1)], TO_SERVER: [('chat', 1)]},
+    'chunk': {TO_CLIENT: [('chunk', 1)], TO_SERVER: [('move', 1)]},
+    'movement': {TO_CLIENT: [('teleport', 1)], TO_SERVER: [('move', 1)]}}
+
+_directions = {TO_CLIENT: 'to_client', TO_SERVER: 'to_server'}
+
+def _chunk_data():
+    rand = random.Random(0)
+    blocks = bytes(rand.choice((0, 0, 1, 1, 1, 2, 3, 14))
+                   for i in range(32768))
+    return blocks + bytes(16384) + b'\xff' * 32768
+
+class _Packets(object):
+    """Creates numbered packets and gets the numbers back out of them.
+
+    """
+    def __init__(self):
+        # Compress the chunk once, since every ChunkData has the same data.
+        self.chunk = ZlibData.compress_many([_chunk_data()])[0]
+
+    def make(self, kind, number):
+        if kind == 'chat':
+            return ChatMessage(message='%d' % number)
+        if kind == 'chunk':
+            return ChunkData(x=number, y=0, z=0, ubound_x=15, ubound_y=127,
+                             ubound_z=15, data=self.chunk)
+        if kind == 'move':
+            return MoveAndLook(x=float(number), y=64.0, stance=65.62, z=0.0,
+                               yaw=0.0, pitch=0.0, on_ground=True)
+        if kind == 'teleport':
+            return TeleportEntity(entity_id=number, x=0, y=2048, z=0, yaw=0,
+                                  pitch=0)
+        raise ValueError('Unknown packet kind %r' % kind)
+
+    @staticmethod
+    def number(packet):
+        if isinstance(packet, ChatMessage):
+            return int(packet.message)
+        if isinstance(packet, ChunkData):
+            return packet.x
+        if isinstance(packet, MoveAndLook):
+            return int(packet.x)
+        if isinstance(packet, TeleportEntity):
+            return packet.entity_id
+
+# The packets that the ends decode. All other packets are skipped over.
+_decoded = (ChatMessage, ChunkData, Handshake, MoveAndLook, TeleportEntity)
+
+class Endpoint(asyncore.dispatcher):
+    """One end of a connection, which sends packets of the kinds given by
+    the traffic mix and notes the time it takes for the packets of the other
+    end to arrive.
+
+    """
+    def __init__(self, bench, sock, direction):
+        """Sets up an end that receives packets of the specified direction.
+        If sock is None, the end is a client that connects to the address
+        of the bench.
+
+        """
+        self.bench = bench
+        self.direction = direction
+        if direction == TO_CLIENT:
+            self.kinds = bench.mix[TO_SERVER]
+        else:
+            self.kinds = bench.mix[TO_CLIENT]
+        self.reader = autoproto.packet.PacketReader(
+            autoproto.marshal.java.JavaUByte, direction, decode=_decoded)
+        self.writer = autoproto.packet.PacketWriter()
+        self.peer = None
+        self.sent = 0
+        self.received = 0
+
+        if sock:
+            asyncore.dispatcher.__init__(self, sock)
+        else:
+            self.index = len(bench.clients)
+            asyncore.dispatcher.__init__(self)
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect(bench.address)
+
+    def pump(self, target=None, window=None):
+        """Sends packets until target packets have been sent, or until window
+        packets are waiting to be received by the other end.
+
+        """
+        if self.peer is None:
+            return
+        bench = self.bench
+        while True:
+            if target is not None and self.sent >= target:
+                break
+            if window is not None and \
+                    self.sent - self.peer.received >= window:
+                break
+            kind = random.choice(self.kinds)[0]
+            bench.number += 1
+            packet = bench.packets.make(kind, bench.number)
+            bench.sent_at[bench.number] = time.perf_counter()
+            self.writer.write(packet)
+            self.sent += 1
+
+    def handle_connect(self):
+        # Tell the other end which connection this is.
+        self.writer.write(Handshake(username='%d' % self.index))
+
+    def handle_read(self):
+        try:
+            packets = self.reader.recv_into(self.socket)
+        except OSError as why:
+            if why.args[0] not in asyncore._DISCONNECTED:
+                raise
+            packets = None
+
+        if packets is None:
+            self.close()
+            return
+
+        now = time.perf_counter()
+        bench = self.bench
+        latencies = bench.latencies[self.direction]
+        for packet in packets:
+            if isinstance(packet, Handshake):
+                self.peer = bench.clients[int(packet.username)]
+                self.peer.peer = self
+                continue
+            sent = bench.sent_at.pop(_Packets.number(packet), None)
+            if sent is not None:
+                latencies.append(now - sent)
+            self.received += 1
+
+    def handle_write(self):
+        try:
+            self.writer.flush(self.socket)
+        except OSError as why:
+            if why.args[0] not in asyncore._DISCONNECTED:
+                raise
+            self.close()
+
+    def writable(self):
+        return not self.connected or self.writer.pending > 0
+
+class FakeUpstream(asyncore.dispatcher):
+    """A server that answers every connection with an Endpoint.
+
+    """
+    def __init__(self, bench):
+        self.bench = bench
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('127.0.0.1', 0))
+        self.listen(128)
+        self.address = self.socket.getsockname()
+
+    def handle_accept(self):
+        sock, address = self.accept()
+        self.bench.upstreams.append(Endpoint(self.bench, sock, TO_SERVER))
+
+def _run_forwarder(listen, forward_to, ready):
+    MinecraftForwarder(listen, forward_to)
+    ready.set()
+    asyncore.loop(0.01)
+
+class ProxyBench(object):
+    def __init__(self, mix, connections):
+        self.mix = MIXES[mix]
+        self.connections = connections
+        self.packets = _Packets()
+        self.upstream = FakeUpstream(self)
+        self.address = None
+        self.clients = []
+        self.upstreams = []
+        self.number = 0
+        self.sent_at = {}
+        self.latencies = {TO_CLIENT: [], TO_SERVER: []}
+
+    def _loop(self, seconds, until=None, rate=None, window=None):
+        """Runs the event loop for the specified number of seconds, or until
+        until returns True. If rate or window is specified, the ends send
+        packets at that rate, or with that many packets in flight.
+
+        """
+        start = time.perf_counter()
+        end = start + seconds
+        while True:
+            now = time.perf_counter()
+            if now >= end or (until and until()):
+                break
+            for endpoint in self.clients + self.upstreams:
+                if rate is not None:
+                    endpoint.pump(target=int((now - start) * rate))
+                elif window is not None:
+                    endpoint.pump(window=window)
+            asyncore.loop(0.001, count=1)
+
+    def _delivered(self):
+        return all(e.peer is not None and e.sent == e.peer.received
+                   for e in self.clients + self.upstreams)
+
+    def run(self, address, rate, window, duration):
+        """Runs both phases against the specified address, which is either
+        the fake upstream or a proxy in front of it. Returns the results.
+
+        """
+        self.address = address
+        self.clients = []
+        self.upstreams = []
+        for i in range(self.connections):
+            self.clients.append(Endpoint(self, None, TO_CLIENT))
+        self._loop(5.0, lambda: all(e.peer for e in self.clients))
+        if not all(e.peer for e in self.clients):
+            raise RuntimeError('Not all connections were set up')
+
+        # Measure the latency at a fixed rate.
+        self.sent_at.clear()
+        for latencies in self.latencies.values():
+            del latencies[:]
+        self._loop(duration, rate=rate)
+        self._loop(5.0, self._delivered)
+        latency = dict((_directions[d], percentiles(values))
+                       for d, values in self.latencies.items())
+
+        # Measure the throughput with as many packets in flight as allowed.
+        endpoints = self.clients + self.upstreams
+        before = [e.received for e in endpoints]
+        start = time.perf_counter()
+        self._loop(duration, window=window)
+        elapsed = time.perf_counter() - start
+        per_connection = []
+        for client in self.clients:
+            i = endpoints.index(client)
+            j = endpoints.index(client.peer)
+            per_connection.append(
+                (client.received - before[i] + client.peer.received -
+                 before[j]) / elapsed)
+        self._loop(5.0, self._delivered)
+
+        for endpoint in endpoints:
+            endpoint.close()
+        return {
+            'latency_seconds': latency,
+            'aggregate_packets_per_second': sum(per_connection),
+            'connection_packets_per_second': percentiles(per_connection)}
+
+def measure(mix, connections=4, rate=200.0, window=256, duration=5.0):
+    """Runs the fake ends directly and through a proxy, and returns a report
+    of the results as a dict.
+
+    """
+    bench = ProxyBench(mix, connections)
+
+    # Run the proxy in a process of its own, so that it doesn't share the
+    # event loop (or the CPU time) of the fake ends. The process is spawned
+    # rather than forked, so that it doesn't inherit the sockets of the fake
+    # upstream.
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    proxy_address = probe.getsockname()
+    probe.close()
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    proxy = context.Process(
+        target=_run_forwarder,
+        args=(proxy_address, bench.upstream.address, ready))
+    proxy.daemon = True
+    proxy.start()
+    ready.wait(10)
+
+    try:
+        direct = bench.run(bench.upstream.address, rate, window, duration)
+        proxied = bench.run(proxy_address, rate, window, duration)
+    finally:
+        proxy.terminate()
+        proxy.join()
+        bench.upstream.close()
+
+    added = {}
+    for direction, latency in proxied['latency_seconds'].items():
+        baseline = direct['latency_seconds'][direction]
+        if latency and baseline:
+            added[direction] = dict((name, latency[name] - baseline[name])
+                                    for name in ('p50', 'p99', 'max'))
+    return {
+        'added_latency_seconds': added,
+        'connections': connections,
+        'direct': direct,
+        'duration': duration,
+        'mix': mix,
+        'proxy': proxied,
+        'rate': rate,
+        'window': window}
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures the latency and throughput that the proxy '
+                    'adds.')
+    parser.add_argument('--mix', choices=sorted(MIXES), default='movement',
+                        help='the kinds of packets to send')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='number of connections')
+    parser.add_argument('--rate', type=float, default=200.0,
+                        help='packets per second that each end sends while '
+                             'the latency is measured')
+    parser.add_argument('--window', type=int, default=256,
+                        help='packets in flight per end while the throughput '
+                             'is measured')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds per phase')
+    parser.add_argument('--output', help='file to write the report to')
+    args = parser.parse_args()
+
+    report = measure(args.mix, args.connections, args.rate, args.window,
+                     args.duration)
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""Replays a capture file recorded by the wrapper (see autoproto.capture).
+
+Without --connect, every packet in the capture is read back with a
+PacketReader for its direction, and the number of packets and the time it
+took are printed. With --connect, the client->server packets are sent to a
+running server (or wrapper) at the times they were recorded, while the
+packets that it sends back are read and counted.
+
+Run this in the top directory:
+
+    python3 -m example.replay.main CAPTURE [--connect HOST:PORT]
+        [--speed FACTOR]
+
+"""
+
+import argparse
+import asyncore
+import socket
+import time
+
+import autoproto.capture
+import autoproto.marshal.java
+import autoproto.packet
+# Registers the packet classes with autoproto.packet.
+import minecraft.packet
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+def decode(capture, direction=None):
+    """Reads every packet in the capture with a PacketReader. Returns a dict
+    of packet counts by packet class name, and the time taken.
+
+    """
+    readers = {}
+    for d in (autoproto.packet.TO_CLIENT, autoproto.packet.TO_SERVER):
+        readers[d] = autoproto.packet.PacketReader(
+            autoproto.marshal.java.JavaUByte, d)
+
+    counts = {}
+    start = time.perf_counter()
+    for t, d, data in capture.records(direction):
+        for packet in readers[d].read(data):
+            name = packet.__class__.__name__
+            counts[name] = counts.get(name, 0) + 1
+        data.release()
+    return counts, time.perf_counter() - start
+
+class ReplayClient(asyncore.dispatcher):
+    """Connects to a server and sends the client->server packets of a capture
+    at the times they were recorded, divided by speed. If speed is 0, the
+    packets are sent as fast as possible.
+
+    """
+    def __init__(self, address, capture, speed=1.0):
+        self.records = capture.records(autoproto.packet.TO_SERVER)
+        self.speed = speed
+        self.reader = autoproto.packet.PacketReader(
+            autoproto.marshal.java.JavaUByte, autoproto.packet.TO_CLIENT,
+            decode=())
+        self.writer = autoproto.packet.PacketWriter()
+        self.sent = 0
+        self.received = 0
+        self.finished = False
+        self._next = next(self.records, None)
+
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+        self.start = time.perf_counter()
+
+    def send_due(self):
+        """Queues all the packets that are due to be sent. Returns the number
+        of seconds until the next packet is due, or None if all the packets
+        have been queued.
+
+        """
+        elapsed = time.perf_counter() - self.start
+        while self._next is not None:
+            t, direction, data = self._next
+            if self.speed:
+                delay = t / self.speed - elapsed
+                if delay > 0:
+                    return delay
+            self.writer.write_bytes(data)
+            self.sent += 1
+            self._next = next(self.records, None)
+        return None
+
+    def handle_close(self):
+        self.finished = True
+        self.close()
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        try:
+            packets = self.reader.recv_into(self.socket)
+        except OSError as why:
+            if why.args[0] not in asyncore._DISCONNECTED:
+                raise
+            packets = None
+
+        if packets is None:
+            self.handle_close()
+            return
+        self.received += len(packets)
+
+    def handle_write(self):
+        try:
+            self.writer.flush(self.socket)
+        except OSError as why:
+            if why.args[0] not in asyncore._DISCONNECTED:
+                raise
+            self.handle_close()
+
+    def writable(self):
+        return not self.connected or self.writer.pending > 0
+
+def replay(address, capture, speed, linger):
+    """Replays the capture against the server at the specified address, then
+    keeps reading from the server for linger seconds.
+
+    """
+    client = ReplayClient(address, capture, speed)
+    while not client.finished:
+        delay = client.send_due()
+        if delay is None and not client.writer.pending:
+            break
+        timeout = 0.05 if delay is None else min(delay, 0.05)
+        asyncore.loop(timeout, count=1)
+
+    end = time.perf_counter() + linger
+    while not client.finished and time.perf_counter() < end:
+        asyncore.loop(0.05, count=1)
+    if not client.finished:
+        client.handle_close()
+    return client
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays a capture file recorded by the wrapper.')
+    parser.add_argument('capture', help='the capture file to replay')
+    parser.add_argument('--connect', metavar='HOST:PORT',
+                        help='send the client packets to this server')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed, where 0 is as fast as possible')
+    parser.add_argument('--linger', type=float, default=1.0,
+                        help='seconds to keep reading after the last packet')
+    args = parser.parse_args()
+
+    capture = autoproto.capture.Capture(args.capture)
+    if not capture.complete:
+        print('Capture has no index (it was not closed properly)')
+    print('%d packets recorded over %.1f seconds' % (
+        len(capture), capture.duration))
+
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        start = time.perf_counter()
+        client = replay((host, int(port)), capture, args.speed, args.linger)
+        print('Sent %d packets, received %d packets in %.2f seconds' % (
+            client.sent, client.received, time.perf_counter() - start))
+    else:
+        counts, elapsed = decode(capture)
+        for name in sorted(counts):
+            print('%-25s%10d' % (name, counts[name]))
+        print('Read %d packets in %.3f seconds' % (
+            sum(counts.values()), elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,13 @@ class Vector:
         self.y = y
         self.z = z
 
+def packed_angle(degrees):
+    """Returns an angle in degrees as the signed byte that packets use, where
+    256 steps make a full turn.
+
+    """
+    return (int(degrees * 256 / 360) + 128) % 256 - 128
+
 class BaseEntity(object):
     """An entity in the world. Entities are objects that can move around freely
     in the world.
@@ -40,10 +47,27 @@ class BaseEntity(object):
         self.vel = Vector()
         self.yaw = 0.0
         self.pitch = 0.0
+        self._teleport = None
 
     def get_packet(self):
         raise NotImplemented()
 
+    def get_teleport_frame(self):
+        """Returns a frame that moves the entity to its current position. The
+        frame is shared by all clients until the entity moves.
+
+        """
+        position = (int(self.pos.x * 32), int(self.pos.y * 32),
+                    int(self.pos.z * 32), packed_angle(self.yaw),
+                    packed_angle(self.pitch))
+        if self._teleport is None or self._teleport[0] != position:
+            x, y, z, yaw, pitch = position
+            packet = TeleportEntity(entity_id=self.id, x=x, y=y, z=z,
+                                    yaw=yaw, pitch=pitch)
+            self._teleport = (position,
+                              autoproto.packet.Frame.from_packet(packet))
+        return self._teleport[1]
+
 class Mob(BaseEntity):
     def __init__(self, position, type):
         super(Mob, self).__init__(position)
@@ -52,8 +76,9 @@ class Mob(BaseEntity):
     def get_packet(self):
         return SpawnMob(
             entity_id=self.id, type=self.type, x=int(self.pos.x * 32),
-            y=int(self.pos.y * 32), z=int(self.pos.z * 32), yaw=int(self.yaw),
-            pitch=int(self.pitch), data=[DynamicField(0, 0, 0)])
+            y=int(self.pos.y * 32), z=int(self.pos.z * 32),
+            yaw=packed_angle(self.yaw), pitch=packed_angle(self.pitch),
+            data=[DynamicField(0, 0, 0)])
 
 class Player(BaseEntity):
     def __init__(self, position, username, held_item=None):
@@ -65,7 +90,7 @@ class Player(BaseEntity):
         return SpawnPlayer(
             entity_id=self.id, username=self.username, x=int(self.pos.x * 32),
             y=int(self.pos.y * 32), z=int(self.pos.z * 32),
-            rotation=int(self.yaw), pitch=int(self.pitch),
+            rotation=packed_angle(self.yaw), pitch=packed_angle(self.pitch),
             item_id=self.held_item.id if self.held_item else -1)
 
 class Error(Exception):
@@ -86,7 +111,7 @@ class MinecraftServer(asyncore.dispatcher):
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.bind((host, port))
         self.listen(1)
-        print 'Listening on %s:%d' % (host or '*', port)
+        print('Listening on %s:%d' % (host or '*', port))
 
     def add_entity(self, entity):
         self.entities[entity.id] = entity
@@ -95,7 +120,7 @@ class MinecraftServer(asyncore.dispatcher):
         if client.username in self.clients:
             raise NameInUseError('Username is already in use.')
 
-        self.message(u'§e%s joined the game' % client.username)
+        self.message('§e%s joined the game' % client.username)
 
         self.clients[client.username] = client
 
@@ -105,14 +130,16 @@ class MinecraftServer(asyncore.dispatcher):
 
     def handle_accept(self):
         socket, address = self.accept()
-        print address, 'connected'
+        print(address, 'connected')
         ClientHandler(socket, self)
 
     def message(self, message):
-        print message
-        packet = ChatMessage(message=message)
+        print(message)
+        # Encode the message once for all the clients.
+        frame = autoproto.packet.Frame.from_packet(
+            ChatMessage(message=message))
         for client in self.clients.values():
-            client.out.append(packet)
+            client.out.append(frame)
 
     def remove_entity(self, entity):
         del self.entities[entity.id]
@@ -121,7 +148,7 @@ class MinecraftServer(asyncore.dispatcher):
         if client.entity:
             self.remove_entity(client.entity)
         del self.clients[client.username]
-        self.message(u'§e%s left the game' % client.username)
+        self.message('§e%s left the game' % client.username)
 
 class ClientHandler(asyncore.dispatcher):
     def __init__(self, socket, server):
@@ -132,10 +159,12 @@ class ClientHandler(asyncore.dispatcher):
         self.reader = autoproto.packet.PacketReader(
             autoproto.marshal.java.JavaUByte,
             autoproto.packet.TO_SERVER)
+        self.writer = autoproto.packet.PacketWriter()
         self.handler = self.protocol()
 
-        # Queue for packets that should be sent, but don't have to be sent
-        # immediately, leaving room for other packets to be handled.
+        # Queue of (future, packet) pairs for packets that should be sent, but
+        # don't have to be sent immediately, leaving room for other packets to
+        # be handled. A packet is sent once its future is done.
         self.deferred = []
         # List of packets that have been received by the client, but not
         # handled.
@@ -190,8 +219,8 @@ class ClientHandler(asyncore.dispatcher):
             yield e.get_packet()
             yield Entity(entity_id=e.id)
 
-        for x in xrange(20):
-            for z in xrange(20):
+        for x in range(20):
+            for z in range(20):
                 yield AllocateChunk(x=x, z=z, allocate=True)
 
         yield MoveAndLookCorrection(
@@ -223,31 +252,35 @@ class ClientHandler(asyncore.dispatcher):
 
         # 64 blocks of gold, then 64 blocks of air, plus metadata and light
         # data, in a 16x128x16 area.
-        data = ('\x29' * 64 + '\x00' * 64) * 256 + '\x00' * 16384 + \
-                '\xff' * 32768
+        data = (b'\x29' * 64 + b'\x00' * 64) * 256 + b'\x00' * 16384 + \
+                b'\xff' * 32768
         chunks = []
-        for x in xrange(20):
-            for z in xrange(20):
+        for x in range(20):
+            for z in range(20):
                 chunks.append(ChunkData(
                     x=x * 16, y=0, z=z * 16, ubound_x=15, ubound_y=127,
-                    ubound_z=15, data=data))
+                    ubound_z=15))
         # Send chunks back in order of distance.
         chunks.sort(key=lambda c: math.sqrt((entity.pos.x - c.x - 8) ** 2 +
                                             (entity.pos.y - c.y - 8) ** 2))
+        # Compress all the chunk data on a thread pool in the background,
+        # instead of one chunk at a time as they're sent.
+        futures = ZlibData.compress_async([data] * len(chunks))
 
         # Add ChunkData to a deferred queue, so client input can be processed
-        # while chunk data is being sent.
-        self.deferred += chunks
+        # while chunk data is being compressed and sent. Every chunk waits for
+        # its data to be compressed.
+        self.deferred += zip(futures, chunks)
 
         # Remove unused variables.
-        del chunks, data
+        del chunks, data, futures
 
         yield MoveAndLookCorrection(
             x=entity.pos.x, y=entity.pos.y, z=entity.pos.z,
             stance=entity.pos.y + 1.62, yaw=entity.yaw, pitch=entity.pitch,
             on_ground=False)
 
-        yield ChatMessage(message=u'§eWelcome to Example Server!')
+        yield ChatMessage(message='§eWelcome to Example Server!')
 
         last_tick = time.time()
         while True:
@@ -262,19 +295,18 @@ class ClientHandler(asyncore.dispatcher):
                         yield Entity(entity_id=e.id)
                         self.known_entities.append(e)
                         continue
-                    yield TeleportEntity(
-                        entity_id=e.id, x=int(e.pos.x * 32),
-                        y=int(e.pos.y * 32), z=int(e.pos.z * 32),
-                        yaw=int(e.yaw), pitch=int(e.pitch))
+                    yield e.get_teleport_frame()
                 last_tick = t
 
             while not self.incoming:
                 # Waiting for incoming packets.
                 n = 0
-                while self.deferred:
+                while self.deferred and self.deferred[0][0].done():
                     # Since there is nothing to do, use this opportunity to
-                    # send deferred packets.
-                    yield self.deferred.pop(0)
+                    # send deferred packets that are ready.
+                    future, packet = self.deferred.pop(0)
+                    packet.data = future.result()
+                    yield packet
                     n += 1
                     if n >= 5:
                         # Only send up to 5 deferred packets at a time.
@@ -294,7 +326,7 @@ class ClientHandler(asyncore.dispatcher):
             if isinstance(packet, ChatMessage):
                 self.server.message('<%s> %s' % (self.username, packet.message))
             if isinstance(packet, Disconnect):
-                print self.username, 'disconnecting:', packet.reason
+                print(self.username, 'disconnecting:', packet.reason)
                 break
 
         self.handle_close()
@@ -308,11 +340,19 @@ class ClientHandler(asyncore.dispatcher):
         self.close()
 
     def handle_read(self):
-        data = self.recv(8192)
-        if not data:
+        # Receive directly into the buffer of the packet reader.
+        try:
+            packets = self.reader.recv_into(self.socket)
+        except OSError as why:
+            if why.args[0] not in asyncore._DISCONNECTED:
+                raise
+            packets = None
+
+        if packets is None:
             self.handle_close()
+            return
 
-        self.incoming += self.reader.read(data)
+        self.incoming += packets
         for response in self.handler:
             # Stop when there are no more packets to send.
             if not response:
@@ -320,16 +360,21 @@ class ClientHandler(asyncore.dispatcher):
             self.out.append(response)
 
     def handle_write(self):
-        data = []
-
         while len(self.out) > 0:
             packet = self.out.pop(0)
-            data.append(packet.build())
+            self.writer.write(packet)
 
-        self.send(''.join(data))
+        # Send as much as possible. Anything left over is sent the next time
+        # the socket is writable.
+        try:
+            self.writer.flush(self.socket)
+        except OSError as why:
+            if why.args[0] not in asyncore._DISCONNECTED:
+                raise
+            self.handle_close()
 
     def writable(self):
-        return len(self.out) > 0
+        return len(self.out) > 0 or self.writer.pending > 0
 
 def main():
     s = MinecraftServer('', 25565)
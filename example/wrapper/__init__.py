@@ -6,7 +6,10 @@ packets.
 """
 
 import asyncore
+import collections
+import importlib
 import sys
+import time
 
 import autoproto.packet
 from example.wrapper.proxy import MinecraftForwarder
@@ -20,24 +23,82 @@ __all__ = [
 def _load_module(module):
     m = sys.modules.get(module)
     if m:
-        reload(m)
+        importlib.reload(m)
     else:
-        __import__(module)
+        importlib.import_module(module)
     return sys.modules[module]
 
+# Packet types that MinecraftWrapper.handle_packet keeps track of itself.
+_tracked_types = (
+    ChatMessage, LogIn, LoggedIn, Move, MoveAndLook, MoveAndLookCorrection,
+    MoveAndPointEntity, MoveEntity, TeleportEntity, Unknown1, Unknown2)
+
 class MinecraftWrapper(object):
-    def __init__(self, forward_to, bind_to=None):
+    # Calls of handlers and commands that take at least this many seconds are
+    # logged as slow.
+    slow_call_threshold = 0.01
+
+    def __init__(self, forward_to, bind_to=None, capture_dir=None,
+                 dump_dir='.'):
+        """Sets up a wrapper listening on the bind_to address that forwards
+        connections to the forward_to address. If capture_dir is specified,
+        every session is recorded to a capture file in that directory. The
+        most recent packets of a session are written to dump_dir when an
+        error occurs.
+
+        """
         if not bind_to:
             bind_to = ('', 25565)
 
+        # The packet types to decode in each direction. Other packets are
+        # forwarded as raw frames. The sets are updated in place whenever the
+        # handlers are reloaded.
+        self._decode = {
+            autoproto.packet.TO_CLIENT: set(_tracked_types),
+            autoproto.packet.TO_SERVER: set(_tracked_types)}
+
         self.forwarder = MinecraftForwarder(
-            bind_to, forward_to, self.handle_packet)
+            bind_to, forward_to, self.handle_packet, self._decode,
+            capture_dir, dump_dir)
 
         self._players = {}
         self._stats = {}
+        # The number of calls, the total time and the longest time of every
+        # handler and command, by name.
+        self._timings = {}
+        # (time, name, seconds) tuples of the most recent slow calls.
+        self.slow_calls = collections.deque(maxlen=100)
+        # The SamplingProfiler started by the /profile command, if any. It's
+        # kept here rather than in the command module, which is reloaded.
+        self.profiler = None
+
+    def _call(self, name, func, *args):
+        """Calls a handler or a command function and keeps track of the time
+        it takes.
+
+        """
+        start = time.perf_counter()
+        try:
+            func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = [0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += elapsed
+            if elapsed > timing[2]:
+                timing[2] = elapsed
+            if elapsed >= self.slow_call_threshold:
+                self.slow_calls.append((time.time(), name, elapsed))
+                print('Slow call: %s took %.1f ms' % (name, elapsed * 1000))
 
     def handle_packet(self, proxy, packet):
-        packet_class = packet.__class__
+        frame = isinstance(packet, autoproto.packet.Frame)
+        if frame:
+            packet_class = packet.packet_class
+        else:
+            packet_class = packet.__class__
 
         # Keep statistics over packet send counts.
         if packet_class in self._stats:
@@ -57,9 +118,13 @@ class MinecraftWrapper(object):
         # Save stats.
         self._stats[packet_class] = (cs, sc)
 
+        if frame:
+            # Nothing is interested in the contents of this packet.
+            return
+
         # Set up a Player object for every client.
         if client not in self._players:
-            self._players[client] = Player(client)
+            self._players[client] = Player(client, self)
         player = self._players[client]
 
         # Do some special handling of certain packets.
@@ -85,10 +150,12 @@ class MinecraftWrapper(object):
                     packet.suppress()
                 elif command in self._commands:
                     try:
-                        self._commands[command](player, packet, *args)
-                    except Exception, e:
-                        print e
-                        player.message(u'§6An error occurred.')
+                        handler = self._commands[command]
+                        self._call('/' + handler.__name__, handler, player,
+                                   packet, *args)
+                    except Exception as e:
+                        print(e)
+                        player.message('§6An error occurred.')
                     # Don't send handled commands to the server.
                     packet.suppress()
         elif isinstance(packet, (Move, MoveAndLook, MoveAndLookCorrection)):
@@ -112,9 +179,9 @@ class MinecraftWrapper(object):
             # The assumption is that any packet that is named "Unknown" needs
             # to be printed so we can figure out what it is.
             if packet.direction == autoproto.packet.TO_SERVER:
-                print 'C->S', repr(packet)
+                print('C->S', repr(packet))
             else:
-                print 'S->C', repr(packet)
+                print('S->C', repr(packet))
 
         # Send the packet to any handler that has been set up for its type and
         # direction.
@@ -123,7 +190,7 @@ class MinecraftWrapper(object):
             return
 
         for handler in self._handlers[key]:
-            handler(player, packet)
+            self._call(handler.__name__, handler, player, packet)
 
     def load_command_module(self, module):
         """Loads a module containing command handler functions. If the module
@@ -132,7 +199,7 @@ class MinecraftWrapper(object):
         Currently only supports one module at a time.
 
         """
-        print 'Loading command handlers...'
+        print('Loading command handlers...')
 
         m = _load_module(module)
 
@@ -149,7 +216,7 @@ class MinecraftWrapper(object):
                     assert alias not in self._commands, 'Command redefinition'
                     self._commands[alias] = attr
 
-        print 'Loaded %d command(s).' % len(self._commands)
+        print('Loaded %d command(s).' % len(self._commands))
 
     def load_handler_module(self, module):
         """Loads a module containing packet handler functions. If the module
@@ -158,7 +225,7 @@ class MinecraftWrapper(object):
         Currently only supports one module at a time.
 
         """
-        print 'Loading packet handlers...'
+        print('Loading packet handlers...')
 
         m = _load_module(module)
 
@@ -176,7 +243,13 @@ class MinecraftWrapper(object):
                         self._handlers[key] = []
                     self._handlers[key].append(attr)
 
-        print 'Loaded %d handler(s).' % len(self._handlers)
+        # Only decode the packets that are handled.
+        for direction, types in self._decode.items():
+            types.clear()
+            types.update(_tracked_types)
+            types.update(t for t, d in self._handlers if d == direction)
+
+        print('Loaded %d handler(s).' % len(self._handlers))
 
     def reload(self):
         """Reloads the command and packet handler modules.
@@ -190,16 +263,28 @@ class MinecraftWrapper(object):
             asyncore.loop()
         except KeyboardInterrupt:
             # Print the packet send count statistics.
-            print ''
-            print '%-25s%10s%10s' % ('[Packet]', '[C->S]', '[S->C]')
+            print('')
+            print('%-25s%10s%10s' % ('[Packet]', '[C->S]', '[S->C]'))
             for packet, (cs, sc) in self._stats.items():
-                print '%-25s%10d%10d' % (packet.__name__, cs, sc)
+                print('%-25s%10d%10d' % (packet.__name__, cs, sc))
+
+            # Print the time used by the handlers and commands.
+            print('')
+            print('%-25s%10s%12s%12s%12s' % (
+                '[Handler]', '[Calls]', '[Total ms]', '[Mean ms]', '[Max ms]'))
+            for name, (count, total, longest) in sorted(
+                    self._timings.items(), key=lambda item: -item[1][1]):
+                print('%-25s%10d%12.1f%12.3f%12.1f' % (
+                    name, count, total * 1000, total / count * 1000,
+                    longest * 1000))
 
             self.forwarder.handle_close()
 
 class Player(object):
-    def __init__(self, client):
+    def __init__(self, client, wrapper=None):
         self.client = client
+        # The MinecraftWrapper that the player is connected through.
+        self.wrapper = wrapper
         self.id = -1
         self.username = 'Unknown'
         self.x = 0.0
@@ -236,7 +321,7 @@ def command(*aliases):
             handler._c_aliases += aliases
         else:
             handler._c_aliases = aliases
-        print '  Registered command %s' % '/'.join(aliases)
+        print('  Registered command %s' % '/'.join(aliases))
         return handler
     return decorator
 
@@ -267,7 +352,7 @@ def packet_handler(packet_type, directions=0):
             handler._p_handler_keys += keys
         else:
             handler._p_handler_keys = keys
-        print '  Registered packet handler %s (for %s)' % (
-            handler.__name__, packet_type.__name__)
+        print('  Registered packet handler %s (for %s)' % (
+            handler.__name__, packet_type.__name__))
         return handler
     return decorator
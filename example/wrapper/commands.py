@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 
-from example.wrapper import command
+import os
+import time
+
+from example.wrapper import command, config
+from example.wrapper.profiler import SamplingProfiler
 from minecraft.packet import *
 
 _locations = {}
 
+def _allowed(player, permission):
+    group = config.get('players', player.username, 'group')
+    return config.get('groups', group, 'permissions', permission)
+
 class Location(object):
     def __init__(self, owner, name):
         self.name = name
@@ -26,11 +34,11 @@ def location(player, packet, *args):
         if location:
             if location.owner == player:
                 del _locations[name]
-                player.message(u'§6Deleted location §f%s§6.' % name)
+                player.message('§6Deleted location §f%s§6.' % name)
             else:
-                player.message(u'§6You may not delete that location.')
+                player.message('§6You may not delete that location.')
         else:
-            player.message(u'§6That location does not exist.')
+            player.message('§6That location does not exist.')
     elif action in ('g', 'go', 'goto'):
         if location:
             # The server doesn't care how far you move in one go. However, it
@@ -59,23 +67,64 @@ def location(player, packet, *args):
             # Tell the client its new position.
             player.send(MoveAndLookCorrection(**kwargs))
         else:
-            player.message(u'§6That location does not exist.')
+            player.message('§6That location does not exist.')
     elif action in ('l', 'ls', 'list'):
         if _locations:
-            player.message(u'§6, §f'.join(_locations))
+            player.message('§6, §f'.join(_locations))
         else:
-            player.message(u'§6There are no locations to list.')
+            player.message('§6There are no locations to list.')
     elif action in ('s', 'save'):
         if location:
             if location.owner == player:
                 location.x = player.x
                 location.y = player.y
                 location.z = player.z
-                player.message(u'§6Updated location §f%s§6.' % name)
+                player.message('§6Updated location §f%s§6.' % name)
             else:
-                player.message(u'§6You may not update that location.')
+                player.message('§6You may not update that location.')
         else:
             location = Location(player, name)
-            player.message(u'§6Created location §f%s§6.' % name)
+            player.message('§6Created location §f%s§6.' % name)
+    else:
+        player.message('§6Action should be one of list, save, goto, delete.')
+
+@command('dump')
+def dump(player, packet, *args):
+    if not _allowed(player, 'dump-packets'):
+        player.message('§6You may not dump packets.')
+        return
+
+    path = player.client.dump()
+    player.message('§6Wrote the last packets to §f%s§6.' % path)
+
+@command('profile')
+def profile(player, packet, *args):
+    if not _allowed(player, 'profile'):
+        player.message('§6You may not profile the wrapper.')
+        return
+
+    wrapper = player.wrapper
+    profiler = wrapper.profiler
+    action = args[0] if args else None
+    if action == 'start':
+        if profiler and profiler.running:
+            player.message('§6The profiler is already running.')
+            return
+        # Commands are run on the event loop, so this profiles the loop.
+        wrapper.profiler = SamplingProfiler()
+        wrapper.profiler.start()
+        player.message('§6Started the profiler.')
+    elif action == 'stop':
+        if not profiler:
+            player.message('§6The profiler is not running.')
+            return
+        profiler.stop()
+        wrapper.profiler = None
+        name = time.strftime('%Y%m%d-%H%M%S', time.localtime(
+            profiler.started)) + '.profile.txt'
+        path = os.path.join(config.get('dump-dir'), name)
+        profiler.write(path)
+        player.message('§6Wrote §f%d§6 samples to §f%s§6.' % (
+            profiler.samples, path))
     else:
-        player.message(u'§6Action should be one of list, save, goto, delete.')
+        player.message('§6Action should be one of start, stop.')
@@ -13,9 +13,12 @@ _defaults = {
         'host': 'localhost',
         'port': 25565},
     'port': 25564,
+    'dump-dir': '.',
     'groups': {
         '@default': {
             'permissions': {
+                'dump-packets': False,
+                'profile': False,
                 'place-blocks': False}}},
     'players': {
         '@default': {'group': 'Guest'}}}
@@ -62,7 +65,7 @@ def get(*path):
         return PartialConfig(*path)
 
     assert value is None or \
-        isinstance(value, (basestring, bool, float, int, list, long)), \
+        isinstance(value, (str, bool, float, int, list)), \
         'Invalid value type'
 
     return value
@@ -95,7 +98,7 @@ def set(*path_and_value):
     key, value = path_and_value[-2:]
     if value is None:
         raise NotImplemented('Cannot unset values yet')
-    if not isinstance(value, (basestring, bool, float, int, list, long)):
+    if not isinstance(value, (str, bool, float, int, list)):
         raise TypeError('Invalid value type')
 
     # Set up the path up to the last dict.
@@ -9,15 +9,15 @@ from minecraft.packet import *
 
 @packet_handler(Disconnect, TO_CLIENT)
 def player_disconnected(player, packet):
-    print '%s disconnected (%s)' % (player.username, packet.reason)
+    print('%s disconnected (%s)' % (player.username, packet.reason))
 
 @packet_handler(LoggedIn)
 def player_logged_in(player, packet):
-    print '%s logged in' % player.username
+    print('%s logged in' % player.username)
 
     config.set('players', player.username, 'last-login',
         datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
 
 @packet_handler(ChatMessage, TO_SERVER)
 def player_sent_message(player, packet):
-    print '<%s> %s' % (player.username, packet.message)
+    print('<%s> %s' % (player.username, packet.message))
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 from example.wrapper import config
@@ -7,7 +7,8 @@ from example.wrapper import MinecraftWrapper
 def main():
     wrapper = MinecraftWrapper(
         (config.get('server', 'host'), config.get('server', 'port')),
-        ('', config.get('port')))
+        ('', config.get('port')), config.get('capture-dir'),
+        config.get('dump-dir'))
     wrapper.load_command_module('example.wrapper.commands')
     wrapper.load_handler_module('example.wrapper.handlers')
     wrapper.start()
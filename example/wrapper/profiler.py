@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""A sampling profiler for the event loop of the wrapper.
+
+A background thread looks at the stack of the profiled thread at a fixed
+interval and counts how many times every stack was seen. Since the profiled
+thread is never interrupted, the cost is low enough to use on a live server.
+The counts are written in the collapsed stack format, with one line per
+stack: the frames from the outermost to the innermost separated by
+semicolons, then a space and the count. Tools like flamegraph.pl and
+speedscope can turn the file into a flame graph.
+
+"""
+
+import os
+import sys
+import threading
+import time
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+__all__ = [
+    'SamplingProfiler']
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name,
+                         code.co_firstlineno)
+
+class SamplingProfiler(object):
+    def __init__(self, thread_id=None, interval=0.01):
+        """Sets up a profiler for the thread with the specified id, which
+        defaults to the current thread. The stack is sampled every interval
+        seconds once the profiler has been started.
+
+        """
+        if thread_id is None:
+            thread_id = threading.get_ident()
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}
+        self.started = None
+        self.stopped = None
+        self._running = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def _run(self):
+        # The names of the frames by code object, since the same code shows up
+        # in almost every sample.
+        names = {}
+        while self._running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                # The profiled thread is gone.
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = _frame_name(frame)
+                stack.append(name)
+                frame = frame.f_back
+            del frame
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+        self._running.clear()
+
+    def start(self):
+        if self.running:
+            raise RuntimeError('The profiler is already running')
+        self.started = time.time()
+        self._running.set()
+        self._thread = threading.Thread(target=self._run,
+                                        name='SamplingProfiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.stopped = time.time()
+
+    def write(self, path):
+        """Writes the stacks that were seen to a file in the collapsed stack
+        format, most common first.
+
+        """
+        with open(path, 'w') as fh:
+            for stack, count in sorted(self.stacks.items(),
+                                       key=lambda item: -item[1]):
+                fh.write('%s %d\n' % (stack, count))
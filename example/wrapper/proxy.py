@@ -6,10 +6,13 @@ connection, and the handling of packets in-between.
 """
 
 import asyncore
+import os
 import socket
 import sys
+import time
 import traceback
 
+import autoproto.capture
 import autoproto.marshal.java
 import autoproto.packet
 
@@ -19,16 +22,37 @@ __all__ = [
     'MinecraftForwarder', 'MinecraftProxy']
 
 class MinecraftProxy(asyncore.dispatcher):
-    def __init__(self, socket, direction, packet_handler=None):
+    # Limits for the data read from the connection. A connection that exceeds
+    # any of them is closed. See PacketReader.
+    limits = dict(max_pending=4 * 1024 * 1024, max_array_length=65536,
+                  max_string_length=16384,
+                  max_decompressed_size=4 * 1024 * 1024)
+
+    def __init__(self, socket, direction, packet_handler=None, decode=None,
+                 capture=None, recorder=None):
         self.other = None
         self.packet_handler = packet_handler
+        # A CaptureWriter that records the packets received by the proxy, if
+        # any. Both proxies of a session share the same capture.
+        self.capture = capture
+        # A FlightRecorder that keeps the most recent packets received by the
+        # proxy, if any. It's also shared by both proxies of a session.
+        self.recorder = recorder
         self.packets = []
+        # Packets with a class that is not in decode are forwarded as raw
+        # frames. Other packets are only decoded if a handler looks at them,
+        # and are forwarded as they are unless a handler changes them.
         self.reader = autoproto.packet.PacketReader(
-            autoproto.marshal.java.JavaUByte, direction)
+            autoproto.marshal.java.JavaUByte, direction, decode, lazy=True,
+            **self.limits)
+        self.writer = autoproto.packet.PacketWriter()
 
         asyncore.dispatcher.__init__(self, socket)
 
     def handle_close(self):
+        if self.capture:
+            self.capture.close()
+
         if not self.other:
             return
 
@@ -38,19 +62,64 @@ class MinecraftProxy(asyncore.dispatcher):
 
     def handle_error(self):
         t, v, tb = sys.exc_info()
-        print 'ERROR: %s' % v
+        print('ERROR: %s' % v)
         traceback.print_tb(tb)
 
+        if self.recorder:
+            try:
+                self.dump()
+            except OSError as e:
+                print('Could not write the last packets: %s' % e)
+
         self.handle_close()
 
+    def dump(self, path=None):
+        """Writes the most recent packets of the session to a capture file,
+        and returns the path of the file.
+
+        """
+        path = path or self.recorder.path
+        count = self.recorder.dump(path)
+        print('Wrote the last %d packets to %s' % (count, path))
+        return path
+
     def handle_read(self):
-        data = self.recv(8192)
+        # Receive directly into the buffer of the packet reader.
+        try:
+            packets = self.reader.recv_into(self.socket)
+        except OSError as why:
+            if why.args[0] not in asyncore._DISCONNECTED:
+                raise
+            packets = None
+        except autoproto.packet.LimitExceeded as e:
+            print('Closing connection: %s' % e)
+            packets = None
+        except NotImplementedError:
+            if self.recorder:
+                # Keep the data that couldn't be read, starting with the id
+                # of the unknown packet.
+                reader = self.reader
+                start = reader.consumed - len(reader.id_type.bytes_from(0))
+                data = reader.buffer[start:reader.size]
+                self.recorder.write_bytes(reader.direction, data[0], data)
+            raise
+
+        if packets is None:
+            self.handle_close()
+            return
+
+        if self.capture:
+            # Record the packets as they were received, before any handler
+            # can change them.
+            for packet in packets:
+                self.capture.write(packet)
+        if self.recorder:
+            for packet in packets:
+                self.recorder.write(packet)
         if self.other:
-            self.other.packets += self.reader.read(data)
+            self.other.packets += packets
 
     def handle_write(self):
-        data = []
-
         # Send all packets in the queue.
         # XXX: Maybe limit this to a certain number of packets in case all the
         #      writing is holding up the rest of the thread.
@@ -59,13 +128,25 @@ class MinecraftProxy(asyncore.dispatcher):
             packet = self.packets.pop(0)
             # Pass the packet to the packet handler.
             if self.packet_handler:
-                self.packet_handler(self, packet)
+                try:
+                    self.packet_handler(self, packet)
+                except autoproto.packet.LimitExceeded as e:
+                    # The handler decoded a packet that exceeds the limits.
+                    print('Closing connection: %s' % e)
+                    self.handle_close()
+                    return
             # Forward the packet as long as it has not been suppressed.
             if not packet.suppressed:
-                data.append(packet.build())
+                self.writer.write(packet)
 
-        # Send all the data that should be sent.
-        self.send(''.join(data))
+        # Send as much as possible. Anything left over is sent the next time
+        # the socket is writable.
+        try:
+            self.writer.flush(self.socket)
+        except OSError as why:
+            if why.args[0] not in asyncore._DISCONNECTED:
+                raise
+            self.handle_close()
 
     def meet(self, other):
         """Connect this proxy with another. Basically, set up forwarding from a
@@ -76,12 +157,30 @@ class MinecraftProxy(asyncore.dispatcher):
         other.other = self
 
     def writable(self):
-        return len(self.packets) > 0
+        return len(self.packets) > 0 or self.writer.pending > 0
 
 class MinecraftForwarder(asyncore.dispatcher):
-    def __init__(self, listen, forward_to, packet_handler=None):
+    def __init__(self, listen, forward_to, packet_handler=None, decode=None,
+                 capture_dir=None, dump_dir='.'):
+        """Sets up a forwarder listening on the listen address that proxies
+        connections to the forward_to address.
+
+        If specified, decode should be a dict mapping TO_CLIENT and TO_SERVER
+        to the collections of packet classes that should be decoded in that
+        direction. All other packets are forwarded without being decoded.
+
+        If capture_dir is specified, both directions of every session are
+        recorded to a capture file in that directory (see autoproto.capture).
+
+        The most recent packets of every session are always kept in memory,
+        and are written to a capture file in dump_dir if an error occurs.
+
+        """
         self.forward_to = forward_to
         self.packet_handler = packet_handler
+        self.decode = decode or {}
+        self.capture_dir = capture_dir
+        self.dump_dir = dump_dir
 
         asyncore.dispatcher.__init__(self)
 
@@ -89,7 +188,7 @@ class MinecraftForwarder(asyncore.dispatcher):
         self.bind(listen)
         self.listen(5)
 
-        print 'Listening on %s' % (listen,)
+        print('Listening on %s' % (listen,))
 
     def handle_accept(self):
         client_connection, source_addr = self.accept()
@@ -97,12 +196,24 @@ class MinecraftForwarder(asyncore.dispatcher):
         server_connection = socket.socket()
         server_connection.connect(self.forward_to)
 
-        client = MinecraftProxy(client_connection, autoproto.packet.TO_SERVER,
-            self.packet_handler)
-        server = MinecraftProxy(server_connection, autoproto.packet.TO_CLIENT,
-            self.packet_handler)
+        name = '%s-%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), source_addr[0],
+                             source_addr[1])
+        capture = None
+        if self.capture_dir:
+            capture = autoproto.capture.CaptureWriter(
+                os.path.join(self.capture_dir, name + '.cap'))
+            print('Recording session to %s' % capture.path)
+        recorder = autoproto.capture.FlightRecorder(
+            path=os.path.join(self.dump_dir, name + '.flight.cap'))
+
+        to_server = autoproto.packet.TO_SERVER
+        to_client = autoproto.packet.TO_CLIENT
+        client = MinecraftProxy(client_connection, to_server,
+            self.packet_handler, self.decode.get(to_server), capture, recorder)
+        server = MinecraftProxy(server_connection, to_client,
+            self.packet_handler, self.decode.get(to_client), capture, recorder)
         server.meet(client)
 
     def handle_close(self):
         self.close()
-        print 'Stopped listening'
+        print('Stopped listening')
@@ -2,18 +2,33 @@
 
 """Minecraft-specific Marshaler types.
 
+Some list types can be read as columnar values instead (see BlockChanges,
+BlockOffsets and ItemStacks), which is faster for large lists but only
+supports indexing and iterating. To read a field of a packet class that way,
+turn the option on for the field:
+
+    >>> WindowItems.items.columnar = True
+
 """
 
+import array
+import collections
 import gzip
+import hashlib
+import struct
+import threading
 import zlib
+from concurrent.futures import Future as _Future
+from concurrent.futures import ThreadPoolExecutor as _ThreadPool
 
 try:
-    from cStringIO import StringIO
+    import numpy
 except ImportError:
-    from StringIO import StringIO
+    numpy = None
 
 from autoproto.marshal import Array, Marshaler
 from autoproto.marshal.java import *
+from autoproto.packet import LimitExceeded
 
 __author__ = 'andreas@blixt.org (Andreas Blixt)'
 
@@ -25,6 +40,133 @@ def _struct_repr(struct):
     cls = struct.__class__
     return '%s.%s(%s)' % (cls.__module__, cls.__name__, ', '.join(kw))
 
+def _struct_eq(struct, other):
+    if struct.__class__ is not other.__class__:
+        return NotImplemented
+    return all(getattr(struct, name) == getattr(other, name)
+               for name in struct.__slots__)
+
+# The array.array typecodes (which are also NumPy dtypes) used for the columns
+# of columnar values.
+_column_types = {JavaByte: 'b', JavaShort: 'h'}
+
+def _column(values, item_type):
+    """Creates a column of item_type values from a sequence. Columns are NumPy
+    arrays if NumPy is available, otherwise array.array instances.
+
+    """
+    if numpy is not None:
+        return numpy.array(values, dtype=_column_types[item_type])
+    return array.array(_column_types[item_type], values)
+
+def _column_bytes(column, item_type):
+    """Returns the bytes for a column of item_type values.
+
+    """
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        return column.astype(item_type.format).tobytes()
+    return Array.bytes_from(column, len(column), item_type)
+
+def _read_column(reader, length, item_type):
+    """Reads a column of length item_type values.
+
+    """
+    if numpy is not None:
+        data = reader.get(length * item_type.size)
+        return numpy.frombuffer(data, item_type.format).astype(
+            _column_types[item_type])
+    return Array.read_bytes(reader, length, item_type, as_array=True)
+
+class _Inflater(object):
+    """The state of a ZlibData value that is being decompressed as its data
+    arrives.
+
+    """
+    __slots__ = ['compressed', 'decompressor', 'kept', 'pieces', 'remaining',
+                 'size', 'wbits']
+
+    def __init__(self, length, wbits, keep=True):
+        """Sets up the decompression of length bytes of compressed data. If
+        keep is False, the compressed data is not kept, and the value will
+        be the decompressed data only.
+
+        """
+        # The compressed data received so far, if it's kept, and its size.
+        self.compressed = [] if keep else None
+        self.kept = 0
+        self.decompressor = zlib.decompressobj(wbits)
+        self.pieces = []
+        self.remaining = length
+        # The number of bytes decompressed so far.
+        self.size = 0
+        self.wbits = wbits
+
+    def decompress(self, data, reader):
+        """Decompresses a piece of data, making sure that the decompressed
+        data doesn't exceed the max_decompressed_size limit of the reader.
+
+        """
+        limit = reader.max_decompressed_size
+        if limit is None:
+            piece = self.decompressor.decompress(data)
+        else:
+            piece = self.decompressor.decompress(data, limit - self.size + 1)
+        self.size += len(piece)
+        reader.check_limit('max_decompressed_size', self.size)
+        self.pieces.append(piece)
+        if self.compressed is not None:
+            self.compressed.append(data)
+            self.kept += len(data)
+
+    def finish(self, reader):
+        """Returns the value of the data: a _Deflated value if the compressed
+        data was kept, otherwise the decompressed data. Raises zlib.error if
+        the compressed data ended before the end of the stream.
+
+        """
+        self.pieces.append(self.decompressor.flush())
+        self.size += len(self.pieces[-1])
+        reader.check_limit('max_decompressed_size', self.size)
+        if not self.decompressor.eof:
+            raise zlib.error('Incomplete or truncated stream')
+        if self.compressed is None:
+            return b''.join(self.pieces)
+        return _Deflated(b''.join(self.compressed), self.wbits,
+                         b''.join(self.pieces))
+
+class _Deflated(object):
+    """A ZlibData value as it was received. The compressed data is kept so
+    that it can be written again as-is, while the decompressed data is only
+    created when it is first needed. If limit is not None, decompressing more
+    than limit bytes raises LimitExceeded.
+
+    """
+    __slots__ = ['data', 'limit', 'wbits', '_value']
+
+    def __init__(self, data, wbits, value=None, limit=None):
+        self.data = data
+        self.limit = limit
+        self.wbits = wbits
+        self._value = value
+
+    def value(self):
+        if self._value is None:
+            if self.limit is None:
+                self._value = zlib.decompress(self.data, self.wbits)
+                return self._value
+            # Stop as soon as the data turns out to be too large.
+            decompressor = zlib.decompressobj(self.wbits)
+            value = decompressor.decompress(self.data, self.limit + 1)
+            if len(value) > self.limit:
+                raise LimitExceeded(
+                    'max_decompressed_size is %d, but got more' % self.limit)
+            value += decompressor.flush()
+            if not decompressor.eof:
+                # Fail like zlib.decompress does.
+                raise zlib.error('Incomplete or truncated stream')
+            self._value = value
+        return self._value
+
 __locals = set(locals())
 __locals.add('__locals')
 
@@ -33,13 +175,104 @@ class BlockOffset(Marshaler):
     they're intended for blocks.
 
     """
+    size = 3
+
     @classmethod
     def bytes_from(cls, value):
-        return ''.join(JavaByte.bytes_from(v) for v in value)
+        return b''.join(JavaByte.bytes_from(v) for v in value)
 
     @classmethod
     def read_bytes(cls, reader):
-        return tuple(JavaByte.read_bytes(reader) for i in xrange(3))
+        return tuple(JavaByte.read_bytes(reader) for i in range(3))
+
+    @classmethod
+    def skip_bytes(cls, reader):
+        reader.skip(3)
+
+class BlockOffsets(object):
+    """A columnar list of X, Y, Z block offsets. The offsets are kept in an
+    (N, 3) NumPy array if NumPy is available, otherwise in a flat array.array
+    of 3 * N values. Indexing or iterating creates the offset tuples on the
+    fly.
+
+    """
+    __slots__ = ['offsets']
+
+    def __init__(self, offsets):
+        self.offsets = offsets
+
+    @classmethod
+    def from_tuples(cls, tuples):
+        values = [v for offset in tuples for v in offset]
+        offsets = _column(values, JavaByte)
+        if numpy is not None:
+            offsets = offsets.reshape(-1, 3)
+        return cls(offsets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Block offset index out of range')
+        if numpy is not None and isinstance(self.offsets, numpy.ndarray):
+            return tuple(int(v) for v in self.offsets[index])
+        return tuple(self.offsets[index * 3:index * 3 + 3])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        if numpy is not None and isinstance(self.offsets, numpy.ndarray):
+            return len(self.offsets)
+        return len(self.offsets) // 3
+
+    def __repr__(self):
+        return '%s.%s(%r)' % (
+            self.__class__.__module__, self.__class__.__name__, list(self))
+
+class BlockOffsetList(Marshaler):
+    """A list of BlockOffset values, preceded by its length as a JavaInt.
+
+    If columnar is True, the value is read as a BlockOffsets instance instead
+    of a list of tuples. Either kind of value can be written.
+
+    """
+    def __init__(self, columnar=False, **kwargs):
+        super(BlockOffsetList, self).__init__(**kwargs)
+        self.columnar = columnar
+
+    @classmethod
+    def bytes_from(cls, value):
+        if not isinstance(value, BlockOffsets):
+            return Array.bytes_from(value, JavaInt, BlockOffset)
+        offsets = value.offsets
+        if numpy is not None and isinstance(offsets, numpy.ndarray):
+            offsets = offsets.reshape(-1)
+        return b''.join((JavaInt.bytes_from(len(value)),
+                        _column_bytes(offsets, JavaByte)))
+
+    @classmethod
+    def read_bytes(cls, reader, columnar=False):
+        length = JavaInt.read_bytes(reader)
+        reader.check_limit('max_array_length', length)
+        if not columnar:
+            # Unpack all the offsets in one go, then group them into tuples.
+            values = Array.read_bytes(reader, length * 3, JavaByte)
+            return list(zip(values[0::3], values[1::3], values[2::3]))
+        offsets = _read_column(reader, length * 3, JavaByte)
+        if numpy is not None:
+            offsets = offsets.reshape(-1, 3)
+        return BlockOffsets(offsets)
+
+    @classmethod
+    def skip_bytes(cls, reader):
+        length = JavaInt.read_bytes(reader)
+        reader.check_limit('max_array_length', length)
+        reader.skip(length * 3)
+
+    def read_value(self, packet, reader):
+        return self.read_bytes(reader, self.columnar)
 
 class Item(object):
     __slots__ = ['id', 'count', 'damage']
@@ -49,6 +282,9 @@ class Item(object):
         self.count = count
         self.damage = damage
 
+    def __eq__(self, other):
+        return _struct_eq(self, other)
+
     def __repr__(self):
         return _struct_repr(self)
 
@@ -72,6 +308,116 @@ class ItemData(Marshaler):
         else:
             return None
 
+    @classmethod
+    def skip_bytes(cls, reader):
+        if JavaShort.read_bytes(reader) >= 0:
+            # Skip count and damage.
+            reader.skip(3)
+
+class ItemStacks(object):
+    """A columnar list of items, where empty slots are None. The ids, counts
+    and damage values are kept in parallel arrays (NumPy arrays if NumPy is
+    available, otherwise array.array instances), with an id of -1 for empty
+    slots. Indexing or iterating creates the Item objects on the fly.
+
+    """
+    __slots__ = ['ids', 'counts', 'damage']
+
+    def __init__(self, ids, counts, damage):
+        self.ids = ids
+        self.counts = counts
+        self.damage = damage
+
+    @classmethod
+    def from_items(cls, items):
+        ids = [item.id if item else -1 for item in items]
+        counts = [item.count if item else 0 for item in items]
+        damage = [item.damage if item else 0 for item in items]
+        return cls(_column(ids, JavaShort), _column(counts, JavaByte),
+                   _column(damage, JavaShort))
+
+    def __getitem__(self, index):
+        id = int(self.ids[index])
+        if id < 0:
+            return None
+        return Item(id, int(self.counts[index]), int(self.damage[index]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return '%s.%s(%r)' % (
+            self.__class__.__module__, self.__class__.__name__, list(self))
+
+class ItemList(Marshaler):
+    """A list of ItemData values, preceded by its length.
+
+    If columnar is True, the value is read as an ItemStacks instance instead
+    of a list. Either kind of value can be written.
+
+    """
+    # The count and damage of an item that is not empty.
+    _count_damage = struct.Struct('>bh')
+
+    def __init__(self, length_type=JavaShort, columnar=False, **kwargs):
+        super(ItemList, self).__init__(**kwargs)
+        self.columnar = columnar
+        self.length_type = length_type
+
+    @classmethod
+    def bytes_from(cls, value, length_type=JavaShort):
+        if not isinstance(value, ItemStacks):
+            return Array.bytes_from(value, length_type, ItemData)
+
+        pieces = [length_type.bytes_from(len(value))]
+        ids, counts, damage = value.ids, value.counts, value.damage
+        if numpy is not None and isinstance(ids, numpy.ndarray):
+            ids = ids.tolist()
+            counts = counts.tolist()
+            damage = damage.tolist()
+        for i in range(len(ids)):
+            if ids[i] < 0:
+                pieces.append(JavaShort.bytes_from(-1))
+            else:
+                pieces.append(JavaShort.bytes_from(ids[i]))
+                pieces.append(cls._count_damage.pack(counts[i], damage[i]))
+        return b''.join(pieces)
+
+    @classmethod
+    def read_bytes(cls, reader, length_type=JavaShort, columnar=False):
+        if not columnar:
+            return Array.read_bytes(reader, length_type, ItemData)
+
+        length = length_type.read_bytes(reader)
+        reader.check_limit('max_array_length', length)
+        ids = [-1] * length
+        counts = [0] * length
+        damage = [0] * length
+        for i in range(length):
+            id = JavaShort.read_bytes(reader)
+            if id >= 0:
+                ids[i] = id
+                counts[i], damage[i] = reader.unpack(cls._count_damage)
+        return ItemStacks(_column(ids, JavaShort), _column(counts, JavaByte),
+                          _column(damage, JavaShort))
+
+    @classmethod
+    def skip_bytes(cls, reader, length_type=JavaShort):
+        Array.skip_bytes(reader, length_type, ItemData)
+
+    def bytes_for(self, packet):
+        return self.bytes_from(self.value_for(packet), self.length_type)
+
+    def read_value(self, packet, reader):
+        return self.read_bytes(reader, self.length_type, self.columnar)
+
+    def skip_value(self, reader):
+        self.skip_bytes(reader, self.length_type)
+
 class DynamicField(object):
     __slots__ = ['type', 'unknown', 'value']
 
@@ -128,7 +474,14 @@ class DynamicData(Marshaler):
             marshaler = DynamicData.get_marshaler(field.type)
             pieces.append(marshaler.bytes_from(field.value))
 
-        return ''.join(pieces + [JavaByte.bytes_from(127)])
+        return b''.join(pieces + [JavaByte.bytes_from(127)])
+
+    @classmethod
+    def skip_bytes(cls, reader):
+        x = JavaByte.read_bytes(reader)
+        while x != 127:
+            DynamicData.get_marshaler(x >> 5).skip_bytes(reader)
+            x = JavaByte.read_bytes(reader)
 
 class RelativeBlockChange(object):
     __slots__ = ['x', 'y', 'z', 'type', 'meta']
@@ -140,75 +493,409 @@ class RelativeBlockChange(object):
         self.type = type
         self.meta = meta
 
+    def __eq__(self, other):
+        return _struct_eq(self, other)
+
     def __repr__(self):
         return _struct_repr(self)
 
+class BlockChanges(object):
+    """A columnar list of relative block changes. The packed coordinates
+    (x << 12 | z << 8 | y), types and metadata are kept in parallel arrays
+    (NumPy arrays if NumPy is available, otherwise array.array instances).
+    Indexing or iterating creates RelativeBlockChange objects on the fly.
+
+    """
+    __slots__ = ['coords', 'types', 'meta']
+
+    def __init__(self, coords, types, meta):
+        self.coords = coords
+        self.types = types
+        self.meta = meta
+
+    @classmethod
+    def from_changes(cls, changes):
+        coords = [c.x << 12 | c.z << 8 | c.y for c in changes]
+        types = [c.type for c in changes]
+        meta = [c.meta for c in changes]
+        return cls(_column(coords, JavaShort), _column(types, JavaByte),
+                   _column(meta, JavaByte))
+
+    @property
+    def x(self):
+        if numpy is not None and isinstance(self.coords, numpy.ndarray):
+            return self.coords >> 12
+        return _column([s >> 12 for s in self.coords], JavaShort)
+
+    @property
+    def y(self):
+        if numpy is not None and isinstance(self.coords, numpy.ndarray):
+            return self.coords & 0xFF
+        return _column([s & 0xFF for s in self.coords], JavaShort)
+
+    @property
+    def z(self):
+        if numpy is not None and isinstance(self.coords, numpy.ndarray):
+            return self.coords >> 8 & 0xF
+        return _column([s >> 8 & 0xF for s in self.coords], JavaShort)
+
+    def __getitem__(self, index):
+        s = int(self.coords[index])
+        return RelativeBlockChange(s >> 12, s & 0xFF, s >> 8 & 0xF,
+                                   int(self.types[index]),
+                                   int(self.meta[index]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __repr__(self):
+        return '%s.%s(%r)' % (
+            self.__class__.__module__, self.__class__.__name__, list(self))
+
 class RelativeBlockChangeList(Marshaler):
+    """A list of RelativeBlockChange values.
+
+    If columnar is True, the value is read as a BlockChanges instance instead
+    of a list. Either kind of value can be written.
+
+    """
+    def __init__(self, columnar=False, **kwargs):
+        super(RelativeBlockChangeList, self).__init__(**kwargs)
+        self.columnar = columnar
+
     @classmethod
     def bytes_from(cls, value):
-        length = len(value)
+        if not isinstance(value, BlockChanges):
+            value = BlockChanges.from_changes(value)
 
-        # Pre-allocate list so it can be filled non-sequentially.
-        pieces = [None] * (1 + length * 3)
-        pieces[0] = JavaShort.bytes_from(len(value))
+        return b''.join((
+            JavaShort.bytes_from(len(value)),
+            _column_bytes(value.coords, JavaShort),
+            _column_bytes(value.types, JavaByte),
+            _column_bytes(value.meta, JavaByte)))
 
-        i = 0
-        for change in value:
-            s = change.x << 12 | change.z << 8 | change.y
-            pieces[1 + i] = JavaShort.bytes_from(s)
-            pieces[1 + i + length] = JavaByte.bytes_from(change.type)
-            pieces[1 + i + length + length] = JavaByte.bytes_from(change.meta)
-            i += 1
+    @classmethod
+    def read_bytes(cls, reader, columnar=False):
+        length = JavaShort.read_bytes(reader)
+        reader.check_limit('max_array_length', length)
+        coords = _read_column(reader, length, JavaShort)
+        types = _read_column(reader, length, JavaByte)
+        meta = _read_column(reader, length, JavaByte)
 
-        return ''.join(pieces)
+        changes = BlockChanges(coords, types, meta)
+        if columnar:
+            return changes
+        return list(changes)
 
     @classmethod
-    def read_bytes(cls, reader):
+    def skip_bytes(cls, reader):
         length = JavaShort.read_bytes(reader)
-        coords = Array.read_bytes(reader, length, JavaShort)
-        types = Array.read_bytes(reader, length, JavaByte)
-        meta = Array.read_bytes(reader, length, JavaByte)
+        reader.check_limit('max_array_length', length)
+        # Every change is a short for the coordinates and two bytes for type
+        # and metadata.
+        reader.skip(length * 4)
 
-        value = []
-        for i in xrange(length):
-            s = coords[i]
-            x, z, y = (s >> 12, s >> 8 & 0xF, s & 0xFF)
-            value.append(RelativeBlockChange(x, y, z, types[i], meta[i]))
-        return value
+    def read_value(self, packet, reader):
+        return self.read_bytes(reader, self.columnar)
+
+class CompressionCache(object):
+    """A least recently used cache of compressed data, keyed by a digest of
+    the uncompressed data. Entries are evicted once the total size of the
+    compressed data exceeds max_bytes. The cache can be used from several
+    threads at once.
+
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024, min_size=1024):
+        """Sets up a cache that holds up to max_bytes of compressed data. Data
+        shorter than min_size is not worth caching and is always compressed.
+
+        """
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        # The total size of the cached compressed data.
+        self.size = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def compress(self, value, compress, *args):
+        """Returns compress(value, *args), reusing the result from a previous
+        call with the same value and arguments if it's still cached.
+
+        """
+        if len(value) < self.min_size:
+            return compress(value, *args)
+
+        key = self.key(value, compress, *args)
+        data = self.get(key)
+        if data is None:
+            data = compress(value, *args)
+            self.put(key, data)
+        return data
+
+    def get(self, key):
+        """Returns the cached data for the specified key, or None.
+
+        """
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            # Move the entry to the end of the queue of entries to evict.
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def key(self, value, compress, *args):
+        """Returns the key for the result of compress(value, *args).
+
+        """
+        return (hashlib.sha1(value).digest(), compress, args)
+
+    def put(self, key, data):
+        with self._lock:
+            if len(data) > self.max_bytes or key in self._entries:
+                return
+
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                key, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '%s.%s(%d entries, %d bytes, %d hits, %d misses)' % (
+            self.__class__.__module__, self.__class__.__name__, len(self),
+            self.size, self.hits, self.misses)
 
 class ZlibData(Marshaler):
-    def __init__(self, length_type=JavaInt, use_gzip=False, **kwargs):
+    # Cache of compressed data that is shared by all ZlibData fields, since
+    # identical data (such as empty chunks) is common. Set to None to always
+    # compress.
+    cache = CompressionCache()
+
+    # The number of threads that compress_async and compress_many use, or None
+    # for the default of the thread pool implementation.
+    workers = None
+    _pool = None
+
+    def __init__(self, length_type=JavaInt, use_gzip=False, streaming=False,
+                 level=None, **kwargs):
+        """Initializes a field of compressed data, preceded by its compressed
+        length as length_type. The level is the compression level to use, or
+        None for the default level.
+
+        If streaming is True, the data is decompressed piece by piece as it
+        arrives instead of once all of it is available, so that the reader
+        doesn't have to hold on to the compressed data. The compressed data
+        is only kept (to be written again as-is) if the keep_compressed
+        option of the reader is set, in which case it counts towards the
+        max_pending limit of the reader.
+
+        """
         super(ZlibData, self).__init__(**kwargs)
         self.length_type = length_type
         self.gzip = use_gzip
+        self.level = level
+        self.streaming = streaming
 
     @classmethod
-    def bytes_from(cls, value, length_type=JavaInt, use_gzip=False):
+    def bytes_from(cls, value, length_type=JavaInt, use_gzip=False,
+                   level=None):
+        if cls.cache is None:
+            data = cls.compress(value, use_gzip, level)
+        else:
+            data = cls.cache.compress(value, cls.compress, use_gzip, level)
+        return length_type.bytes_from(len(data)) + data
+
+    @staticmethod
+    def compress(value, use_gzip=False, level=None):
+        """Returns the compressed bytes for the specified value. The same
+        value always gives the same bytes, so that cached data can be used
+        in its place.
+
+        """
         if use_gzip:
-            buffer = StringIO()
-            gz = gzip.GzipFile(None, mode='wb', fileobj=buffer)
-            gz.write(value)
-            gz.close()
-            data = length_type.bytes_from(buffer.tell()) + buffer.getvalue()
-            buffer.close()
-            return data
+            # Leave the time out of the gzip header.
+            return gzip.compress(value, 9 if level is None else level,
+                                 mtime=0)
+        else:
+            return zlib.compress(value, -1 if level is None else level)
+
+    @classmethod
+    def _compress_job(cls, value, use_gzip, level, wbits, key):
+        data = cls.compress(value, use_gzip, level)
+        if key is not None:
+            cls.cache.put(key, data)
+        return _Deflated(data, wbits, value)
+
+    @classmethod
+    def compress_async(cls, values, use_gzip=False, level=None):
+        """Starts compressing a sequence of values in parallel on a thread
+        pool, since zlib does not hold the interpreter lock while
+        compressing. Cached and repeated values are only compressed once.
+
+        Returns a list of concurrent.futures.Future instances in the same
+        order as the values, without waiting for any of them. The result of
+        every future can be assigned to ZlibData fields (with the same
+        use_gzip option) to have the fields write the compressed data
+        instead of compressing the value again. Futures of cached values are
+        done right away.
+
+        """
+        if use_gzip:
+            wbits = zlib.MAX_WBITS + 16
         else:
-            deflated = zlib.compress(value)
-            return length_type.bytes_from(len(deflated)) + deflated
+            wbits = zlib.MAX_WBITS
+
+        cache = cls.cache
+        futures = []
+        # The futures of the values that are cached or being compressed, by
+        # cache key.
+        jobs = {}
+        for value in values:
+            key = None
+            if cache is not None and len(value) >= cache.min_size:
+                key = cache.key(value, cls.compress, use_gzip, level)
+                future = jobs.get(key)
+                if future is not None:
+                    futures.append(future)
+                    continue
+                data = cache.get(key)
+                if data is not None:
+                    future = jobs[key] = _Future()
+                    future.set_result(_Deflated(data, wbits, value))
+                    futures.append(future)
+                    continue
+
+            if cls._pool is None:
+                ZlibData._pool = _ThreadPool(cls.workers)
+            future = ZlibData._pool.submit(cls._compress_job, value, use_gzip,
+                                           level, wbits, key)
+            if key is not None:
+                jobs[key] = future
+            futures.append(future)
+        return futures
 
     @classmethod
-    def read_bytes(cls, reader, length_type=JavaInt, use_gzip=False):
+    def compress_many(cls, values, use_gzip=False, level=None):
+        """Compresses a sequence of values like compress_async, but waits for
+        all of them. Returns a list of the results in the same order.
+
+        """
+        return [future.result()
+                for future in cls.compress_async(values, use_gzip, level)]
+
+    def __get__(self, instance, owner):
+        value = super(ZlibData, self).__get__(instance, owner)
+        if value.__class__ is _Deflated:
+            return value.value()
+        return value
+
+    @classmethod
+    def read_bytes(cls, reader, length_type=JavaInt, use_gzip=False,
+                   streaming=False):
+        """Reads compressed data. The value is returned as an object that
+        holds on to the compressed data, which ZlibData fields decompress when
+        the value is first accessed and write back out unchanged unless the
+        value is replaced.
+
+        """
+        if streaming:
+            return cls._read_stream(reader, length_type, use_gzip)
+
         length = length_type.read_bytes(reader)
         if use_gzip:
-            return zlib.decompress(reader.get(length), zlib.MAX_WBITS + 16)
+            return cls._read_all(reader, length, zlib.MAX_WBITS + 16)
         else:
-            return zlib.decompress(reader.get(length))
+            return cls._read_all(reader, length, zlib.MAX_WBITS)
+
+    @classmethod
+    def _read_all(cls, reader, length, wbits):
+        """Reads compressed data that is expected to be available in full.
+
+        """
+        # All the compressed data is held by the reader.
+        reader.check_limit('max_pending', length)
+        # The data is decompressed when it's first needed, within the
+        # max_decompressed_size limit of the reader.
+        return _Deflated(reader.get(length), wbits,
+                         limit=reader.max_decompressed_size)
+
+    @classmethod
+    def _read_stream(cls, reader, length_type, use_gzip):
+        """Decompresses as much of the data as is available. The state of the
+        decompression is kept as the partial value of the reader until all
+        the data has been decompressed.
+
+        """
+        state = reader.partial
+        if state is None:
+            length = length_type.read_bytes(reader)
+            if use_gzip:
+                wbits = zlib.MAX_WBITS + 16
+            else:
+                wbits = zlib.MAX_WBITS
+            if reader.available() >= length:
+                # All the data is already here, so read it in one go.
+                return cls._read_all(reader, length, wbits)
+            state = _Inflater(length, wbits, reader.keep_compressed)
+            reader.partial = state
+
+        num = min(state.remaining, reader.available())
+        if num:
+            data = reader.get(num)
+            state.decompress(data, reader)
+            state.remaining -= num
+            # The kept data is held on to just like pending data.
+            reader.check_limit('max_pending', state.kept)
+        if state.remaining:
+            # Continue as soon as there is more data.
+            reader.require(1)
+
+        reader.partial = None
+        return state.finish(reader)
+
+    @classmethod
+    def skip_bytes(cls, reader, length_type=JavaInt, use_gzip=False):
+        length = length_type.read_bytes(reader)
+        reader.check_limit('max_pending', length)
+        reader.skip(length)
 
     def bytes_for(self, packet):
-        return self.bytes_from(self.value_for(packet), self.length_type,
-            self.gzip)
+        if packet._pending is not None:
+            packet._decode()
+        try:
+            value = self._get(packet)
+        except AttributeError:
+            value = self.value_for(packet)
+        if value.__class__ is _Deflated:
+            # Pass on the data exactly as it was received.
+            return self.length_type.bytes_from(len(value.data)) + value.data
+        return self.bytes_from(value, self.length_type, self.gzip,
+                               self.level)
 
     def read_value(self, packet, reader):
-        return self.read_bytes(reader, self.length_type, self.gzip)
+        return self.read_bytes(reader, self.length_type, self.gzip,
+                               self.streaming)
+
+    def skip_value(self, reader):
+        self.skip_bytes(reader, self.length_type, self.gzip)
 
 __all__ = list(set(locals()) - __locals)
@@ -359,7 +359,7 @@ class ChunkData(PacketToClient):
     ubound_x = JavaByte()
     ubound_y = JavaByte()
     ubound_z = JavaByte()
-    data = ZlibData()
+    data = ZlibData(streaming=True)
 
 class MultiBlockChange(PacketToClient):
     id = 0x34
@@ -395,7 +395,7 @@ class Explode(PacketToClient):
     y = JavaDouble()
     z = JavaDouble()
     unknown = JavaFloat()
-    blocks = Array(JavaInt, BlockOffset)
+    blocks = BlockOffsetList()
 
 class InitializeWindow(PacketToClient):
     id = 0x64
@@ -438,7 +438,7 @@ class SetSlot(PacketToClient):
 class WindowItems(PacketToClient):
     id = 0x68
     window = JavaByte()
-    items = Array(JavaShort, ItemData)
+    items = ItemList()
 
 class SetProgressBar(PacketToClient):
     id = 0x69
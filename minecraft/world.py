@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""Module for working with the blocks of the world.
+
+This module requires NumPy, which is an optional dependency of the package.
+
+"""
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError('minecraft.world requires NumPy (pip install numpy)')
+
+from minecraft.packet import ChunkData
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+def _nibble(nibbles, index):
+    value = nibbles[index >> 1]
+    if index & 1:
+        return int(value >> 4)
+    else:
+        return int(value & 0x0F)
+
+def _set_nibble(nibbles, index, value):
+    i = index >> 1
+    if index & 1:
+        nibbles[i] = (nibbles[i] & 0x0F) | (value & 0x0F) << 4
+    else:
+        nibbles[i] = (nibbles[i] & 0xF0) | (value & 0x0F)
+
+__locals = set(locals())
+__locals.add('__locals')
+
+def pack_nibbles(values):
+    """Packs a sequence of 4-bit values into an array of bytes, two values per
+    byte with the first value in the low bits.
+
+    """
+    values = numpy.asarray(values, dtype=numpy.uint8).ravel()
+    assert len(values) % 2 == 0, 'Invalid number of nibbles'
+    return (values[0::2] & 0x0F) | (values[1::2] << 4)
+
+def unpack_nibbles(data):
+    """Unpacks an array (or byte string) of packed 4-bit values into an array
+    with one value per byte.
+
+    """
+    if not isinstance(data, numpy.ndarray):
+        data = numpy.frombuffer(data, dtype=numpy.uint8)
+    values = numpy.empty(len(data) * 2, dtype=numpy.uint8)
+    values[0::2] = data & 0x0F
+    values[1::2] = data >> 4
+    return values
+
+class Chunk(object):
+    """A cuboid of blocks, in the same layout as the data of a ChunkData
+    packet: the block types, followed by the metadata, block light and sky
+    light of the blocks as 4-bit values. The index of a block is
+    y + z * size_y + x * size_y * size_z.
+
+    All the data is kept in a single array, and blocks, metadata, block_light
+    and sky_light are views of it. The block types are shaped as
+    (size_x, size_z, size_y) while the other views hold packed 4-bit values
+    (see unpack_nibbles).
+
+    """
+    def __init__(self, x=0, y=0, z=0, size_x=16, size_y=128, size_z=16,
+                 data=None):
+        """Creates a chunk at the specified block position. The data is the
+        uncompressed data of a ChunkData packet. A bytes object is used
+        without being copied until the chunk is changed, while any other
+        buffer (such as a bytearray) is copied right away so that changes to
+        the chunk never show up in the buffer of the caller. If no data is
+        given, the chunk is filled with air and no light.
+
+        """
+        self.x = x
+        self.y = y
+        self.z = z
+        self.size = (size_x, size_y, size_z)
+
+        count = size_x * size_y * size_z
+        if data is None:
+            self._data = numpy.zeros(count * 5 // 2, dtype=numpy.uint8)
+        else:
+            assert len(data) == count * 5 // 2, 'Invalid data length'
+            # Converting to bytes only copies buffers that can change.
+            self._data = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+        self._set_views()
+
+    def _set_views(self):
+        size_x, size_y, size_z = self.size
+        count = size_x * size_y * size_z
+        half = count // 2
+        self.blocks = self._data[:count].reshape(size_x, size_z, size_y)
+        self.metadata = self._data[count:count + half]
+        self.block_light = self._data[count + half:count + half * 2]
+        self.sky_light = self._data[count + half * 2:]
+
+    def _index(self, x, y, z):
+        size_x, size_y, size_z = self.size
+        return y + z * size_y + x * size_y * size_z
+
+    def _writable(self):
+        # Data that came from a byte string is read-only, so copy it the first
+        # time the chunk is changed.
+        if not self._data.flags.writeable:
+            self._data = self._data.copy()
+            self._set_views()
+
+    @classmethod
+    def from_packet(cls, packet):
+        """Creates a chunk from a ChunkData packet.
+
+        """
+        return cls(packet.x, packet.y, packet.z, packet.ubound_x + 1,
+                   packet.ubound_y + 1, packet.ubound_z + 1, packet.data)
+
+    def get_block(self, x, y, z):
+        """Returns the block type at the specified position, relative to the
+        chunk.
+
+        """
+        return int(self.blocks[x, z, y])
+
+    def get_block_light(self, x, y, z):
+        return _nibble(self.block_light, self._index(x, y, z))
+
+    def get_metadata(self, x, y, z):
+        return _nibble(self.metadata, self._index(x, y, z))
+
+    def get_sky_light(self, x, y, z):
+        return _nibble(self.sky_light, self._index(x, y, z))
+
+    def set_block(self, x, y, z, type, metadata=None):
+        """Sets the block type (and optionally the metadata) at the specified
+        position, relative to the chunk.
+
+        """
+        self._writable()
+        self.blocks[x, z, y] = type
+        if metadata is not None:
+            _set_nibble(self.metadata, self._index(x, y, z), metadata)
+
+    def set_block_light(self, x, y, z, value):
+        self._writable()
+        _set_nibble(self.block_light, self._index(x, y, z), value)
+
+    def set_metadata(self, x, y, z, value):
+        self._writable()
+        _set_nibble(self.metadata, self._index(x, y, z), value)
+
+    def set_sky_light(self, x, y, z, value):
+        self._writable()
+        _set_nibble(self.sky_light, self._index(x, y, z), value)
+
+    def to_bytes(self):
+        """Returns the chunk as the uncompressed data of a ChunkData packet.
+
+        """
+        return self._data.tobytes()
+
+    def to_packet(self):
+        """Returns a ChunkData packet for the chunk.
+
+        """
+        size_x, size_y, size_z = self.size
+        return ChunkData(x=self.x, y=self.y, z=self.z, ubound_x=size_x - 1,
+                         ubound_y=size_y - 1, ubound_z=size_z - 1,
+                         data=self.to_bytes())
+
+    def __repr__(self):
+        return '%s.%s(%d, %d, %d, %d, %d, %d)' % (
+            self.__class__.__module__, self.__class__.__name__, self.x,
+            self.y, self.z, self.size[0], self.size[1], self.size[2])
+
+__all__ = list(set(locals()) - __locals)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the capture files of autoproto.capture.
+
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from autoproto.capture import Capture, CaptureWriter, FlightRecorder
+from autoproto.packet import TO_CLIENT, TO_SERVER
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+def _packets(count):
+    """Returns (direction, packet id, data) tuples of count packets.
+
+    """
+    packets = []
+    for i in range(count):
+        packet_id = (0x03, 0x0D, 0x33)[i % 3]
+        direction = TO_SERVER if i % 2 else TO_CLIENT
+        data = bytes([packet_id]) + bytes([i % 256]) * (i % 50)
+        packets.append((direction, packet_id, data))
+    return packets
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, packets, name='test.cap'):
+        path = os.path.join(self.dir, name)
+        with CaptureWriter(path, start_time=1000.0) as writer:
+            for i, (direction, packet_id, data) in enumerate(packets):
+                writer.write_bytes(direction, packet_id, data, 1000.0 + i)
+        return path
+
+    def _unclosed(self, packets):
+        """Writes a capture without its index, as if the process writing it
+        had been killed in the middle of a record.
+
+        """
+        path = self._write(packets)
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        index_offset = struct.unpack('>Q', data[-12:-4])[0]
+        with open(path, 'wb') as fh:
+            fh.write(data[:index_offset] + b'\x00' * 7)
+        return path
+
+    def _read(self, capture, **kwargs):
+        records = []
+        for t, direction, data in capture.records(**kwargs):
+            records.append((t, direction, bytes(data)))
+            data.release()
+        return records
+
+    def test_round_trip(self):
+        packets = _packets(30)
+        path = self._write(packets)
+        with Capture(path) as capture:
+            self.assertTrue(capture.complete)
+            self.assertEqual(capture.start_time, 1000.0)
+            self.assertEqual(len(capture), 30)
+            self.assertEqual(capture.duration, 29.0)
+            self.assertEqual(self._read(capture), [
+                (float(i), direction, data)
+                for i, (direction, packet_id, data) in enumerate(packets)])
+            self.assertEqual(
+                sorted(capture.index),
+                sorted(set((d, packet_id) for d, packet_id, _ in packets)))
+
+    def test_unclosed(self):
+        packets = _packets(30)
+        path = self._unclosed(packets)
+        with Capture(path) as capture:
+            self.assertFalse(capture.complete)
+            # The partial record at the end is left out.
+            self.assertEqual(len(capture), 30)
+            self.assertEqual(capture.duration, 29.0)
+            self.assertEqual([(d, data) for t, d, data in self._read(capture)],
+                             [(d, data) for d, packet_id, data in packets])
+        # The rebuilt index is the same as the index of a closed capture.
+        with Capture(self._write(packets, 'closed.cap')) as capture:
+            index = capture.index
+        with Capture(path) as capture:
+            self.assertEqual(capture.index, index)
+
+    def test_filtered_records(self):
+        packets = _packets(60)
+        path = self._write(packets)
+        with Capture(path) as capture:
+            start, end = capture.split(600)[1]
+            all_records = self._read(capture, start=start, end=end)
+            self.assertTrue(0 < len(all_records) < 60)
+
+            records = self._read(capture, start=start, end=end,
+                                 packet_ids={0x03, 0x33})
+            self.assertEqual(records, [r for r in all_records
+                                       if r[2][0] in (0x03, 0x33)])
+            records = self._read(capture, direction=TO_SERVER,
+                                 packet_ids={0x0D})
+            self.assertEqual(
+                [data for t, d, data in records],
+                [data for d, packet_id, data in packets
+                 if d == TO_SERVER and packet_id == 0x0D])
+            records = self._read(capture, direction=TO_CLIENT)
+            self.assertEqual(len(records), 30)
+
+    def _check_split(self, path, packets):
+        with Capture(path) as capture:
+            ranges = capture.split(500)
+            self.assertIsNone(capture._index)
+        self.assertGreater(len(ranges), 2)
+        for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_start)
+
+        records = []
+        for start, end in ranges:
+            # A new instance for every range, like the analyzer processes.
+            with Capture(path) as capture:
+                for t, direction, data in capture.records(start=start,
+                                                          end=end):
+                    records.append((direction, data[0], bytes(data)))
+                    data.release()
+                self.assertIsNone(capture._index)
+                if not capture.complete:
+                    # The end of the records was not looked for either.
+                    self.assertIsNone(capture._end)
+        self.assertEqual(records, packets)
+
+    def test_split(self):
+        packets = _packets(100)
+        self._check_split(self._write(packets), packets)
+
+    def test_split_unclosed(self):
+        packets = _packets(100)
+        self._check_split(self._unclosed(packets), packets)
+
+class FlightRecorderTest(unittest.TestCase):
+    def test_frames_wrap_around(self):
+        recorder = FlightRecorder(frames=4, size=1024)
+        for i, (direction, packet_id, data) in enumerate(_packets(10)):
+            recorder.write_bytes(direction, packet_id, data, 100.0 + i)
+        self.assertEqual(recorder.count, 10)
+        self.assertEqual(recorder.packets(), [
+            (100.0 + i, direction, packet_id, data)
+            for i, (direction, packet_id, data)
+            in enumerate(_packets(10)) if i >= 6])
+
+    def test_data_wraps_around(self):
+        recorder = FlightRecorder(frames=8, size=100)
+        for i in range(6):
+            recorder.write_bytes(TO_CLIENT, 0x03, bytes([3, i]) * 15)
+        # A packet that doesn't fit in the buffer is only counted.
+        recorder.write_bytes(TO_CLIENT, 0x33, b'\x33' * 101)
+        recorder.write_bytes(TO_SERVER, 0x0D, b'\x0d' * 10)
+        data = [p[3] for p in recorder.packets()]
+        # Only the three most recent messages still fit in the buffer.
+        self.assertEqual(data, [None, None, None] +
+                         [bytes([3, i]) * 15 for i in (3, 4, 5)] +
+                         [None, b'\x0d' * 10])
+
+    def test_dump(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'flight.cap')
+            recorder = FlightRecorder(frames=4, size=64, path=path)
+            for i in range(6):
+                recorder.write_bytes(TO_CLIENT, 0x03, bytes([3, i]) * 10,
+                                     500.0 + i)
+            # The data of the oldest of the four packets has been
+            # overwritten.
+            self.assertEqual(recorder.dump(), 3)
+            with Capture(path) as capture:
+                self.assertEqual(capture.start_time, 503.0)
+                records = [(t, d, bytes(data))
+                           for t, d, data in capture.records()]
+            self.assertEqual(records, [
+                (float(i - 3), TO_CLIENT, bytes([3, i]) * 10)
+                for i in (3, 4, 5)])
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
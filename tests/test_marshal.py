@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the Marshaler types of autoproto.marshal and minecraft.marshal.
+
+"""
+
+import inspect
+import unittest
+import zlib
+
+from autoproto.marshal import Array, Marshaler
+from autoproto.marshal.java import *
+from autoproto.packet import BufferReader, LimitExceeded, NotAvailableYet
+from minecraft.marshal import *
+from minecraft.packet import *
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+class MarshalerTest(unittest.TestCase):
+    def test_field_on_class(self):
+        self.assertIsInstance(ChatMessage.message, Marshaler)
+        self.assertTrue(hasattr(ChatMessage, 'message'))
+        self.assertIsInstance(ChunkData.data, ZlibData)
+        members = dict(inspect.getmembers(ChatMessage))
+        self.assertIs(members['message'], ChatMessage.message)
+
+    def test_missing_value(self):
+        self.assertRaises(AttributeError, getattr, ChatMessage(), 'message')
+
+def _round_trip(packet):
+    cls = packet.__class__
+    packet = cls.from_bytes(packet.build())
+    packet._decode()
+    return packet
+
+class ListTest(unittest.TestCase):
+    def test_array_requires_all_items(self):
+        blocks = [(1, 2, 3)] * 10
+        data = Array.bytes_from(blocks, JavaInt, BlockOffset)
+        reader = BufferReader(data[:-1])
+        with self.assertRaises(NotAvailableYet):
+            Array.read_bytes(reader, JavaInt, BlockOffset)
+        self.assertEqual(reader._wanted, len(data))
+        reader = BufferReader(data)
+        self.assertEqual(Array.read_bytes(reader, JavaInt, BlockOffset),
+                         blocks)
+
+    def test_window_items(self):
+        items = [None, Item(276, 1, 12), Item(1, 64, 0), None]
+        p = WindowItems(window=0, items=items)
+        q = _round_trip(p)
+        self.assertEqual(q.items, p.items)
+        self.assertEqual(q.items[0:2], items[0:2])
+
+    def test_block_changes(self):
+        changes = [RelativeBlockChange(1, 64, 2, 4, 0),
+                   RelativeBlockChange(7, 127, 15, 1, 3)]
+        p = MultiBlockChange(x=0, z=0, changes=changes)
+        q = _round_trip(p)
+        self.assertEqual(q.changes, changes)
+        self.assertEqual(q.changes[1:], changes[1:])
+
+    def test_explode(self):
+        blocks = [(1, -2, 3), (0, 0, -1)]
+        p = Explode(x=0.0, y=64.0, z=0.0, unknown=1.0, blocks=blocks)
+        self.assertEqual(_round_trip(p).blocks, blocks)
+
+    def test_columnar_option(self):
+        items = [None, Item(276, 1, 12)]
+        p = WindowItems(window=0, items=items)
+        WindowItems.items.columnar = True
+        try:
+            q = _round_trip(p)
+        finally:
+            WindowItems.items.columnar = False
+        self.assertIsInstance(q.items, ItemStacks)
+        self.assertEqual(list(q.items), items)
+
+class CompressionCacheTest(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = CompressionCache(min_size=100)
+        value = b'\x29' * 64 + b'\x00' * 64
+        for use_gzip in (False, True):
+            for level in (1, 9):
+                data = cache.compress(value, ZlibData.compress, use_gzip,
+                                      level)
+                self.assertEqual(data,
+                                 ZlibData.compress(value, use_gzip, level))
+                self.assertIs(cache.compress(value, ZlibData.compress,
+                                             use_gzip, level), data)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (4, 4, 4))
+
+        # Short values are not cached.
+        cache.compress(b'short', ZlibData.compress)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (4, 4, 4))
+
+    def test_least_recently_used_is_evicted(self):
+        values = [bytes([i]) * 1000 for i in range(3)]
+        size = len(ZlibData.compress(values[0]))
+        cache = CompressionCache(max_bytes=size * 2, min_size=0)
+        cache.compress(values[0], ZlibData.compress)
+        cache.compress(values[1], ZlibData.compress)
+        # Use the first value, so that the second one is evicted next.
+        cache.compress(values[0], ZlibData.compress)
+        cache.compress(values[2], ZlibData.compress)
+        self.assertEqual((len(cache), cache.size, cache.evictions),
+                         (2, size * 2, 1))
+        for value, cached in zip(values, (True, False, True)):
+            key = cache.key(value, ZlibData.compress)
+            self.assertEqual(cache.get(key) is not None, cached)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_fields_use_cache(self):
+        old_cache = ZlibData.cache
+        ZlibData.cache = CompressionCache()
+        try:
+            data = b'\x29' * 4096
+            p = ChunkData(x=0, y=0, z=0, ubound_x=15, ubound_y=127,
+                          ubound_z=15, data=data)
+            wire = p.build()
+            self.assertEqual(p.build(), wire)
+            self.assertEqual((ZlibData.cache.hits, ZlibData.cache.misses),
+                             (1, 1))
+            ZlibData.cache = None
+            self.assertEqual(p.build(), wire)
+        finally:
+            ZlibData.cache = old_cache
+
+class LengthTest(unittest.TestCase):
+    def _check(self, data, read, skip, limits=None):
+        self.assertRaises(LimitExceeded, read, BufferReader(data, limits))
+        self.assertRaises(LimitExceeded, skip, BufferReader(data, limits))
+
+    def test_negative_lengths(self):
+        for item_type in (JavaShort, BlockOffset, ItemData):
+            self._check(
+                b'\xff\xff\xff\xff' + b'\x00' * 12,
+                lambda r: Array.read_bytes(r, JavaInt, item_type),
+                lambda r: Array.skip_bytes(r, JavaInt, item_type))
+        self._check(b'\xff\xff' + b'x' * 4, JavaString.read_bytes,
+                    JavaString.skip_bytes)
+        self._check(b'\xff\xff\xff\xfe' + b'\x00' * 12,
+                    BlockOffsetList.read_bytes, BlockOffsetList.skip_bytes)
+        self._check(b'\xff\xfe' + b'\x00' * 12,
+                    RelativeBlockChangeList.read_bytes,
+                    RelativeBlockChangeList.skip_bytes)
+        self._check(b'\xff\xff\xff\xff' + b'\x00' * 12,
+                    ZlibData.read_bytes, ZlibData.skip_bytes)
+
+    def test_limits_when_skipping(self):
+        limits = {'max_array_length': 2, 'max_string_length': 2}
+        self._check(Array.bytes_from([1, 2, 3], JavaInt, JavaShort),
+                    lambda r: Array.read_bytes(r, JavaInt, JavaShort),
+                    lambda r: Array.skip_bytes(r, JavaInt, JavaShort),
+                    limits)
+        self._check(JavaString.bytes_from('abc'), JavaString.read_bytes,
+                    JavaString.skip_bytes, limits)
+        self._check(BlockOffsetList.bytes_from([(0, 0, 0)] * 3),
+                    BlockOffsetList.read_bytes, BlockOffsetList.skip_bytes,
+                    limits)
+
+        reader = BufferReader(JavaString.bytes_from('ab'), limits)
+        JavaString.skip_bytes(reader)
+        self.assertEqual(reader.available(), 0)
+
+class ZlibDataTest(unittest.TestCase):
+    def test_compress_async(self):
+        values = [b'a' * 4096, b'b' * 10, b'a' * 4096, b'c' * 2048]
+        futures = ZlibData.compress_async(values)
+        self.assertEqual(len(futures), len(values))
+        for future, value in zip(futures, values):
+            self.assertEqual(zlib.decompress(future.result().data), value)
+            self.assertEqual(future.result().value(), value)
+        # Values that are cached are done right away.
+        for future in ZlibData.compress_async(values[:1]):
+            self.assertTrue(future.done())
+        self.assertEqual([future.result().data for future in futures],
+                         [d.data for d in ZlibData.compress_many(values)])
+
+    def test_compressed_value_in_packet(self):
+        data = b'\x29' * 4096
+        value = ZlibData.compress_async([data])[0].result()
+        p = ChunkData(x=0, y=0, z=0, ubound_x=15, ubound_y=127, ubound_z=15)
+        p.data = value
+        self.assertEqual(_round_trip(p).data, data)
+
+if __name__ == '__main__':
+    unittest.main()
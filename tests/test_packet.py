@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for reading and writing packets with autoproto.packet.
+
+"""
+
+import random
+import struct
+import unittest
+import zlib
+
+import autoproto.marshal.java
+from autoproto.marshal.java import *
+import autoproto.packet
+from autoproto.packet import LimitExceeded, PacketToClient, TO_CLIENT, \
+                             TO_SERVER
+from minecraft.marshal import ZlibData
+from minecraft.packet import *
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+def _reader(direction=TO_CLIENT, **kwargs):
+    return autoproto.packet.PacketReader(
+        autoproto.marshal.java.JavaUByte, direction, **kwargs)
+
+class _StreamedData(PacketToClient):
+    """A packet with fields after a streamed ZlibData field.
+
+    """
+    id = 0xFE
+    before = JavaShort()
+    data = ZlibData(streaming=True)
+    after = JavaInt()
+    name = JavaString()
+
+class PacketReaderTest(unittest.TestCase):
+    def test_reserve_is_capped_by_received_data(self):
+        # An Explode header that claims 100,000,000 block offsets.
+        header = struct.pack('>Bdddfi', Explode.id, 0.0, 64.0, 0.0, 1.0,
+                             100000000)
+        reader = _reader()
+        self.assertEqual(reader.read(header), [])
+        self.assertEqual(reader.read(b'\x00'), [])
+        self.assertLessEqual(len(reader.buffer), 4 * reader.max_reserve)
+
+    def test_fields_after_streamed_field(self):
+        rand = random.Random(0)
+        data = bytes(rand.randrange(256) for i in range(20000))
+        packet = _StreamedData(before=-5, data=data, after=123456,
+                               name='after')
+        wire = packet.build() * 3
+        for size in (1, 7, 1000, 4096):
+            reader = _reader()
+            packets = []
+            for i in range(0, len(wire), size):
+                packets += reader.read(wire[i:i + size])
+            self.assertEqual(len(packets), 3)
+            for p in packets:
+                self.assertEqual((p.before, p.data, p.after, p.name),
+                                 (-5, data, 123456, 'after'))
+
+    def test_lazy_packets_keep_limits(self):
+        kwargs = dict(x=0, y=0, z=0, ubound_x=15, ubound_y=127, ubound_z=15)
+        wire = (ChunkData(data=b'\x00' * 1000000, **kwargs).build() +
+                ChunkData(data=b'\x29' * 100, **kwargs).build())
+        reader = _reader(lazy=True, max_decompressed_size=1000,
+                         max_string_length=10)
+        bomb, chunk = reader.read(wire)
+        # The packets are passed on as they were without being decoded.
+        self.assertEqual(bomb.build() + chunk.build(), wire)
+        self.assertRaises(LimitExceeded, getattr, bomb, 'data')
+        self.assertEqual(chunk.data, b'\x29' * 100)
+
+        # Lengths are checked while finding the end of the packet.
+        reader = _reader(lazy=True, max_string_length=10)
+        self.assertRaises(LimitExceeded, reader.read,
+                          ChatMessage(message='x' * 11).build())
+        reader = _reader(lazy=True, max_array_length=1)
+        self.assertRaises(LimitExceeded, reader.read, Explode(
+            x=0.0, y=0.0, z=0.0, unknown=1.0, blocks=[(0, 0, 0)] * 2).build())
+
+    def _read_streamed(self, reader, wire, size=8192):
+        packets = []
+        for i in range(0, len(wire), size):
+            packets += reader.read(wire[i:i + size])
+            if reader.partial is not None:
+                compressed = reader.partial.compressed
+                held = sum(map(len, compressed)) if compressed else 0
+                self.assertLessEqual(held, reader.max_pending or held)
+        return packets
+
+    def test_streamed_data_is_not_kept(self):
+        rand = random.Random(1)
+        data = bytes(rand.randrange(256) for i in range(100000))
+        wire = _StreamedData(before=0, data=data, after=0,
+                             name='').build()
+        reader = _reader()
+        packets = self._read_streamed(reader, wire)
+        self.assertEqual(packets[0].data, data)
+        self.assertIsInstance(packets[0]._v_data, bytes)
+
+        reader = _reader()
+        reader.keep_compressed = True
+        packets = self._read_streamed(reader, wire)
+        self.assertEqual(packets[0].data, data)
+        # The compressed data is written again as it was received.
+        self.assertEqual(packets[0].build(), wire)
+
+    def test_kept_data_counts_towards_max_pending(self):
+        rand = random.Random(2)
+        data = bytes(rand.randrange(256) for i in range(100000))
+        wire = _StreamedData(before=0, data=data, after=0,
+                             name='').build()
+        reader = _reader(max_pending=65536)
+        self.assertEqual(len(self._read_streamed(reader, wire)), 1)
+
+        reader = _reader(max_pending=65536)
+        reader.keep_compressed = True
+        self.assertRaises(autoproto.packet.LimitExceeded,
+                          self._read_streamed, reader, wire)
+
+    def test_truncated_data(self):
+        rand = random.Random(3)
+        data = bytes(rand.randrange(256) for i in range(20000))
+        compressed = zlib.compress(data)[:-100]
+        wire = (struct.pack('>BhI', _StreamedData.id, 0, len(compressed)) +
+                compressed + struct.pack('>ih', 0, 0))
+        # Data that arrives in pieces is decompressed as it's read.
+        self.assertRaises(zlib.error, self._read_streamed, _reader(), wire,
+                          100)
+
+        # Data that is available in full is decompressed when it's used.
+        chunk = ChunkData(x=0, y=0, z=0, ubound_x=15, ubound_y=127,
+                          ubound_z=15, data=data).build()
+        header = 1 + 4 + 2 + 4 + 3
+        compressed = chunk[header + 4:-100]
+        wire = (chunk[:header] + struct.pack('>i', len(compressed)) +
+                compressed)
+        for limit in (None, 65536):
+            packet, = _reader(max_decompressed_size=limit).read(wire)
+            self.assertRaises(zlib.error, getattr, packet, 'data')
+
+    def test_large_packet_in_pieces(self):
+        data = bytes(range(256)) * 1024
+        packet = ChunkData(x=0, y=0, z=0, ubound_x=15, ubound_y=127,
+                           ubound_z=15, data=data)
+        wire = packet.build()
+        reader = _reader()
+        packets = []
+        for i in range(0, len(wire), 1000):
+            packets += reader.read(wire[i:i + 1000])
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(packets[0].data, data)
+
+    def test_sequence_in_single_bytes(self):
+        blocks = [(i % 7, -i % 5, i % 3) for i in range(512)]
+        wire = Explode(x=0.0, y=64.0, z=0.0, unknown=1.0,
+                       blocks=blocks).build()
+        # The packet id, the position, the radius and the number of blocks.
+        header = 1 + 3 * 8 + 4 + 4
+        reader = _reader()
+        for i in range(header):
+            self.assertEqual(reader.read(wire[i:i + 1]), [])
+        # The reader waits for all the blocks instead of trying again for
+        # every byte.
+        self.assertEqual(reader._wanted - reader.size, len(wire) - header)
+        packets = []
+        for i in range(header, len(wire)):
+            packets += reader.read(wire[i:i + 1])
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(packets[0].blocks, blocks)
+
+class StatsTest(unittest.TestCase):
+    def test_record_stats(self):
+        classes = (ChatMessage, KeepAlive, MoveAndLook)
+        methods = [(cls.__dict__['build'], cls.__dict__['_read'])
+                   for cls in classes]
+        # Two chat messages of 4 and 5 bytes and a keep-alive of 1 byte.
+        wire = (ChatMessage(message='a').build() +
+                ChatMessage(message='bb').build() + KeepAlive().build())
+        packet = MoveAndLook(TO_SERVER, x=0.0, y=64.0, stance=65.62, z=0.0,
+                             yaw=0.0, pitch=0.0, on_ground=True)
+
+        stats = autoproto.packet.PacketStats()
+        previous = autoproto.packet.record_stats(stats)
+        try:
+            reader = _reader()
+            # The second chat message arrives in two pieces.
+            reader.read(wire[:5])
+            reader.read(wire[5:])
+            packet.build()
+            autoproto.packet.PacketWriter().write(packet)
+        finally:
+            autoproto.packet.record_stats(previous)
+
+        entries = stats.entries
+        chat = entries[ChatMessage, TO_CLIENT]
+        self.assertEqual((chat['decoded'], chat['decoded_bytes'],
+                          chat['read_calls'], chat['encoded']), (2, 9, 3, 0))
+        keep_alive = entries[KeepAlive, TO_CLIENT]
+        self.assertEqual((keep_alive['decoded'], keep_alive['decoded_bytes'],
+                          keep_alive['read_calls']), (1, 1, 1))
+        move = entries[MoveAndLook, TO_SERVER]
+        # Once by build and once by the writer.
+        self.assertEqual((move['decoded'], move['encoded'],
+                          move['encoded_bytes']),
+                         (0, 2, 2 * len(packet.build())))
+        self.assertEqual(len(stats.report()), 3)
+
+        # The original methods are back once recording stops.
+        self.assertEqual([(cls.__dict__['build'], cls.__dict__['_read'])
+                          for cls in classes], methods)
+        packet.build()
+        _reader().read(wire)
+        self.assertEqual(len(stats.entries), 3)
+        self.assertEqual(stats.entries[MoveAndLook, TO_SERVER]['encoded'], 2)
+
+class _Sink(object):
+    """A socket that accepts all the data it's given.
+
+    """
+    def __init__(self):
+        self.data = bytearray()
+
+    def sendmsg(self, buffers):
+        num = 0
+        for buf in buffers:
+            self.data += buf
+            num += len(buf)
+        return num
+
+    send = sendmsg
+
+class PacketWriterTest(unittest.TestCase):
+    def _flush(self, writer):
+        sink = _Sink()
+        while writer.pending:
+            writer.flush(sink)
+        return bytes(sink.data)
+
+    def test_more_than_buffer_without_flush(self):
+        writer = autoproto.packet.PacketWriter()
+        sent = []
+        for i in range(1000):
+            packet = MoveAndLook(x=float(i), y=64.0, stance=65.62, z=-i,
+                                 yaw=1.0, pitch=2.0, on_ground=i % 2 == 0)
+            sent.append(packet)
+            writer.write(packet)
+        self.assertGreater(writer.pending, writer.initial_size)
+
+        received = _reader(TO_SERVER).read(self._flush(writer))
+        self.assertEqual(len(received), len(sent))
+        for a, b in zip(sent, received):
+            self.assertIsInstance(b, MoveAndLook)
+            self.assertEqual(b.build(), a.build())
+
+    def test_failed_write_adds_nothing(self):
+        writer = autoproto.packet.PacketWriter()
+        writer.write(KeepAlive())
+        # The packet is missing a value.
+        self.assertRaises(AttributeError, writer.write,
+                          MoveAndLook(x=0.0, y=64.0, stance=65.62, z=0.0))
+        # The value is out of range.
+        self.assertRaises(struct.error, writer.write, TeleportEntity(
+            entity_id=1, x=0, y=0, z=0, yaw=1000, pitch=0))
+        writer.write(ChatMessage(message='hi'))
+        received = _reader(TO_SERVER).read(self._flush(writer))
+        self.assertEqual([p.__class__ for p in received],
+                         [KeepAlive, ChatMessage])
+
+    def test_shared_frame(self):
+        packet = ChatMessage(message='§eSomeone joined the game')
+        frame = autoproto.packet.Frame.from_packet(packet)
+        self.assertEqual(frame.build(), packet.build())
+        self.assertIs(frame.packet_class, ChatMessage)
+
+        writers = [autoproto.packet.PacketWriter() for i in range(3)]
+        for writer in writers:
+            writer.write(frame)
+            writer.write(KeepAlive())
+        for writer in writers:
+            self.assertEqual(self._flush(writer),
+                             packet.build() + KeepAlive().build())
+
+        # No connection can change the frame for the others.
+        self.assertRaises(AttributeError, setattr, frame, 'data', b'')
+        self.assertRaises(AttributeError, setattr, frame, 'suppressed', True)
+        self.assertRaises(TypeError, frame.suppress)
+        copy = frame.copy()
+        copy.suppress()
+        self.assertTrue(copy.suppressed)
+        self.assertFalse(frame.suppressed)
+        self.assertEqual(copy.build(), frame.build())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the chunks of minecraft.world, which require NumPy.
+
+"""
+
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from minecraft.packet import ChunkData
+
+if numpy is not None:
+    from minecraft.world import Chunk, pack_nibbles, unpack_nibbles
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class ChunkTest(unittest.TestCase):
+    def test_nibbles(self):
+        values = [1, 2, 15, 0, 7, 8]
+        packed = pack_nibbles(values)
+        self.assertEqual(packed.tobytes(), b'\x21\x0f\x87')
+        self.assertEqual(unpack_nibbles(packed).tolist(), values)
+        self.assertEqual(unpack_nibbles(b'\x21\x0f\x87').tolist(), values)
+
+    def test_blocks(self):
+        chunk = Chunk(size_x=2, size_y=4, size_z=2)
+        self.assertEqual(chunk.get_block(1, 3, 1), 0)
+        chunk.set_block(1, 3, 1, 41, metadata=5)
+        chunk.set_block(0, 1, 1, 1)
+        chunk.set_sky_light(1, 2, 0, 15)
+        chunk.set_block_light(0, 0, 0, 9)
+        self.assertEqual(chunk.get_block(1, 3, 1), 41)
+        self.assertEqual(chunk.get_metadata(1, 3, 1), 5)
+        self.assertEqual(chunk.get_block(0, 1, 1), 1)
+        self.assertEqual(chunk.get_metadata(0, 1, 1), 0)
+        self.assertEqual(chunk.get_sky_light(1, 2, 0), 15)
+        self.assertEqual(chunk.get_block_light(0, 0, 0), 9)
+        # The index of a block is y + z * size_y + x * size_y * size_z.
+        data = chunk.to_bytes()
+        self.assertEqual(data[3 + 1 * 4 + 1 * 8], 41)
+        self.assertEqual(data[16 + (3 + 4 + 8) // 2] >> 4, 5)
+
+    def test_packet_round_trip(self):
+        data = bytes(range(256)) * 2 + b'\x00' * 128
+        packet = ChunkData(x=32, y=0, z=-16, ubound_x=3, ubound_y=15,
+                           ubound_z=3, data=data)
+        packet = ChunkData.from_bytes(packet.build())
+        chunk = Chunk.from_packet(packet)
+        self.assertEqual((chunk.x, chunk.y, chunk.z), (32, 0, -16))
+        self.assertEqual(chunk.size, (4, 16, 4))
+        self.assertEqual(chunk.get_block(0, 5, 0), 5)
+        chunk.set_block(0, 5, 0, 20)
+
+        copy = ChunkData.from_bytes(chunk.to_packet().build())
+        self.assertEqual((copy.x, copy.z, copy.ubound_y), (32, -16, 15))
+        self.assertEqual(copy.data, b'\x00\x01\x02\x03\x04\x14' + data[6:])
+        # The data of the original packet was not changed.
+        self.assertEqual(packet.data, data)
+
+    def test_data_is_not_shared(self):
+        data = bytearray(2 * 2 * 2 * 5 // 2)
+        chunk = Chunk(size_x=2, size_y=2, size_z=2, data=data)
+        chunk.set_block(0, 0, 0, 3)
+        data[1] = 7
+        self.assertEqual(data[0], 0)
+        self.assertEqual(chunk.get_block(0, 0, 0), 3)
+        self.assertEqual(chunk.get_block(0, 1, 0), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the wrapper example (example.wrapper).
+
+"""
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+try:
+    # The wrapper is built on asyncore, which needs the pyasyncore package on
+    # Python 3.12 or later.
+    import example.wrapper
+    from example.wrapper import config
+except ImportError:
+    example = None
+
+__author__ = 'andreas@blixt.org (Andreas Blixt)'
+
+class _Client(object):
+    """A proxy that collects the packets sent to either side.
+
+    """
+    def __init__(self):
+        self.packets = []
+        self.other = self
+
+@unittest.skipIf(example is None, 'asyncore is not available')
+class WrapperTest(unittest.TestCase):
+    def setUp(self):
+        self.wrapper = example.wrapper.MinecraftWrapper(
+            ('127.0.0.1', 1), ('127.0.0.1', 0))
+        self.client = _Client()
+        self.player = example.wrapper.Player(self.client, self.wrapper)
+        self.player.username = 'Tester'
+        self.output = io.StringIO()
+
+    def tearDown(self):
+        self.wrapper.forwarder.close()
+
+    def _call(self, *args):
+        with contextlib.redirect_stdout(self.output):
+            self.wrapper._call(*args)
+
+    def test_slow_calls(self):
+        self.wrapper.slow_call_threshold = 0.02
+        self._call('fast', lambda: None)
+        self._call('slow', time.sleep, 0.03)
+        self.assertRaises(ZeroDivisionError, self._call, 'failing',
+                          lambda: time.sleep(0.03) or 1 / 0)
+        self._call('fast', lambda: None)
+
+        self.assertEqual([name for t, name, seconds
+                          in self.wrapper.slow_calls], ['slow', 'failing'])
+        for t, name, seconds in self.wrapper.slow_calls:
+            self.assertGreaterEqual(seconds, 0.03)
+        self.assertIn('Slow call: slow took', self.output.getvalue())
+        count, total, longest = self.wrapper._timings['fast']
+        self.assertEqual(count, 2)
+        self.assertLess(longest, 0.02)
+
+    def test_profiler_survives_reload(self):
+        directory = tempfile.mkdtemp()
+        old_data = config._data
+        config._data = {
+            'dump-dir': directory,
+            'groups': {'Admin': {'permissions': {'profile': True}}},
+            'players': {'Tester': {'group': 'Admin'}}}
+        try:
+            with contextlib.redirect_stdout(self.output):
+                self.wrapper.load_command_module('example.wrapper.commands')
+                self.wrapper._commands['profile'](self.player, None, 'start')
+                self.assertTrue(self.wrapper.profiler.running)
+                self.wrapper.load_command_module('example.wrapper.commands')
+                self.wrapper._commands['profile'](self.player, None, 'stop')
+            self.assertIsNone(self.wrapper.profiler)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertEqual(len(self.client.packets), 2)
+        finally:
+            config._data = old_data
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()